@@ -4,8 +4,16 @@ import math
 import time
 import jsonlines
 import numpy as np
+import scipy.sparse
 from datetime import datetime
-import multiprocessing
+import network_tools
+import network_io
+import network_on_disk
+import seir_engine
+import kernels
+from state_store import StateStore
+from network_cache import NetworkCache
+from sharded_engine import ShardedEngine
 
 logging.basicConfig(filename='test.log', level=logging.DEBUG)
 
@@ -13,9 +21,8 @@ class VaxAgent:
     def __init__(self, unique_id, model):
         self.unique_id = unique_id
         self.model = model
-        self.current_state = None
         self.hub = None
-        self.neighbors = None 
+        self._neighbors = None # list of VaxAgent objects, only used while the network is being matched
         self.number_of_connections = None
         self.time_infected = 0
         self.time_exposed = 0 
@@ -32,6 +39,38 @@ class VaxAgent:
         """
         logging.debug("ERROR: " + string + f"unique_id = {self.unique_id}") 
 
+    @property
+    def current_state(self):
+        """
+        This agent's S/E/I/R/V state, stored as an int8 code in the model's StateStore.
+        """
+        if self.model.store is None:
+            return None
+        return self.model.store.state(self.unique_id)
+
+    @current_state.setter
+    def current_state(self, state):
+        self.model.store.set_state(self.unique_id, state)
+
+    @property
+    def neighbors(self):
+        """
+        Compatibility view of this agent's neighbors as a list of VaxAgent objects. 
+        Once the network is generated, the neighbors are stored in the model's CSR arrays (indptr/indices), 
+        so this list is rebuilt every time it is accessed. Hot loops should read the CSR arrays directly.
+        """
+        if self._neighbors is not None: #the network is still being matched, so return the working list
+            return self._neighbors
+        if self.model.indptr is None: #no network has been generated yet
+            return None
+        start = self.model.indptr[self.unique_id]
+        stop = self.model.indptr[self.unique_id + 1]
+        return [self.model.agents_by_id[neighbor_id] for neighbor_id in self.model.indices[start:stop]]
+
+    @neighbors.setter
+    def neighbors(self, neighbors):
+        self._neighbors = neighbors
+
 
     def update_state(self, exposed, time_period):
         """
@@ -154,6 +193,10 @@ class VaxAgent:
                 Agents calculate probability of infection by taking an average of past seasons that 
                 has been weighted by a certain discount rate. For example, suppose discount rate is 0.9.
                 Then, last period as a weight of (0.9)^0, the period before has (0.9)^1, then (0.9)^2, .... 
+                The average is the same for every agent in a hub, so the model keeps it once per hub.
+
+        If 'batch_vax_choice' is set in the config file, VaxModel.batch_vax_choices makes these choices for every 
+        agent at once instead.
         """
         vax_choice_key = self.model.vax_choice_key #retrieve the vax_choice_key from the model
         vax_choice_params = self.model.vax_choice_params #retrieve parameters for vax_choice algorithm from model
@@ -181,17 +224,10 @@ class VaxAgent:
                     self.current_state = 'S' 
 
         elif vax_choice_key == "neighbors":
-            num_infected = 0
-            num_unvaccinated = 0
-            observations = self.neighbors.copy() + [self] # the agent looks at her own data long with her neighbors
-
-            # if an agent finished recovered, they were infected at some point last season. 
-            # If they finished vax'ed, they were always vax'ed that season. 
-            for agent in observations: 
-                if self.model.time_period_data[self.model.season][-1][f"{agent}"]['starting_state'] == 'R':
-                    num_infected +=1 
-                if self.model.time_period_data[self.model.season][-1][f"{agent}"]['starting_state'] != 'V':
-                    num_unvaccinated +=1     
+            # the agent looks at her own data long with her neighbors. The model counts them for every agent
+            # at once in end_season (see VaxModel.observe_neighbors)
+            num_infected = int(self.model.neighbor_observations[self.unique_id, 0])
+            num_unvaccinated = int(self.model.neighbor_observations[self.unique_id, 1])
 
             if self.debug: 
                 logging.debug(f"Agent {self} had {num_infected} infected contacts"
@@ -214,7 +250,7 @@ class VaxAgent:
                 mu = vax_choice_params["beta_mean"]
                 sigma = vax_choice_params["beta_sigma"]
 
-                self.vax_choice_dict["beta"] = float(np.random.normal(mu,sigma,1)) #draw beta from a normal dist.
+                self.vax_choice_dict["beta"] = float(np.random.normal(mu,sigma)) #draw beta from a normal dist.
 
                 if self.vax_choice_dict["beta"] < 0: #bound beta below at 0
                     self.vax_choice_dict["beta"] = 0
@@ -255,29 +291,18 @@ class VaxAgent:
             else: 
                 self.current_state = 'S'
             
-            #if self.debug:
-            logging.debug(f"Agent {self} faced expected_inf_cost = {expected_inf_cost}, prob_vax_choice = {prob_vax_choice}, "
-                          f"and decided on current_state = {self.current_state}.")
+            if self.debug:
+                logging.debug(f"Agent {self} faced expected_inf_cost = {expected_inf_cost}, prob_vax_choice = {prob_vax_choice}, "
+                              f"and decided on current_state = {self.current_state}.")
 
         elif vax_choice_key == "seasonal_learning":
-            discount_factor = vax_choice_params["discount_factor"]
-            current_prob = probabilities_of_infection[self.hub]
-            season = self.model.season
-            
-            if season == 0: # in the first season, simply use the probability from last season as your weighted average
-                self.avg_prob_of_infection = current_prob
-
-            else: # in later seasons, incorporate last season's data into average weighted by discount factor
-                old_denominator = sum([(discount_factor**i) for i in range(season)])
-                old_numerator = self.avg_prob_of_infection * old_denominator
-                old_numerator_discounted = old_numerator * discount_factor
-                numerator = old_numerator_discounted + current_prob
-                denominator = old_denominator + discount_factor**season
-                self.avg_prob_of_infection = numerator / denominator
+            # every agent in a hub sees the same probabilities, so the model keeps one weighted average per hub,
+            # updated once per season in end_season (see VaxModel.update_seasonal_belief)
+            self.avg_prob_of_infection = float(self.model.avg_probs_of_infection[self.hub])
 
             if self.debug:
-                logging.debug(f"Agent {self} calculated average probability = {self.avg_prob_of_infection} in season {season} " 
-                              f"with discount_factor = {discount_factor}.")
+                logging.debug(f"Agent {self} calculated average probability = {self.avg_prob_of_infection} in season {self.model.season} " 
+                              f"with discount_factor = {vax_choice_params['discount_factor']}.")
 
             # after calculating the average probability of infection, plug it into our standard vax_choice algorithm
             if self.avg_prob_of_infection >= (1/self.infection_cost): 
@@ -292,7 +317,7 @@ class VaxAgent:
 
 class VaxModel:
     """A model with some number of agents."""
-    def __init__(self, config, run_number, tmpdirname):
+    def __init__(self, config, run_number, tmpdirname, replication=None):
         self.number_of_agents = config["number_of_agents"]
         self.rate_of_infection_per_contact = config["rate_of_infection_per_contact"]
         self.recovery_rate = config["recovery_rate"]
@@ -308,19 +333,73 @@ class VaxModel:
         self.log_time_period_data = config["log_time_period_data"]
         self.vax_choice_key = config["vax_choice_key"]
         self.vax_choice_params = config["vax_choice_params"]
+        self.network_generator = config.get("network_generator", "matching")
+        self.network_file = config.get("network_file") # only used if network_generator is 'file'
+        self.network_node_file = config.get("network_node_file")
+        self.network_degree_tolerance = config.get("network_degree_tolerance", 0.01) # the share of agents in a network file that may be short of neighbors
+        self.network_dir = config.get("network_dir") # only used if network_generator is 'out_of_core'
+        self.network_memory_budget_mb = config.get("network_memory_budget_mb", 1024)
+        self.network_seed = config.get("network_seed") # if None, networks are drawn from the global random state
+        self.homophily_base = config.get("homophily_base") # if set, networks are generated at this homophily, then rewired
+        self.network_cache_dir = config.get("network_cache_dir") # if None, networks are never cached
+        self.network_cache_max_mb = config.get("network_cache_max_mb")
+        self.engine = config.get("engine", "agents") # how each season is simulated, see run_full_simulation
+        self.scheduled_transitions = config.get("scheduled_transitions", False) # only used by the numpy and frontier engines
+        self.agent_order = config.get("agent_order", "shuffled") # the order agents are stored and simulated in, see order_agents
+        self.use_kernels = config.get("use_kernels", False) # if True, hot loops run as compiled Numba kernels, see kernels.py
+        self.number_of_shards = config.get("number_of_shards", 1) # only used by the sharded engine
+        self.adaptive_crossover = config.get("adaptive_crossover", None) # only used by the adaptive engine, None picks the default
+        self.batch_vax_choice = config.get("batch_vax_choice", False) # if True, every agent's vax choice is made at once, see batch_vax_choices
+        self.network_export_dir = config.get("network_export_dir") # if None, networks are never exported
+        self.network_export_every = config.get("network_export_every", 1) # export the network of every n-th replication
+        self.network_export_formats = config.get("network_export_formats", ["npy"])
         self.run_number = run_number
+        self.replication = replication # the index of this run among the replications of its config
         self.tmpdirname = tmpdirname
         self.agents = []
+        self.agents_by_id = [] # the same agents as self.agents, but always ordered by unique_id
+        self.agent_hubs = None # int32 array with the hub of each agent, indexed by unique_id
+        self.indptr = None # CSR adjacency: the neighbors of agent i are indices[indptr[i]:indptr[i+1]]
+        self.indices = None
+        self.contacts = None # only used by the annealed network, see network_tools.hub_contact_matrix
         self.dict_of_hubs = {} 
         self.eligible_agents = None
         self.network_structure = {} 
-        self.time_period_data = []
+        self.store = None # every agent's state, see StateStore
+        self.keep_state_history = config.get("keep_state_history", False) # if True, the store keeps every time period
+        self.log_hub_time_period_data = config.get("log_hub_time_period_data", False) # log_time_period_data, for each hub
         self.debug = False
         self.season = 0
         self.time_period = 0
         self.number_infected = None
+        self.array_engine = None # only used by the numpy and frontier engines, see seir_engine.ArrayEngine
+        self.rng = None
+        self.agent_costs = None # each agent's infection cost, only used by batch_vax_choices
+        self.betas = None # each agent's beta, only used by batch_vax_choices if vax_choice_key is logit_normal
+        self.avg_probs_of_infection = None # each hub's average, only used if vax_choice_key is seasonal_learning
+        self.belief_denominator = None # the sum of the discount weights so far, see update_seasonal_belief
+        self.observation_matrix = None # the adjacency matrix plus the identity, only used if vax_choice_key is neighbors
+        self.neighbor_observations = None # each agent's (infected, unvaccinated) count, see observe_neighbors
         self.inst_unique_id = str(self.run_number) + 'I' + str(datetime.now()) + str(random.randrange(0,100000000)) #TODO: fix this
 
+        if self.use_kernels and not kernels.NUMBA_AVAILABLE:
+            logging.debug("Institution: use_kernels is set but Numba is not installed, so the NumPy code paths are used instead")
+            self.use_kernels = False
+
+        #the sharded engine keeps no state history and only runs per-period lotteries, so runs that need either use numpy
+        if self.engine == "sharded" and (self.keep_state_history or self.scheduled_transitions):
+            logging.debug("Institution: keep_state_history and scheduled_transitions are not supported by the sharded engine, so the numpy engine is used instead")
+            self.engine = "numpy"
+
+        #out_of_core networks are meant for more agents than fit in memory as VaxAgent objects, so their agents are 
+        #only arrays (see init_agent_arrays), every season runs on an array engine and vax choices are made in batch
+        self.agent_objects = self.network_generator != "out_of_core"
+        if not self.agent_objects:
+            if self.engine == "agents":
+                logging.debug("Institution: the agents engine needs VaxAgent objects, which out_of_core networks do not build, so the numpy engine is used instead")
+                self.engine = "numpy"
+            self.batch_vax_choice = True
+
     def init_simulation(self):
         """Initializes each agent with a starting state and a hub"""
         #SANITY CHECK 1
@@ -342,14 +421,19 @@ class VaxModel:
             self.dict_of_hubs[i]['agent_ids'] = []
             self.dict_of_hubs[i]['number_of_connections'] = self.hub_densities[i]
 
-        #initiaize the list of lists to store data for each season
-        for i in range(self.number_of_seasons):
-            self.time_period_data.append([])
+        #initialize the store that holds every agent's state
+        self.agent_hubs = np.zeros(self.number_of_agents, dtype=np.int32)
+        self.store = StateStore(self.number_of_agents, self.agent_hubs, self.number_of_hubs, self.keep_state_history, self.use_kernels)
+
+        if not self.agent_objects:
+            self.init_agent_arrays()
+            return
 
         #initialize the agents with a unique id
         for i in range(self.number_of_agents):
             agent = VaxAgent(i, self)
             self.agents.append(agent)
+        self.agents_by_id = self.agents.copy()
                 
         current_hub = 0 #the first agent will be assigned to group 1
         current_agent = 0
@@ -374,6 +458,7 @@ class VaxModel:
             agent.infection_cost = self.assign_infection_cost(current_hub)
             agent.neighbors = []
             agent.number_of_connections = self.dict_of_hubs[agent.hub]["number_of_connections"]
+            self.agent_hubs[agent.unique_id] = agent.hub
             self.dict_of_hubs[agent.hub]['agent_ids'].append(agent.unique_id) 
 
             #after notifying the agent of their hub, prepare to assign the next agent to the next hub
@@ -382,7 +467,50 @@ class VaxModel:
             elif current_agent == self.hub_sizes[current_hub] - 1: #if this hub is full, move to the next one
                 current_hub+=1
                 current_agent = 0
+
+        #now that every agent has a state and a hub, count the agents in each state
+        self.store.recount()
     
+    def init_agent_arrays(self):
+        """
+        Sets up the agents without a VaxAgent for each of them, for out_of_core networks. Agents are assigned to hubs 
+        in order of unique_id like init_simulation does, but their infection costs and starting states are drawn for 
+        every agent at once from the model's numpy generator, so they match init_simulation in distribution only.
+        """
+        self.rng = np.random.default_rng(random.getrandbits(64)) #seeding the random module still makes runs repeatable
+        self.agent_hubs[:] = np.repeat(np.arange(self.number_of_hubs, dtype=np.int32), self.hub_sizes)
+        self.agent_costs = self.assign_infection_costs()
+
+        #seed agents start infected, the others are vaccinated with probability starting_vaccination_rate
+        seeds = self.rng.choice(self.number_of_agents, 10, replace=False)
+        vaccinated = self.rng.random(self.number_of_agents) <= self.starting_vaccination_rate
+        states = np.where(vaccinated, seir_engine.VACCINATED, seir_engine.SUSCEPTIBLE).astype(np.int8)
+        states[seeds] = seir_engine.INFECTIOUS
+        self.store.replace(states)
+
+    def assign_infection_costs(self):
+        """
+        Draws every agent's infection cost at once from the model's numpy generator, indexed by unique_id. 
+        See assign_infection_cost for the infection cost keys.
+        """
+        if self.infection_cost_key == "constant":
+            return np.asarray(self.infection_costs, dtype=np.float64)[self.agent_hubs]
+
+        elif self.infection_cost_key == "uniform":
+            bounds = np.asarray(self.infection_costs, dtype=np.float64)[self.agent_hubs]
+            return self.rng.uniform(bounds[:, 0], bounds[:, 1])
+
+        elif self.infection_cost_key == "normal":
+            means = np.array([costs["mean"] for costs in self.infection_costs], dtype=np.float64)[self.agent_hubs]
+            sds = np.array([costs["sd"] for costs in self.infection_costs], dtype=np.float64)[self.agent_hubs]
+            agent_costs = self.rng.normal(means, sds)
+            agent_costs[agent_costs < 0] = 0.001 # bound the infection_cost below at 0.001
+            return agent_costs
+
+        else:
+            logging.debug(f"ERROR: Unexpected value for infection_cost_key = {self.infection_cost_key}")
+            return np.ones(self.number_of_agents)
+
     def assign_infection_cost(self, current_hub):
         """
         This function assigns an infection_cost to an agent based on their hub. 
@@ -424,7 +552,7 @@ class VaxModel:
             infection_cost_dict = self.infection_costs[current_hub]
             mean = infection_cost_dict["mean"]
             sd = infection_cost_dict["sd"]
-            infection_cost = float(np.random.normal(mean,sd,1)) #draw the agents inf cost from a normal distribution
+            infection_cost = float(np.random.normal(mean,sd)) #draw the agents inf cost from a normal distribution
             if infection_cost < 0: # bound the infection_cost below at 0.001
                 infection_cost = 0.001
             return infection_cost
@@ -434,8 +562,209 @@ class VaxModel:
             self.error_log(f"Unexpected value for infection_cost_key = {self.infection_cost_key}")
 
     def generate_network(self):
+        """
+        Generates the contact network, using the algorithm picked by the 'network_generator' key in the config file. 
+
+        If 'network_cache_dir' is set in the config file, networks are stored in (and loaded from) an on-disk cache
+        keyed by the generator, hub_sizes, hub_densities, degree_of_homophily and the seed. The seed is 'network_seed'
+        if it is set, otherwise the replication number, so every config with the same network parameters reuses the
+        same set of networks. 'network_cache_max_mb' caps the size of the cache directory.
+
+        If 'homophily_base' is set, the matching and stochastic_block generators build (or load from the cache) a base 
+        network at that homophily, seeded the same way, and then rewire it to degree_of_homophily with degree-preserving 
+        swaps of just enough edges. In a homophily sweep, every level then runs on a rewired copy of the same base 
+        network for each replication, so differences between the levels are not blurred by differences between networks. 
+        If the base network cannot be rewired to degree_of_homophily (see network_tools.rewire_homophily), an ERROR is 
+        logged and the network is generated at degree_of_homophily from scratch instead.
+
+        Possible network generators: 
+
+        - matching (default),
+            Description: Agents are shuffled, then each agent is matched one neighbor at a time, inside their hub with
+                probability degree_of_homophily and outside their hub otherwise. Agents who run out of valid matches
+                are left with fewer neighbors than their hub density. 
+        
+        - stochastic_block, 
+            Description: The number of edges inside each hub and between each pair of hubs is decided up front, 
+                then agents' stubs are shuffled and paired block by block in time linear in the number of edges. 
+                Every agent gets exactly the number of neighbors given by their hub density. 
+
+        - out_of_core, 
+            Description: A network from the same distribution as stochastic_block (but not the same network for the same 
+                seed), generated hub by hub straight into memory-mapped indptr.npy/indices.npy files in a subdirectory of 
+                'network_dir', using about 'network_memory_budget_mb' of working memory. The model then runs directly 
+                against the memory-mapped files, with no VaxAgent objects (see init_agent_arrays), on the numpy engine 
+                if 'engine' is agents, and with batch_vax_choice always on. Each network's subdirectory is named after 
+                its parameters and seed, so a network generated before, by this or any other worker, is reused (see 
+                network_on_disk.generate_or_load_on_disk). A seed is required, so without a network_seed the model 
+                needs a replication number. 
+
+        - file, 
+            Description: Nothing is generated. The network is loaded from 'network_file', which can be a .npy or .csv 
+                edge list (optionally with a 'network_node_file' giving each agent's hub or urban/rural type), a .npz 
+                file of CSR arrays (indptr, indices) or a .gexf file. Hub sizes and degrees are checked against the 
+                config, allowing up to 'network_degree_tolerance' of the agents to be short of neighbors (see 
+                network_io.load_network). If the network does not match, no seasons are run. 
+
+        - annealed, 
+            Description: No network is stored. Every time period, each agent meets hub_density new random agents, 
+                drawn from the hubs in the proportions a stochastic_block network would have (see 
+                network_tools.hub_contact_matrix and seir_engine.AnnealedEngine), so memory is O(number_of_agents). 
+                Seasons always run on the AnnealedEngine, whatever the 'engine' key says, and the neighbors 
+                vax_choice_key, which needs a network, is not available. 
+        """
+        seed = self.network_seed
+        if seed is None and (self.network_cache_dir is not None or self.homophily_base is not None or self.network_generator == "out_of_core"):
+            seed = self.replication #cached, rewired and out_of_core networks need a seed, so fall back on the replication number
+
+        if self.network_generator == "out_of_core":
+            network = network_on_disk.generate_or_load_on_disk(self.network_dir, self.hub_sizes, self.hub_densities, 
+                                                               self.degree_of_homophily, seed, self.network_memory_budget_mb)
+            if network is None:
+                return
+            self.set_adjacency(*network)
+            self.order_agents()
+            self.record_network()
+            return
+
+        elif self.network_generator == "file":
+            network = network_io.load_network(self.network_file, self.hub_sizes, self.hub_densities, self.network_node_file, 
+                                              self.network_degree_tolerance)
+            if network is None:
+                logging.debug(f"ERROR: network file {self.network_file} could not be used, so no seasons will be run")
+                return
+            self.set_adjacency(*network)
+            self.order_agents()
+            self.record_network()
+            return
+
+        elif self.network_generator == "annealed":
+            self.contacts = network_tools.hub_contact_matrix(self.hub_sizes, self.hub_densities, self.degree_of_homophily)
+            if self.vax_choice_key == "neighbors":
+                logging.debug("ERROR: the neighbors vax_choice_key needs a network, which the annealed network does not have")
+            self.order_agents()
+            return
+
+        elif self.network_generator not in ("matching", "stochastic_block"):
+            logging.debug(f"ERROR: Unexpected value for network_generator = {self.network_generator}")
+            return
+
+        #if homophily_base is set, generate the base network at that homophily, then rewire it to degree_of_homophily below
+        homophily = self.homophily_base if self.homophily_base is not None else self.degree_of_homophily
+
+        #if a network cache is configured, try to load this network instead of generating it
+        cache = None
+        network = None
+        if self.network_cache_dir is not None:
+            if seed is None:
+                logging.debug("ERROR: network_cache_dir is set, but there is no network_seed or replication number to key the cache")
+            else:
+                cache = NetworkCache(self.network_cache_dir, self.network_cache_max_mb)
+                #compiled matching draws from a different random stream, so its networks are cached separately
+                generator = "compiled_matching" if self.network_generator == "matching" and self.use_kernels else self.network_generator
+                cache_key = cache.key(generator, self.hub_sizes, self.hub_densities, homophily, seed)
+                network = cache.load(cache_key)
+
+        if network is not None:
+            self.set_adjacency(*network)
+
+        elif self.network_generator == "matching":
+            self.generate_matched_network(seed, homophily)
+
+        elif self.network_generator == "stochastic_block":
+            indptr, indices = network_tools.generate_block_network(self.hub_sizes, self.hub_densities, homophily, seed)
+            self.set_adjacency(indptr, indices)
+
+        if cache is not None and network is None:
+            cache.store(cache_key, self.indptr, self.indices)
+
+        if homophily != self.degree_of_homophily:
+            rng = np.random.default_rng(seed)
+            network = network_tools.rewire_homophily(self.indptr, self.indices, self.agent_hubs, self.degree_of_homophily, rng)
+            if network is not None:
+                self.set_adjacency(*network)
+            else: #the base network cannot be rewired to degree_of_homophily, so generate this network from scratch instead
+                logging.debug(f"ERROR: the homophily_base network could not be rewired to homophily {self.degree_of_homophily}, "
+                              f"so a new network was generated at that homophily instead of a rewired copy of the base network")
+                if self.network_generator == "matching":
+                    for agent in self.agents_by_id:
+                        agent.neighbors = []
+                    self.generate_matched_network(seed)
+                else:
+                    self.set_adjacency(*network_tools.generate_block_network(self.hub_sizes, self.hub_densities, self.degree_of_homophily, seed))
+
+        self.order_agents()
+        self.record_network()
+
+    def order_agents(self):
+        """
+        Decides the order agents are simulated in, using the 'agent_order' key in the config file. 
+        Only the order of self.agents changes, never the unique_ids or the network, so the randomness of the matching 
+        is preserved. Every loop over self.agents draws its random numbers in this order, so runs with different 
+        orders are statistically equivalent but not identical.
+
+        Possible agent orders: 
+
+        - shuffled (default),
+            Description: The original behavior. Agents stay in whatever order the matching shuffled them into, 
+                so each pass over the agents visits them (and their neighbors) in random memory order. 
+
+        - hub, 
+            Description: Agents are visited in order of unique_id, which is already hub by hub, so each pass walks 
+                the StateStore and the CSR arrays front to back. Nothing is renumbered, so this is a no-op with 
+                every generator but matching, the only one that shuffles self.agents. 
+        """
+        if self.agent_order == "shuffled":
+            return
+
+        elif self.agent_order != "hub":
+            logging.debug(f"ERROR: Unexpected value for agent_order = {self.agent_order}")
+            return
+
+        self.agents = self.agents_by_id.copy()
+
+    def record_network(self):
+        """
+        Logs the network diagnostics and, if 'network_export_dir' is set, exports the network of every 
+        'network_export_every'-th replication in each of the 'network_export_formats' ('npy', 'csv' and/or 'gexf').
+        Networks built for the shared pool (run_number -1, see network_pool) are skipped, since every worker that 
+        runs on one records it under its own run_number.
+        """
+        if self.run_number < 0:
+            return
+
+        self.log_network_diagnostics()
+
+        if self.network_export_dir is not None:
+            replication = self.replication if self.replication is not None else self.run_number
+            if replication % self.network_export_every == 0:
+                network_io.export_network(self.network_export_dir, f"network_{self.run_number}", self.indptr, self.indices,
+                                          self.agent_hubs, self.hub_densities, self.network_export_formats)
+
+    def generate_matched_network(self, seed=None, degree_of_homophily=None):
+        """
+        The original matching algorithm. See the 'matching' key in generate_network. 
+        If a seed is given, the matching draws from its own random stream instead of the global one.
+        By default the matching targets the model's degree_of_homophily.
+        If 'use_kernels' is set, the agents are shuffled the same way, but the matching itself runs as a compiled 
+        kernel (see kernels.match_network), which gives the same distribution of networks but not the same networks.
+        """
+        rng = random if seed is None else random.Random(seed)
+        if degree_of_homophily is None:
+            degree_of_homophily = self.degree_of_homophily
+
+        rng.shuffle(self.agents)
+
+        if self.use_kernels:
+            order = np.array([agent.unique_id for agent in self.agents], dtype=np.int64)
+            number_of_connections = np.array([agent.number_of_connections for agent in self.agents_by_id], dtype=np.int64)
+            indptr, indices, unmatched = kernels.match_network(order, self.agent_hubs, number_of_connections, self.number_of_hubs,
+                                                               degree_of_homophily, rng.getrandbits(32))
+            if unmatched > 0:
+                logging.debug(f"Institution: {unmatched} matches could not be made when assigning neighbors")
+            self.set_adjacency(indptr, indices)
+            return
 
-        random.shuffle(self.agents)
         self.eligible_agents = self.agents.copy()
         
         #iterate through the list of registered_agents
@@ -473,21 +802,21 @@ class VaxModel:
 
                     #if both lists are non-empty, decide randomly where to draw the match, based on the degree_of_homophily
                     if len(inside_hub)>0 and len(outside_hub)>0:
-                        homophily_lottery = random.random()
-                        if homophily_lottery <= self.degree_of_homophily: #if the lottery is less than the parameter, match within hub
-                            random_neighbor = random.choice(inside_hub)
+                        homophily_lottery = rng.random()
+                        if homophily_lottery <= degree_of_homophily: #if the lottery is less than the parameter, match within hub
+                            random_neighbor = rng.choice(inside_hub)
                         else: #if the lottery exceeds the probability, match outside of hub
-                            random_neighbor = random.choice(outside_hub)
+                            random_neighbor = rng.choice(outside_hub)
                         self.match(agent, random_neighbor)
 
                     #if only inside_hub is non-empty, match from that list
                     elif len(inside_hub)>0 and len(outside_hub)==0:
-                        random_neighbor = random.choice(inside_hub)
+                        random_neighbor = rng.choice(inside_hub)
                         self.match(agent, random_neighbor)
 
                     #if only outside_hub is non_empty, match from that list
                     elif len(inside_hub)==0 and len(outside_hub)>0:
-                        random_neighbor = random.choice(outside_hub)
+                        random_neighbor = rng.choice(outside_hub)
                         self.match(agent, random_neighbor)
 
                     else: #if an agent cannot find a valid match, report what agent has been left unmatched
@@ -498,79 +827,75 @@ class VaxModel:
                     agent.number_of_connections:
                     self.eligible_agents.append(agent)
                     
-        #matching is complete! Let's compute some basic info about the network.
-        computed_hub_sizes = [len(self.dict_of_hubs[hub_number]['agent_ids']) for hub_number in self.dict_of_hubs.keys()] 
-        total_hub_matches = [0 for i in range(len(self.hub_densities))]  #compute density of each hub
-        inside_hub_matches = total_hub_matches.copy()
-        total_neighbors = 0 #compute total number of interactions
-        neighbors_inside_hub = 0 #compute number of interactions within hub
+        #matching is complete! Store the network as CSR arrays and drop the lists of neighbor objects
+        self.build_adjacency()
 
-        for agent in self.agents:
-            #if the agent has a weird number of matches, log it
-            if len(agent.neighbors) != agent.number_of_connections:
-                logging.debug(f"Institution: Agent {agent} has {len(agent.neighbors)} neighbors, wanted {agent.number_of_connections}")
-            else: 
-                if self.debug:
-                    logging.debug(f"Institution: Agent {agent} has the correct number of matches!")
-            total_hub_matches[agent.hub] += len(agent.neighbors)
-            total_neighbors += len(agent.neighbors)  
-            for neighbor in agent.neighbors: 
-                if neighbor.unique_id in self.dict_of_hubs[agent.hub]['agent_ids']:
-                    neighbors_inside_hub +=1
-                    inside_hub_matches[agent.hub] +=1
-
-        #for each hub, density is the total number of matches divided by the size
-        computed_hub_densities = [ ]
-        for total, size in zip(total_hub_matches, computed_hub_sizes):
-            computed_hub_densities.append(total/size)
-
-        #for each hub, the level of homophily is the number of matches inside-hub divided by the total number of matches
-        computed_hub_homophilies = []  
-        for inside_total, total in zip(inside_hub_matches, total_hub_matches):
-            computed_hub_homophilies.append(inside_total/total)
-
-        #this is the overall homophily of the network
-        proportion_inside_hub = neighbors_inside_hub / total_neighbors
-            
-        logging.debug("INSTITUTION: NETWORK GENERATED! Here is some information: \n" 
-                      f"actual list of hub densities = {computed_hub_densities} \n"
-                      f"expected list of hub densities = {self.hub_densities} \n"
-                      f"actual list of hub sizes = {computed_hub_sizes} \n"
-                      f"expected list of hub sizes = {self.hub_sizes} \n"
-                      f"proportion of neighbors inside hub, by hub = {computed_hub_homophilies} \n"
-                      f"total proportion of neighbors inside one's hub = {proportion_inside_hub}, expected = {self.degree_of_homophily}")
-
-        #Testing Urban vs. Rural homophily. TODO: this code seems to be broken. make it more general somehow?? 
-        avg_rural_homophily = 0
-        avg_urban_homophily  = 0
-        for i in range(self.number_of_hubs):
-            if self.hub_densities[i]==4:
-                avg_rural_homophily += computed_hub_homophilies[i]
-            elif self.hub_densities[i]==7:
-                avg_urban_homophily += computed_hub_homophilies[i]
-        avg_rural_homophily = avg_rural_homophily/5
-        avg_urban_homophily = avg_urban_homophily/5    
-
-        # #logging the different averages
-        # self.log_experiment_data({"avg_rural_homophily": avg_rural_homophily,
-        #                           "avg_urban_homophily": avg_urban_homophily,
-        #                           "data_flag": "homophily"})
-        
-        # #log some data about network structure
-        # for agent in self.registered_agents:
-        #     for neighbor in self.network_structure[f"{agent}"]["neighbors"]:
-        #         self.log_experiment_data({"source": agent,
-        #                                   "target": neighbor,
-        #                                   "data_flag": "network"})
-        #     #then log some data about agent hubs, #TODO: adjust this depending on the urban-rural contact rates
-        #     if len(self.network_structure[f"{agent}"]["neighbors"]) <= 8:
-        #         city_type = 'rural'
-        #     else: 
-        #         city_type = 'urban'
-        #     self.log_experiment_data({"agent": agent,
-        #                               "hub": self.network_structure[f"{agent}"]["hub"],
-        #                               "type": city_type,
-        #                               "data_flag": "hub"})
+    def log_network_diagnostics(self):
+        """
+        Computes some basic info about the generated network (hub sizes, densities, homophily, the hub x hub mixing matrix
+        and how many agents fell short of their target number of neighbors), then writes it as one record with 
+        data_flag = 'network' to a network data file next to the seasonal data. 
+        """
+        diagnostics = network_tools.network_diagnostics(self.indptr, self.indices, self.agent_hubs, self.hub_densities)
+
+        if self.debug:
+            logging.debug("INSTITUTION: NETWORK GENERATED! Here is some information: \n" 
+                          f"actual list of hub densities = {diagnostics['hub_densities']} \n"
+                          f"expected list of hub densities = {self.hub_densities} \n"
+                          f"actual list of hub sizes = {diagnostics['hub_sizes']} \n"
+                          f"expected list of hub sizes = {self.hub_sizes} \n"
+                          f"proportion of neighbors inside hub, by hub = {diagnostics['hub_homophilies']} \n"
+                          f"total proportion of neighbors inside one's hub = {diagnostics['homophily']}, expected = {self.degree_of_homophily}")
+
+        if diagnostics["agents_short"] > 0:
+            logging.debug(f"Institution: {diagnostics['agents_short']} agents are short {diagnostics['missing_connections']} neighbors in total")
+
+        if self.tmpdirname is None: #this model is only being used to build a network, so there is nowhere to write the record
+            return
+
+        network_dict = {"run_number": self.run_number,
+                        "inst_unique_id": self.inst_unique_id,
+                        "network_generator": self.network_generator,
+                        "expected_hub_sizes": self.hub_sizes,
+                        "expected_hub_densities": self.hub_densities,
+                        "expected_homophily": self.degree_of_homophily,
+                        "data_flag": 'network',
+                        "timestamp": time.time(),
+                        **diagnostics}
+
+        with jsonlines.open(self.tmpdirname + f'/network_data_{self.run_number}.log', mode='a') as writer:
+            writer.write(network_dict)
+
+    def build_adjacency(self):
+        """
+        Converts the lists of neighbor objects built during matching into CSR arrays indexed by unique_id. 
+        After this, agent.neighbors is only a compatibility view over self.indptr and self.indices.
+        """
+        degrees = np.zeros(self.number_of_agents, dtype=np.int64)
+        for agent in self.agents_by_id:
+            degrees[agent.unique_id] = len(agent._neighbors)
+
+        indptr = np.zeros(self.number_of_agents + 1, dtype=np.int64)
+        np.cumsum(degrees, out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        for agent in self.agents_by_id:
+            indices[indptr[agent.unique_id]:indptr[agent.unique_id + 1]] = [neighbor.unique_id for neighbor in agent._neighbors]
+
+        self.set_adjacency(indptr, indices)
+
+    def set_adjacency(self, indptr, indices):
+        """
+        Installs a CSR network (the neighbors of agent i are indices[indptr[i]:indptr[i+1]]). 
+        Any lists of neighbor objects left over from matching are released.
+        """
+        if len(indptr) != self.number_of_agents + 1:
+            logging.debug(f"ERROR: CSR network has {len(indptr) - 1} agents, expected {self.number_of_agents}")
+
+        self.indptr = indptr
+        self.indices = indices
+        self.observation_matrix = None # rebuilt from the new network the next time it is needed
+        for agent in self.agents_by_id:
+            agent.neighbors = None
 
     def match(self, agent, neighbor):
         """
@@ -587,13 +912,72 @@ class VaxModel:
             self.eligible_agents.remove(neighbor)
 
     def run_full_simulation(self):
-        
+        """
+        Runs every season, using the engine picked by the 'engine' key in the config file. 
+
+        Possible engines: 
+
+        - agents (default),
+            Description: The original engine. Each time period loops over every agent and their neighbors in Python, 
+                and every agent updates their own state with their own random draws. 
+
+        - numpy, 
+            Description: States are kept in an int8 array for the whole season (see seir_engine). Each time period 
+                is one sparse matrix-vector product to count infectious neighbors, a lookup table of exposure 
+                probabilities and one array of uniform draws. The same transitions happen with the same 
+                probabilities, so seasons match the agents engine in distribution, but not draw for draw. 
+
+        - frontier, 
+            Description: Like numpy, but each time period only touches the infectious and exposed agents and the 
+                susceptible neighbors of the infectious ones, so its cost follows the size of the epidemic instead of 
+                the number of agents. This wins most on the small, long-tailed outbreaks of later seasons.
+
+        - adaptive, 
+            Description: Picks the numpy or the frontier step every time period, from how many infectious and exposed 
+                agents there are and how many neighbors the infectious ones have, so the seeds and the long tail of a 
+                season run on the frontier and a large outbreak runs on the dense step. 'adaptive_crossover' sets the 
+                switch point (see seir_engine.AdaptiveEngine), and how many time periods ran on each step is logged 
+                at the end of every season.
+
+        - sharded, 
+            Description: Like numpy, but the hubs are split across 'number_of_shards' worker processes (1 by default, 
+                so set it to the number of cores to spare) that step their own agents in parallel on states kept in 
+                shared memory, so a single very large replication can use several cores. Under parallel_run every 
+                replication starts its own workers, so the shards and the parallel replications share the cores. 
+                With fewer cores than shards it is slower than numpy (see testing_files/sharded_benchmark).
+                Configs with scheduled_transitions or keep_state_history set run on the numpy engine instead, since 
+                the sharded engine supports neither. See sharded_engine.ShardedEngine. 
+
+        - hub,
+            Description: Not an engine of this class. parallel_run runs configs with engine = 'hub' on a HubModel
+                (see hub_model), which approximates each hub's S/E/I/R/V counts without a network or agents.
+
+        With numpy, frontier or adaptive, setting 'scheduled_transitions' replaces the per-period incubation and recovery 
+        lotteries with waiting times drawn once per agent, when they enter Ex or In (see seir_engine.TransitionCalendar). 
+
+        If 'use_kernels' is set and Numba is installed, every engine runs its loops over agents and neighbors as 
+        compiled kernels (see kernels.py). They draw the same random numbers, so seasons are identical either way. 
+        """
+        if self.indptr is None and self.network_generator != "annealed":
+            logging.debug("ERROR: there is no network to run on, so no seasons were run")
+            return self.run_number
+
+        if self.engine == "sharded":
+            return self.run_sharded_simulation()
+
         for season in range(self.number_of_seasons): 
             self.season = season
 
+            if self.engine in ("numpy", "frontier", "adaptive") or self.network_generator == "annealed":
+                self.run_numpy_season()
+                self.end_season(season)
+                continue
+            elif self.engine != "agents":
+                logging.debug(f"ERROR: Unexpected value for engine = {self.engine}")
+
             #count the number of infected agents at the start of the season
-            self.number_infected = sum([1 for agent in self.agents if agent.current_state == 'In'])
-            self.number_vaccinated = sum([1 for agent in self.agents if agent.current_state == 'V'])
+            self.number_infected = self.store.count(seir_engine.INFECTIOUS)
+            self.number_vaccinated = self.store.count(seir_engine.VACCINATED)
 
             if self.debug:
                 logging.debug(f"Institution: Entered loop for new season = {self.season} inside run_full_simulation "
@@ -603,30 +987,109 @@ class VaxModel:
             if self.number_infected == 0:
                 logging.debug(f"Institution: All seed agents were vaccinated in season {self.season} so no epidemic took place.")
                 
-                #log time period data such that all agents were not exposed
-                self.time_period_data[self.season].append({})
-                for agent in self.agents:
-                    self.time_period_data[self.season][self.time_period][f"{agent}"] = {} #add this agent to the record for the time period
-                    self.time_period_data[self.season][self.time_period][f"{agent}"]["exposed"] = False #the default state for this is False, unless they get infected later
-                    self.time_period_data[self.season][self.time_period][f"{agent}"]["starting_state"] = agent.current_state
+                #record a time period in which no agents were exposed
+                self.store.begin_period()
+                self.store.record_period()
+
+            if self.use_kernels: #the unique_ids of the agents in the order they draw their random numbers
+                order = np.array([agent.unique_id for agent in self.agents], dtype=np.int64)
+                table = seir_engine.exposure_table(self.rate_of_infection_per_contact, int(np.diff(self.indptr).max(initial=0)))
 
             #repeat the simulation until the number of infected equals zero        
             while self.number_infected > 0:
-                self.run_one_time_period()
+                if self.use_kernels:
+                    self.run_compiled_time_period(order, table)
+                else:
+                    self.run_one_time_period()
 
-                for agent in self.agents: #notify agents of their exposure status, allow them to change state
-                    exposed = self.time_period_data[self.season][self.time_period][f"{agent}"]['exposed']
-                    agent.update_state(exposed, self.time_period)
+                    for agent in self.agents: #notify agents of their exposure status, allow them to change state
+                        exposed = bool(self.store.exposed[agent.unique_id])
+                        agent.update_state(exposed, self.time_period)
 
                 self.time_period += 1 #move to the next time period
-                self.number_infected = sum([1 for agent in self.agents if agent.current_state == 'In'])
+                self.number_infected = self.store.count(seir_engine.INFECTIOUS)
             
             #whenever the infection dies out, end the season
             self.end_season(season)
         
         return self.run_number
 
-        
+
+    def run_sharded_simulation(self):
+        """
+        Runs every season on the sharded engine. The worker processes are started once, and always stopped at the end.
+        """
+        engine = ShardedEngine(self, self.number_of_shards)
+        try:
+            for season in range(self.number_of_seasons):
+                self.season = season
+                engine.run_season(self)
+                self.end_season(season)
+        finally:
+            engine.close()
+
+        return self.run_number
+
+    def run_numpy_season(self):
+        """
+        Runs one season on the numpy, frontier or adaptive engine, or on the annealed network, straight on the arrays of the StateStore.
+        """
+        if self.array_engine is None and self.network_generator == "annealed":
+            self.rng = np.random.default_rng(random.getrandbits(64)) #seeding the random module still makes runs repeatable
+            self.array_engine = seir_engine.AnnealedEngine(self.agent_hubs, self.contacts, self.hub_densities, self.rate_of_infection_per_contact,
+                                                           self.recovery_rate, 1 / self.incubation_period, self.rng, self.scheduled_transitions)
+        elif self.array_engine is None: #the network never changes, so the engine is built once per model
+            self.rng = np.random.default_rng(random.getrandbits(64)) #seeding the random module still makes runs repeatable
+            table = seir_engine.exposure_table(self.rate_of_infection_per_contact, int(np.diff(self.indptr).max(initial=0)))
+            if self.engine == "adaptive":
+                self.array_engine = seir_engine.AdaptiveEngine(self.indptr, self.indices, table, self.recovery_rate, 1 / self.incubation_period, 
+                                                               self.rng, self.scheduled_transitions, self.use_kernels, self.adaptive_crossover)
+            else:
+                engine_class = seir_engine.DenseEngine if self.engine == "numpy" else seir_engine.FrontierEngine
+                self.array_engine = engine_class(self.indptr, self.indices, table, self.recovery_rate, 1 / self.incubation_period, 
+                                                 self.rng, self.scheduled_transitions, self.use_kernels)
+        engine = self.array_engine
+
+        store = self.store
+        time_infected = np.zeros(self.number_of_agents, dtype=np.int32)
+        time_exposed = np.zeros(self.number_of_agents, dtype=np.int32)
+
+        #count the number of infected agents at the start of the season
+        self.number_infected = store.count(seir_engine.INFECTIOUS)
+        self.number_vaccinated = store.count(seir_engine.VACCINATED)
+
+        if self.debug:
+            logging.debug(f"Institution: Entered loop for new season = {self.season} inside run_numpy_season "
+                          f"with {self.number_infected} infected agents and {self.number_vaccinated} vaccinated agents to begin.")
+
+        # if no agents started infected, then all seed agents were vaxed, and no epidemic takes place
+        if self.number_infected == 0:
+            logging.debug(f"Institution: All seed agents were vaccinated in season {self.season} so no epidemic took place.")
+            store.begin_period()
+            store.record_period()
+
+        engine.start_season(store, self.time_period)
+
+        #repeat the simulation until the number of infected equals zero
+        while self.number_infected > 0:
+            store.begin_period()
+            time_infected[engine.infectious] += 1
+            time_exposed[engine.exposed] += 1
+            engine.step(store, self.time_period)
+            store.record_period()
+            self.log_period_data()
+
+            self.time_period += 1 #move to the next time period
+            self.number_infected = store.count(seir_engine.INFECTIOUS)
+
+        for agent in self.agents_by_id:
+            agent.time_infected += int(time_infected[agent.unique_id])
+            agent.time_exposed += int(time_exposed[agent.unique_id])
+
+        if self.engine == "adaptive": #the counts are totals over every season so far
+            logging.debug(f"Institution: after season {self.season}, the adaptive engine has run {engine.path_counts['dense']} "
+                          f"dense and {engine.path_counts['frontier']} frontier time periods")
+
     def run_one_time_period(self):
         """
         Runs the SEIR simulation for one time period. At the end of this function, the time period is ticked up by 1.  
@@ -634,18 +1097,15 @@ class VaxModel:
         if self.debug:
             logging.debug(f"Institution entered run_one_time_period, time_period = {self.time_period}, season = {self.season}")
         
-        self.time_period_data[self.season].append({})
-
-        for agent in self.agents:
-            self.time_period_data[self.season][self.time_period][f"{agent}"] = {} #add this agent to the record for the time period
-            self.time_period_data[self.season][self.time_period][f"{agent}"]["exposed"] = False #the default state for this is False, unless they get infected later
-            self.time_period_data[self.season][self.time_period][f"{agent}"]["starting_state"] = agent.current_state
+        self.store.begin_period()
 
         if self.debug:
-            logging.debug(f"Institution: initialized time_period_data in time period = {self.time_period}, season = {self.season}, "
-                          f"time_period_data = {self.time_period_data[self.season][self.time_period]}")
+            logging.debug(f"Institution: started time period = {self.time_period}, season = {self.season}, "
+                          f"starting_states = {self.store.starting_states}")
+
+        #flag which agents start this time period infectious, indexed by unique_id to match the CSR arrays
+        infectious = self.store.starting_states == seir_engine.INFECTIOUS
 
-        new_exposures = 0
         #find out which agent has been matched with an infectious person in this time period
         for agent in self.agents: #iterate through all the agents
                 if self.debug:
@@ -653,64 +1113,92 @@ class VaxModel:
                 infectious_neighbors = 0
                 if self.debug:
                     logging.debug(f"INSTITUTION: agent {agent} has these neighbors: {agent.neighbors}")
-                for neighbor in agent.neighbors: #then iterate through each neighbor they contacted
-                    #then check if the agent was susceptible and they came in contact with an infectious neighbor
-                    if (self.time_period_data[self.season][self.time_period][f"{neighbor}"]['starting_state'] == 'In') and (self.time_period_data[self.season][self.time_period][f"{agent}"]['starting_state'] == 'S'):
-                            infectious_neighbors +=1 #keep count of how many infectious neighbors an agent encountered
+                #check if the agent was susceptible, then count how many infectious neighbors they came in contact with
+                if agent.current_state == 'S':
+                    start = self.indptr[agent.unique_id]
+                    stop = self.indptr[agent.unique_id + 1]
+                    infectious_neighbors = int(np.count_nonzero(infectious[self.indices[start:stop]]))
                 #after iterating through each neighbor, calculate the probability that our agent is exposed
                 #see Chang and Tassier (2019), A.2 for the following equation
                 exposure_probability = 1 - ((1-self.rate_of_infection_per_contact)**infectious_neighbors)
                 exposure_lottery = random.random() #randomly draw whether the agent was exposed
                 if exposure_lottery <= exposure_probability: 
-                    self.time_period_data[self.season][self.time_period][f"{agent}"]['exposed'] = True #if the infection lottery passes, that agent is now infected
-                    new_exposures += 1 #keep count of how susceptible many agents are exposed                     
-
-        current_recovered = 0
-        #count how many infected agents were recovered before this round -- only after time period 0
-        if self.time_period > 0:
-            for agent in self.agents: ###self.time_period_data[self.season][self.time_period].keys(): #iterate through all the agents
-                if self.time_period_data[self.season][self.time_period][f"{agent}"]["starting_state"] == 'R':
-                    current_recovered += 1
-
-        current_infections = 0
-        #then count how many agents entered the round infectious
-        for agent in self.agents: #self.time_period_data[self.season][self.time_period].keys():
-            if self.time_period_data[self.season][self.time_period][f"{agent}"]['starting_state'] == 'In': 
-                current_infections += 1
-
-        current_exposed = 0
-        #now count how many agents are currently exposed
-        for agent in  self.agents: #self.time_period_data[self.season][self.time_period].keys():
-            #first, count how many agents entered the round exposed
-            if self.time_period_data[self.season][self.time_period][f"{agent}"]['starting_state'] == 'Ex': 
-                current_exposed += 1
-            #else if the agent was exposed this round, count them too
-            elif self.time_period_data[self.season][self.time_period][f"{agent}"]['exposed'] == True:
-                current_exposed +=1
-
-        current_vaccinated = 0
-        #finally, count how many agents were vaccinated this round
-        for agent in self.agents: #self.time_period_data[self.season][self.time_period].keys():
-            if self.time_period_data[self.season][self.time_period][f"{agent}"]['starting_state'] == 'V': 
-                current_vaccinated += 1
-
-        current_susceptible = self.number_of_agents - \
-                              current_vaccinated - current_recovered - current_infections - current_exposed
-        
-        if self.log_time_period_data:
-             logging.debug({"time_period": self.time_period,
-                           "season": self.season,
-                           "current_recovered": current_recovered,
-                           "new_exposures": new_exposures,
-                           "current_infections": current_infections,
-                           "current_exposed": current_exposed,
-                           "current_vaccinated": current_vaccinated,
-                           "current_susceptible": current_susceptible,
-                           "data_flag": 'infection'})
+                    self.store.expose(agent.unique_id) #if the infection lottery passes, that agent is now infected
+
+        self.store.record_period()
+        self.log_period_data()
 
         if self.debug:
             logging.debug("institution exited run_basic_simulation")
     
+    def run_compiled_time_period(self, order, table):
+        """
+        Runs run_one_time_period and every agent's update_state for one time period, with the exposures counted by 
+        a compiled kernel (see kernels.agent_exposures) and the state changes applied to the StateStore in bulk. 
+        The same random numbers are drawn from the random module in the same order, one per agent in order for the 
+        exposures and then one per infectious or exposed agent for their transition, so the season is identical 
+        to the one the agents would have simulated themselves. Only the per-agent debug logging is skipped.
+        table is the seir_engine.exposure_table of the network.
+        """
+        store = self.store
+        store.begin_period()
+
+        exposure_lottery = np.array([random.random() for _ in range(len(order))])
+        newly_exposed = kernels.agent_exposures(self.indptr, self.indices, store.starting_states, order, exposure_lottery, table)
+        store.expose(newly_exposed)
+        store.record_period()
+        self.log_period_data()
+
+        #nobody's state has changed yet, so the infectious and exposed agents draw in the order they come in self.agents
+        starting_states = store.starting_states[order]
+        changing = order[(starting_states == seir_engine.INFECTIOUS) | (starting_states == seir_engine.EXPOSED)]
+        changing_states = store.starting_states[changing]
+        transition_lottery = np.array([random.random() for _ in range(len(changing))])
+        infectious = changing[changing_states == seir_engine.INFECTIOUS]
+        exposed = changing[changing_states == seir_engine.EXPOSED]
+        recovering = infectious[transition_lottery[changing_states == seir_engine.INFECTIOUS] <= self.recovery_rate]
+        incubated = exposed[transition_lottery[changing_states == seir_engine.EXPOSED] <= (1 / self.incubation_period)]
+
+        for unique_id in infectious:
+            self.agents_by_id[unique_id].time_infected += 1
+        for unique_id in exposed:
+            self.agents_by_id[unique_id].time_exposed += 1
+
+        store.move(recovering, seir_engine.INFECTIOUS, seir_engine.RECOVERED)
+        store.move(incubated, seir_engine.EXPOSED, seir_engine.INFECTIOUS)
+        store.move(newly_exposed, seir_engine.SUSCEPTIBLE, seir_engine.EXPOSED)
+
+    def log_period_data(self, starting_counts=None, exposed=None, hub_exposures=None):
+        """
+        Logs how many agents entered this time period in each state, overall if 'log_time_period_data' is set and for 
+        each hub if 'log_hub_time_period_data' is set. By default the counts come from the StateStore's counters, 
+        so this never loops over the agents. The batched engine passes in its own (hub x state) starting_counts 
+        and exposure mask instead, and the hub engine its starting_counts and the number of exposures in each hub.
+        """
+        if starting_counts is None:
+            starting_counts = self.store.starting_counts
+            exposed = self.store.exposed
+            new_exposures = self.store.new_exposures
+        elif hub_exposures is not None:
+            new_exposures = hub_exposures.sum()
+        else:
+            new_exposures = np.count_nonzero(exposed)
+
+        if self.log_time_period_data:
+            period_data = {"time_period": self.time_period, "season": self.season}
+            period_data.update(seir_engine.period_counts(starting_counts.sum(axis=0), new_exposures, self.time_period))
+            period_data["data_flag"] = 'infection'
+            logging.debug(period_data)
+
+        if self.log_hub_time_period_data:
+            if hub_exposures is None:
+                hub_exposures = np.bincount(self.agent_hubs[exposed], minlength=self.number_of_hubs)
+            for i in range(self.number_of_hubs):
+                period_data = {"time_period": self.time_period, "season": self.season, "hub": i}
+                period_data.update(seir_engine.period_counts(starting_counts[i], hub_exposures[i], self.time_period))
+                period_data["data_flag"] = 'hub_infection'
+                logging.debug(period_data)
+
     def end_season(self, season):
         """This helper function starts a new season """
         if self.debug:
@@ -719,20 +1207,20 @@ class VaxModel:
         self.time_period = 0 #reset the time period to 0 for the next season
 
         if self.debug:
-            logging.debug(f"Institution: Time period data at the end of season {self.season}: {self.time_period_data[self.season][-1]}")
+            logging.debug(f"Institution: Starting states of the last time period of season {self.season}: {self.store.starting_states}")
 
         #randomly pick ten agents to seed the infection for the next season
-        seed_list = random.sample(self.agents, 10)    
+        if self.agent_objects:
+            seed_list = random.sample(self.agents, 10)    
+            seeds = np.array([agent.unique_id for agent in seed_list], dtype=np.int64)
+        else:
+            seeds = self.rng.choice(self.number_of_agents, 10, replace=False)
 
         #calculate the number of recovered and the number unvaccinated in each hub
-        number_recovered = [0 for i in range(len(self.hub_densities))]
-        number_unvaccinated = number_recovered.copy()
-
-        for agent in self.agents:
-            if self.time_period_data[self.season][-1][f"{agent}"]['starting_state'] == 'R':
-                number_recovered[agent.hub] += 1
-            if self.time_period_data[self.season][-1][f"{agent}"]['starting_state'] != 'V':
-                number_unvaccinated[agent.hub] += 1
+        self.store.end_season()
+        starting_counts = self.store.starting_counts
+        number_recovered = starting_counts[:, seir_engine.RECOVERED].tolist()
+        number_unvaccinated = (starting_counts.sum(axis=1) - starting_counts[:, seir_engine.VACCINATED]).tolist()
 
         #calculate the probability of infection for each hub. that's the num recovered / num unvaccinated
         probabilities_of_infection = []
@@ -742,6 +1230,24 @@ class VaxModel:
             else: 
                 probabilities_of_infection.append(rec/unvac)
         
+        if self.batch_vax_choice:
+            #as long as there is still one more season left to run, set up the new season for every agent at once
+            if self.season + 1 < self.number_of_seasons:
+                self.batch_new_season(seeds, probabilities_of_infection)
+            self.log_seasonal_data(number_recovered, number_unvaccinated)
+            return
+
+        # if the vax_choice_key is seasonal_learning, the model updates each hub's average once, for all of its agents
+        if self.vax_choice_key == "seasonal_learning" and self.season + 1 < self.number_of_seasons:
+            self.update_seasonal_belief(probabilities_of_infection)
+
+        # if the vax_choice_key is neighbors, the model counts what every agent observed at once
+        if self.vax_choice_key == "neighbors" and self.season + 1 < self.number_of_seasons:
+            if self.indptr is None:
+                logging.debug("ERROR: the neighbors vax_choice_key needs a stored network, so no vax choices can be made")
+            else:
+                self.observe_neighbors()
+
         # if the vax_choice_key is fixed_percent, then the model must make a centralized decision about
         # who can update their vaccination status 
         if self.vax_choice_key == "fixed_percent":
@@ -761,7 +1267,7 @@ class VaxModel:
         for agent in self.agents:
 
             #if the agent finished the last season vaccinated, they start the new one vaccinated by default 
-            if self.time_period_data[self.season][-1][f"{agent}"]['starting_state'] == 'V':
+            if self.store.starting_states[agent.unique_id] == seir_engine.VACCINATED:
                 new_season_state = 'V'
             
             else: #if the agent finished the last season unvaccinated, they will start Susceptible by default
@@ -778,6 +1284,121 @@ class VaxModel:
                 #send a message to the agent notifying them with this information for the new season
                 agent.new_season(seed, new_season_state, probabilities_of_infection)
 
+        self.log_seasonal_data(number_recovered, number_unvaccinated)
+
+    def update_seasonal_belief(self, probabilities_of_infection):
+        """
+        Adds this season's probabilities of infection to each hub's discounted average, for the seasonal_learning 
+        vax_choice_key. The denominator, the sum of discount_factor**i over the seasons so far, is kept between 
+        seasons and grows by one term each season, so the update takes the same time in season 100 as in season 1.
+        The terms are added in the same order as a fresh sum over every season, so the averages are the same to 
+        the last bit.
+        """
+        discount_factor = self.vax_choice_params["discount_factor"]
+        current_probs = np.asarray(probabilities_of_infection, dtype=np.float64)
+        if self.season == 0: # in the first season, simply use the probability from last season as the weighted average
+            self.avg_probs_of_infection = current_probs
+            self.belief_denominator = 0 + discount_factor**0
+        else: # in later seasons, incorporate last season's data into the average weighted by the discount factor
+            old_numerator = self.avg_probs_of_infection * self.belief_denominator
+            numerator = old_numerator * discount_factor + current_probs
+            self.belief_denominator = self.belief_denominator + discount_factor**self.season
+            self.avg_probs_of_infection = numerator / self.belief_denominator
+
+    def observe_neighbors(self):
+        """
+        Counts what every agent sees for the neighbors vax_choice_key: the number of recovered and of unvaccinated 
+        agents among themselves and their neighbors, at the start of the last time period. If an agent finished 
+        recovered, they were infected at some point last season. If they finished vax'ed, they were always vax'ed 
+        that season. Both counts are one sparse product of the adjacency matrix plus the identity, built once per 
+        network, with the two indicator columns. The counts are saved as an (agents x 2) array in neighbor_observations.
+        """
+        if self.observation_matrix is None:
+            adjacency = seir_engine.adjacency_matrix(self.indptr, self.indices)
+            self.observation_matrix = (adjacency + scipy.sparse.identity(self.number_of_agents, dtype=np.int32, format='csr')).tocsr()
+        starting_states = self.store.starting_states
+        indicators = np.column_stack((starting_states == seir_engine.RECOVERED, starting_states != seir_engine.VACCINATED)).astype(np.int32)
+        self.neighbor_observations = self.observation_matrix @ indicators
+
+    def batch_new_season(self, seeds, probabilities_of_infection):
+        """
+        Starts the next season like VaxAgent.new_season, but for every agent at once: agents who ended the season 
+        vaccinated start it vaccinated and everyone else starts it susceptible, then batch_vax_choices decides who 
+        is vaccinated and the unvaccinated seeds (an array of unique_ids) start infectious.
+        """
+        vaccinated = self.store.starting_states == seir_engine.VACCINATED
+        vaccinated = self.batch_vax_choices(probabilities_of_infection, vaccinated)
+        new_states = np.where(vaccinated, seir_engine.VACCINATED, seir_engine.SUSCEPTIBLE).astype(np.int8)
+        new_states[seeds[~vaccinated[seeds]]] = seir_engine.INFECTIOUS
+        self.store.replace(new_states)
+
+    def batch_vax_choices(self, probabilities_of_infection, vaccinated):
+        """
+        Makes every agent's vax choice for the next season at once, used when 'batch_vax_choice' is set in the
+        config file. Every vax_choice_key follows VaxAgent.vax_choice, but with a few array operations over all 
+        agents instead of one call per agent: probabilities_of_infection is spread to the agents through agent_hubs, 
+        and the infection costs, betas and seasonal_learning averages are kept in arrays on the model instead of on 
+        the agents. Takes and returns a boolean array of who is vaccinated, indexed by unique_id.
+
+        The random draws come from the model's numpy generator, so choices match the per-agent ones in 
+        distribution, but not draw for draw.
+        """
+        vax_choice_key = self.vax_choice_key
+        vax_choice_params = self.vax_choice_params
+        if self.rng is None:
+            self.rng = np.random.default_rng(random.getrandbits(64)) #seeding the random module still makes runs repeatable
+        if self.agent_costs is None:
+            self.agent_costs = np.array([agent.infection_cost for agent in self.agents_by_id], dtype=np.float64)
+        agent_probs = np.asarray(probabilities_of_infection, dtype=np.float64)[self.agent_hubs]
+        wants_vaccine = agent_probs >= (1 / self.agent_costs)
+        vaccinated = vaccinated.copy()
+
+        if vax_choice_key == "simple_probability":
+            choosers = self.rng.random(self.number_of_agents) <= vax_choice_params["probability_choice"]
+            vaccinated[choosers] = wants_vaccine[choosers]
+
+        elif vax_choice_key == "fixed_percent":
+            num_choice = int(self.number_of_agents * vax_choice_params["percent_choice"])
+            choosers = self.rng.choice(self.number_of_agents, num_choice, replace=False)
+            vaccinated[choosers] = wants_vaccine[choosers]
+
+        elif vax_choice_key == "neighbors" and self.indptr is None:
+            logging.debug("ERROR: the neighbors vax_choice_key needs a stored network, so every agent keeps their vaccination status")
+
+        elif vax_choice_key == "neighbors":
+            self.observe_neighbors()
+            num_infected = self.neighbor_observations[:, 0]
+            num_unvaccinated = self.neighbor_observations[:, 1]
+            neighbor_probs = np.divide(num_infected, num_unvaccinated, out=np.zeros(self.number_of_agents), where=num_unvaccinated > 0)
+            vaccinated = (num_unvaccinated > 0) & (neighbor_probs >= (1 / self.agent_costs))
+
+        elif vax_choice_key in ("logit_normal", "logit_constant"):
+            if vax_choice_key == "logit_constant":
+                beta = vax_choice_params["beta"]
+            else:
+                if self.betas is None: #draw each agent's beta from a normal dist., bounded below at 0
+                    self.betas = np.maximum(self.rng.normal(vax_choice_params["beta_mean"], vax_choice_params["beta_sigma"],
+                                                            self.number_of_agents), 0)
+                beta = self.betas
+            diff = agent_probs * self.agent_costs - 1 # we normalize the cost of vaccination as 1
+            with np.errstate(over='ignore'):
+                prob_vax_choice = 1 / (1 + np.exp(-1 * beta * diff))
+            vaccinated = self.rng.random(self.number_of_agents) <= prob_vax_choice
+
+        elif vax_choice_key == "seasonal_learning":
+            self.update_seasonal_belief(probabilities_of_infection)
+            vaccinated = self.avg_probs_of_infection[self.agent_hubs] >= (1 / self.agent_costs)
+
+        else:
+            logging.debug(f"ERROR: Unexpected value for vax_choice_key = {vax_choice_key}")
+
+        return vaccinated
+
+    def log_seasonal_data(self, number_recovered, number_unvaccinated):
+        """
+        Writes one record with data_flag = 'seasonal_data' for each hub to the experiment data file, 
+        from the number of recovered and unvaccinated agents in each hub at the end of the season. 
+        """
         timestamp = time.time()
         #log seasonal data for each hub
         for i in range(self.number_of_hubs):
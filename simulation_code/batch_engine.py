@@ -0,0 +1,105 @@
+import logging
+import random
+import numpy as np
+import scipy.sparse
+import seir_engine
+
+
+class BatchedSimulation:
+    """
+    Simulates several replications of the same config at once, in one process. Each replication is a VaxModel that
+    has been initialized and given a network as usual, but instead of stepping each model's seasons separately, the
+    states of every replication are stacked into one (replications x agents) int8 array and stepped together, with
+    the same transitions and probabilities as the numpy engine. A replication whose epidemic has died out is masked
+    off until every replication's season has ended. Then each model gets its final states back and runs its own
+    end_season, so vax choices and the seasonal data log work exactly as in a single run.
+
+    If every model uses the very same network arrays (for example one network from a SharedNetworkPool), infectious
+    neighbors are counted with one sparse matrix times a dense (agents x replications) matrix. Otherwise the networks
+    are stacked into one block-diagonal sparse matrix.
+
+    The batch does not keep a state history or the agents' time_infected/time_exposed debug counters, and always
+    uses per-period lotteries (scheduled_transitions is ignored).
+    """
+    def __init__(self, models):
+        self.models = models
+        self.number_of_agents = models[0].number_of_agents
+        self.shared_network = all(model.indptr is models[0].indptr and model.indices is models[0].indices for model in models)
+        if self.shared_network:
+            self.adjacency = seir_engine.adjacency_matrix(models[0].indptr, models[0].indices)
+        else:
+            self.adjacency = scipy.sparse.block_diag([seir_engine.adjacency_matrix(model.indptr, model.indices) for model in models],
+                                                     format='csr', dtype=np.int32)
+        max_degree = max(int(np.diff(model.indptr).max(initial=0)) for model in models)
+        self.table = seir_engine.exposure_table(models[0].rate_of_infection_per_contact, max_degree)
+        self.recovery_rate = models[0].recovery_rate
+        self.transition_rate = 1 / models[0].incubation_period
+        self.rng = np.random.default_rng(random.getrandbits(64)) #seeding the random module still makes runs repeatable
+
+        if any(model.keep_state_history for model in models):
+            logging.debug("ERROR: keep_state_history is not supported by the batched engine, no history will be kept")
+            for model in models:
+                model.store.keep_history = False
+
+    def infectious_neighbors(self, states, rows):
+        """
+        Counts every agent's infectious neighbors, in the replications listed in rows.
+        """
+        if self.shared_network:
+            infectious = (states[rows] == seir_engine.INFECTIOUS).astype(np.int32)
+            return np.asarray(self.adjacency @ infectious.T).T
+        infectious = (states == seir_engine.INFECTIOUS).astype(np.int32)
+        return (self.adjacency @ infectious.ravel()).reshape(states.shape)[rows]
+
+    def run_full_simulation(self):
+        """
+        Runs every season of every replication, and returns the run numbers of the replications.
+        """
+        for season in range(self.models[0].number_of_seasons):
+            self.run_season(season)
+            for model in self.models:
+                model.end_season(season)
+        return [model.run_number for model in self.models]
+
+    def run_season(self, season):
+        states = np.stack([model.store.states for model in self.models])
+        starting_states = states.copy()
+        time_period = 0
+        for model in self.models:
+            model.season = season
+            model.number_infected = model.store.count(seir_engine.INFECTIOUS)
+            if model.number_infected == 0:
+                logging.debug(f"Institution: All seed agents were vaccinated in season {season} so no epidemic took place.")
+
+        #repeat the simulation until the number of infected equals zero in every replication
+        active = np.count_nonzero(states == seir_engine.INFECTIOUS, axis=1) > 0
+        while active.any():
+            rows = np.flatnonzero(active)
+            starting_states[rows] = states[rows]
+            period_states = states[rows]
+
+            #each agent is in exactly one state, so one uniform draw per agent covers every transition
+            infectious_neighbors = self.infectious_neighbors(states, rows)
+            lottery = self.rng.random(period_states.shape)
+            exposed = (period_states == seir_engine.SUSCEPTIBLE) & (lottery <= self.table[infectious_neighbors])
+            recovering = (period_states == seir_engine.INFECTIOUS) & (lottery <= self.recovery_rate)
+            incubated = (period_states == seir_engine.EXPOSED) & (lottery <= self.transition_rate)
+
+            period_states[recovering] = seir_engine.RECOVERED
+            period_states[incubated] = seir_engine.INFECTIOUS
+            period_states[exposed] = seir_engine.EXPOSED
+            states[rows] = period_states
+
+            for i, row in enumerate(rows):
+                model = self.models[row]
+                if model.log_time_period_data or model.log_hub_time_period_data:
+                    model.time_period = time_period
+                    model.log_period_data(model.store.hub_counts(starting_states[row]), exposed[i])
+
+            time_period += 1 #move to the next time period
+            active[rows] = np.count_nonzero(period_states == seir_engine.INFECTIOUS, axis=1) > 0
+
+        #hand every replication its final states, so end_season sees the last time period's starting states
+        for row, model in enumerate(self.models):
+            model.store.load(states[row], starting_states[row])
+            model.number_infected = 0
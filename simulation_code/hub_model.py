@@ -0,0 +1,145 @@
+import logging
+import random
+import numpy as np
+import network_tools
+import seir_engine
+from VaxModel import VaxModel
+
+
+class HubModel(VaxModel):
+    """
+    An approximate, hub-level VaxModel for fast screening sweeps, used when 'engine' is 'hub' in the config file.
+
+    There is no network and there are no agents in the epidemic. Each hub is only its number of agents in each
+    S/E/I/R/V state, and every time period moves each hub forward with binomial draws (tau-leaping, one time period
+    per step). Instead of a network, network_tools.hub_contact_matrix gives the expected number of neighbors an agent
+    in one hub has in every other hub, from hub_sizes, hub_densities and degree_of_homophily. Each of an agent's
+    hub_density neighbors is taken to be infectious with the probability that a random neighbor of theirs is, so a
+    susceptible agent is exposed with probability 1 - (1 - rate_of_infection_per_contact * that probability)^hub_density.
+
+    Vax choices still depend on each agent's infection cost, so infection costs and vaccination status are kept in
+    one array per agent, and vax_choice is applied to every agent at once. The neighbors key needs a network, so it
+    is not supported. The seasonal_data records (and any time period records) are the same as VaxModel's, so the
+    same analysis works on either. Since mixing inside a hub is random, epidemics are only approximately the same
+    size as on a generated network, so this is for finding the interesting parts of a parameter space, not for
+    final results.
+    """
+    def __init__(self, config, run_number, tmpdirname, replication=None):
+        super().__init__(config, run_number, tmpdirname, replication)
+        self.contacts = None # (number_of_hubs x number_of_hubs) expected neighbors, see network_tools.hub_contact_matrix
+        self.counts = None # the number of agents in each state in each hub
+        self.starting_counts = None # the counts at the start of the latest time period
+        self.vaccinated = None # whether each agent will start the next season vaccinated
+
+    def init_simulation(self):
+        """Gives each agent a hub, an infection cost and a starting state, then counts the states in each hub"""
+        if len(self.hub_sizes) != self.number_of_hubs or sum(self.hub_sizes) != self.number_of_agents:
+            logging.debug("ERROR: there is something wrong with the hub_sizes list or the number of agents")
+
+        self.rng = np.random.default_rng(random.getrandbits(64)) #seeding the random module still makes runs repeatable
+        self.agent_hubs = np.repeat(np.arange(self.number_of_hubs, dtype=np.int32), self.hub_sizes)
+        self.agent_costs = self.assign_infection_costs()
+
+        #seed agents start infected, the others are vaccinated with probability starting_vaccination_rate
+        seeds = self.rng.choice(self.number_of_agents, 10, replace=False)
+        self.vaccinated = self.rng.random(self.number_of_agents) <= self.starting_vaccination_rate
+        self.vaccinated[seeds] = False
+        self.counts = self.season_counts(seeds)
+        self.starting_counts = self.counts.copy()
+
+    def season_counts(self, seeds):
+        """
+        The starting counts of a season: vaccinated agents are V, unvaccinated seeds are In and everyone else is S.
+        """
+        counts = np.zeros((self.number_of_hubs, len(seir_engine.STATES)), dtype=np.int64)
+        counts[:, seir_engine.VACCINATED] = np.bincount(self.agent_hubs[self.vaccinated], minlength=self.number_of_hubs)
+        infected_seeds = seeds[~self.vaccinated[seeds]]
+        counts[:, seir_engine.INFECTIOUS] = np.bincount(self.agent_hubs[infected_seeds], minlength=self.number_of_hubs)
+        counts[:, seir_engine.SUSCEPTIBLE] = np.asarray(self.hub_sizes) - counts.sum(axis=1)
+        return counts
+
+    def generate_network(self):
+        """
+        Nothing is generated, the hub x hub contact matrix stands in for the network.
+        """
+        self.contacts = network_tools.hub_contact_matrix(self.hub_sizes, self.hub_densities, self.degree_of_homophily)
+
+    def run_full_simulation(self):
+        """
+        Runs every season, hub by hub.
+        """
+        for season in range(self.number_of_seasons):
+            self.season = season
+            self.run_hub_season()
+            self.end_season(season)
+
+        return self.run_number
+
+    def run_hub_season(self):
+        """
+        Runs one season with one binomial draw per hub for each transition in each time period.
+        """
+        counts = self.counts
+        hub_sizes = np.maximum(counts.sum(axis=1), 1)
+        hub_densities = np.asarray(self.hub_densities, dtype=np.float64)
+        transition_rate = 1 / self.incubation_period
+
+        self.number_infected = int(counts[:, seir_engine.INFECTIOUS].sum())
+        if self.number_infected == 0:
+            logging.debug(f"Institution: All seed agents were vaccinated in season {self.season} so no epidemic took place.")
+            self.starting_counts = counts.copy()
+
+        #repeat the simulation until the number of infected equals zero
+        while self.number_infected > 0:
+            self.starting_counts = counts.copy()
+
+            exposure_probability = seir_engine.hub_exposure_probability(self.contacts, counts[:, seir_engine.INFECTIOUS] / hub_sizes, 
+                                                            hub_densities, self.rate_of_infection_per_contact)
+            new_exposures = self.rng.binomial(counts[:, seir_engine.SUSCEPTIBLE], exposure_probability)
+            recoveries = self.rng.binomial(counts[:, seir_engine.INFECTIOUS], self.recovery_rate)
+            incubations = self.rng.binomial(counts[:, seir_engine.EXPOSED], transition_rate)
+
+            self.log_period_data(self.starting_counts, hub_exposures=new_exposures)
+
+            counts[:, seir_engine.SUSCEPTIBLE] -= new_exposures
+            counts[:, seir_engine.EXPOSED] += new_exposures - incubations
+            counts[:, seir_engine.INFECTIOUS] += incubations - recoveries
+            counts[:, seir_engine.RECOVERED] += recoveries
+
+            self.time_period += 1 #move to the next time period
+            self.number_infected = int(counts[:, seir_engine.INFECTIOUS].sum())
+
+    def end_season(self, season):
+        """
+        Logs the seasonal data from the starting counts of the last time period, like VaxModel.end_season,
+        then makes every agent's vax choice and seeds the next season.
+        """
+        self.time_period = 0 #reset the time period to 0 for the next season
+
+        number_recovered = self.starting_counts[:, seir_engine.RECOVERED].tolist()
+        number_unvaccinated = (self.starting_counts.sum(axis=1) - self.starting_counts[:, seir_engine.VACCINATED]).tolist()
+
+        #calculate the probability of infection for each hub. that's the num recovered / num unvaccinated
+        probabilities_of_infection = []
+        for rec, unvac in zip(number_recovered, number_unvaccinated):
+            if unvac == 0:
+                probabilities_of_infection.append(0) #if everyone is vaccinated, the prob of infection is 0
+            else:
+                probabilities_of_infection.append(rec/unvac)
+
+        #as long as there is still one more season left to run, set up the new season
+        if self.season + 1 < self.number_of_seasons:
+            self.vax_choices(probabilities_of_infection)
+            seeds = self.rng.choice(self.number_of_agents, 10, replace=False)
+            self.counts = self.season_counts(seeds)
+
+        self.log_seasonal_data(number_recovered, number_unvaccinated)
+
+    def vax_choices(self, probabilities_of_infection):
+        """
+        Updates every agent's vaccination status for the next season at once, see VaxModel.batch_vax_choices.
+        """
+        if self.vax_choice_key == "neighbors":
+            logging.debug("ERROR: the neighbors vax_choice_key needs a network, so the hub engine keeps every agent's vaccination status")
+            return
+        self.vaccinated = self.batch_vax_choices(probabilities_of_infection, self.vaccinated)
@@ -0,0 +1,309 @@
+import numpy as np
+from states import SUSCEPTIBLE, EXPOSED, INFECTIOUS, RECOVERED
+
+try:
+    import numba
+except ImportError: #numba is optional, without it the model keeps its NumPy code paths
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+
+def jit(function):
+    """
+    Compiles a kernel with Numba, if it is installed. Compiled kernels are cached on disk (in __pycache__ next to
+    this file, or in NUMBA_CACHE_DIR if that is set), so each worker process loads them instead of compiling them
+    again. Without Numba the kernel is left as a plain Python function, which still works but is far slower than
+    the NumPy code it replaces, so the model only calls kernels when 'use_kernels' is set and Numba is available.
+    """
+    if numba is None:
+        return function
+    return numba.njit(cache=True, nogil=True)(function)
+
+
+@jit
+def agent_exposures(indptr, indices, starting_states, order, lottery, table):
+    """
+    The exposures of one time period of the agents engine. Agents are visited in order, and the agent at position p
+    uses lottery[p], so with the same draws this exposes the same agents as run_one_time_period.
+    """
+    exposed = np.empty(len(order), dtype=np.int64)
+    number_exposed = 0
+    for p in range(len(order)):
+        agent = order[p]
+        if starting_states[agent] != SUSCEPTIBLE:
+            continue
+        infectious_neighbors = 0
+        for slot in range(indptr[agent], indptr[agent + 1]):
+            if starting_states[indices[slot]] == INFECTIOUS:
+                infectious_neighbors += 1
+        if lottery[p] <= table[infectious_neighbors]:
+            exposed[number_exposed] = agent
+            number_exposed += 1
+    return exposed[:number_exposed].copy()
+
+
+@jit
+def dense_draw(indptr, indices, states, lottery, table, recovery_rate, transition_rate):
+    """
+    DenseEngine.draw as one pass over the agents, with the same per-agent lottery, so it returns the same
+    (newly_exposed, recovering, incubated) ids, in the same order.
+    """
+    number_of_agents = len(states)
+    newly_exposed = np.empty(number_of_agents, dtype=np.int64)
+    recovering = np.empty(number_of_agents, dtype=np.int64)
+    incubated = np.empty(number_of_agents, dtype=np.int64)
+    number_exposed = 0
+    number_recovering = 0
+    number_incubated = 0
+    for agent in range(number_of_agents):
+        state = states[agent]
+        if state == SUSCEPTIBLE:
+            infectious_neighbors = 0
+            for slot in range(indptr[agent], indptr[agent + 1]):
+                if states[indices[slot]] == INFECTIOUS:
+                    infectious_neighbors += 1
+            if lottery[agent] <= table[infectious_neighbors]:
+                newly_exposed[number_exposed] = agent
+                number_exposed += 1
+        elif state == INFECTIOUS:
+            if lottery[agent] <= recovery_rate:
+                recovering[number_recovering] = agent
+                number_recovering += 1
+        elif state == EXPOSED:
+            if lottery[agent] <= transition_rate:
+                incubated[number_incubated] = agent
+                number_incubated += 1
+    return newly_exposed[:number_exposed].copy(), recovering[:number_recovering].copy(), incubated[:number_incubated].copy()
+
+
+@jit
+def exposure_candidates(indptr, indices, states):
+    """
+    The susceptible agents with at least one infectious neighbor, in order of unique_id, and how many infectious
+    neighbors each one has (see DenseEngine.exposures).
+    """
+    number_of_agents = len(states)
+    candidates = np.empty(number_of_agents, dtype=np.int64)
+    counts = np.empty(number_of_agents, dtype=np.int64)
+    number_of_candidates = 0
+    for agent in range(number_of_agents):
+        if states[agent] != SUSCEPTIBLE:
+            continue
+        infectious_neighbors = 0
+        for slot in range(indptr[agent], indptr[agent + 1]):
+            if states[indices[slot]] == INFECTIOUS:
+                infectious_neighbors += 1
+        if infectious_neighbors > 0:
+            candidates[number_of_candidates] = agent
+            counts[number_of_candidates] = infectious_neighbors
+            number_of_candidates += 1
+    return candidates[:number_of_candidates].copy(), counts[:number_of_candidates].copy()
+
+
+@jit
+def frontier_targets(indptr, indices, states, infectious, scratch):
+    """
+    The susceptible neighbors of the infectious agents, sorted by unique_id, and how many infectious neighbors each
+    one has, like the np.unique in FrontierEngine.exposures. scratch is an int64 array of zeros with one entry per
+    agent, which is used for the counts and left zeroed again, so no O(number_of_agents) work is done per call.
+    """
+    number_of_contacts = 0
+    for agent in infectious:
+        number_of_contacts += indptr[agent + 1] - indptr[agent]
+    targets = np.empty(number_of_contacts, dtype=np.int64)
+    number_of_targets = 0
+    for agent in infectious:
+        for slot in range(indptr[agent], indptr[agent + 1]):
+            neighbor = indices[slot]
+            if states[neighbor] == SUSCEPTIBLE:
+                if scratch[neighbor] == 0:
+                    targets[number_of_targets] = neighbor
+                    number_of_targets += 1
+                scratch[neighbor] += 1
+    targets = np.sort(targets[:number_of_targets])
+    counts = np.empty(number_of_targets, dtype=np.int64)
+    for i in range(number_of_targets):
+        counts[i] = scratch[targets[i]]
+        scratch[targets[i]] = 0
+    return targets, counts
+
+
+@jit
+def hub_counts(agent_hubs, states, number_of_hubs, number_of_states):
+    """
+    The number of agents in each state in each hub, like StateStore.hub_counts, without the temporary
+    array of (hub, state) codes.
+    """
+    counts = np.zeros((number_of_hubs, number_of_states), dtype=np.int64)
+    for agent in range(len(states)):
+        counts[agent_hubs[agent], states[agent]] += 1
+    return counts
+
+
+@jit
+def match_network(order, agent_hubs, number_of_connections, number_of_hubs, degree_of_homophily, seed):
+    """
+    The matching algorithm of VaxModel.generate_matched_network on arrays. Agents are visited in order, and each
+    eligible agent is matched one neighbor at a time, inside their hub with probability degree_of_homophily and
+    outside otherwise, drawing uniformly from the eligible agents who are not already their neighbors.
+
+    Instead of copying and filtering the list of eligible agents for every match, the eligible agents are kept
+    grouped by hub in one array (removing an agent swaps the last agent of their hub into their place), and a
+    match is drawn by picking a random eligible agent and redrawing while it is already a neighbor. An agent has
+    at most their hub density of neighbors, so redraws are rare. The draws come from Numba's own random stream,
+    seeded with seed, so the network has the same distribution as the original matching, but is not the same network.
+
+    Returns the CSR arrays (indptr, indices) and the number of matches that could not be made.
+    """
+    np.random.seed(seed)
+    number_of_agents = len(order)
+
+    #each agent gets room for number_of_connections neighbors, which they never exceed
+    slots = np.zeros(number_of_agents + 1, dtype=np.int64)
+    for agent in range(number_of_agents):
+        slots[agent + 1] = slots[agent] + max(number_of_connections[agent], 0)
+    neighbors = np.empty(slots[-1], dtype=np.int32)
+    degrees = np.zeros(number_of_agents, dtype=np.int64)
+
+    #the eligible agents of hub h are eligible[hub_starts[h]:hub_starts[h] + hub_fill[h]]
+    hub_starts = np.zeros(number_of_hubs + 1, dtype=np.int64)
+    for agent in range(number_of_agents):
+        hub_starts[agent_hubs[agent] + 1] += 1
+    for hub in range(number_of_hubs):
+        hub_starts[hub + 1] += hub_starts[hub]
+    hub_fill = np.zeros(number_of_hubs, dtype=np.int64)
+    eligible = np.empty(number_of_agents, dtype=np.int64)
+    position = np.full(number_of_agents, -1, dtype=np.int64) # where each agent is in eligible, or -1 if they are not eligible
+    total_eligible = 0
+    for agent in order:
+        if number_of_connections[agent] <= 0: #agents who need no neighbors are never eligible
+            continue
+        hub = agent_hubs[agent]
+        eligible[hub_starts[hub] + hub_fill[hub]] = agent
+        position[agent] = hub_starts[hub] + hub_fill[hub]
+        hub_fill[hub] += 1
+        total_eligible += 1
+    unmatched = 0
+
+    for agent in order:
+        if position[agent] < 0:
+            continue
+
+        #this agent is no longer eligible!
+        hub = agent_hubs[agent]
+        last = hub_starts[hub] + hub_fill[hub] - 1
+        eligible[position[agent]] = eligible[last]
+        position[eligible[last]] = position[agent]
+        position[agent] = -1
+        hub_fill[hub] -= 1
+        total_eligible -= 1
+
+        for _ in range(number_of_connections[agent] - degrees[agent]):
+            #count the valid matches inside and outside the agent's hub, leaving out their past matches
+            inside_hub = hub_fill[hub]
+            outside_hub = total_eligible - hub_fill[hub]
+            for slot in range(slots[agent], slots[agent] + degrees[agent]):
+                past_match = neighbors[slot]
+                if position[past_match] >= 0:
+                    if agent_hubs[past_match] == hub:
+                        inside_hub -= 1
+                    else:
+                        outside_hub -= 1
+
+            if inside_hub > 0 and outside_hub > 0:
+                match_inside = np.random.random() <= degree_of_homophily
+            elif inside_hub > 0:
+                match_inside = True
+            elif outside_hub > 0:
+                match_inside = False
+            else: #nobody is left to match with, and nothing will change before this agent's next match
+                unmatched += number_of_connections[agent] - degrees[agent]
+                break
+
+            #draw eligible agents until one is not already a neighbor
+            while True:
+                if match_inside:
+                    neighbor = eligible[hub_starts[hub] + np.random.randint(0, hub_fill[hub])]
+                else:
+                    draw = np.random.randint(0, total_eligible - hub_fill[hub])
+                    other_hub = 0
+                    while other_hub == hub or draw >= hub_fill[other_hub]:
+                        if other_hub != hub:
+                            draw -= hub_fill[other_hub]
+                        other_hub += 1
+                    neighbor = eligible[hub_starts[other_hub] + draw]
+                already_matched = False
+                for slot in range(slots[agent], slots[agent] + degrees[agent]):
+                    if neighbors[slot] == neighbor:
+                        already_matched = True
+                        break
+                if not already_matched:
+                    break
+
+            #match the two agents, and drop the neighbor once they have all their connections
+            neighbors[slots[agent] + degrees[agent]] = neighbor
+            degrees[agent] += 1
+            neighbors[slots[neighbor] + degrees[neighbor]] = agent
+            degrees[neighbor] += 1
+            if degrees[neighbor] >= number_of_connections[neighbor]:
+                neighbor_hub = agent_hubs[neighbor]
+                last = hub_starts[neighbor_hub] + hub_fill[neighbor_hub] - 1
+                eligible[position[neighbor]] = eligible[last]
+                position[eligible[last]] = position[neighbor]
+                position[neighbor] = -1
+                hub_fill[neighbor_hub] -= 1
+                total_eligible -= 1
+
+        #if the agent has too few matches, they become eligible again
+        if degrees[agent] < number_of_connections[agent]:
+            eligible[hub_starts[hub] + hub_fill[hub]] = agent
+            position[agent] = hub_starts[hub] + hub_fill[hub]
+            hub_fill[hub] += 1
+            total_eligible += 1
+
+    #pack the neighbor lists into CSR arrays
+    indptr = np.zeros(number_of_agents + 1, dtype=np.int64)
+    for agent in range(number_of_agents):
+        indptr[agent + 1] = indptr[agent] + degrees[agent]
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    for agent in range(number_of_agents):
+        indices[indptr[agent]:indptr[agent + 1]] = neighbors[slots[agent]:slots[agent] + degrees[agent]]
+    return indptr, indices, unmatched
+
+
+@jit
+def mean_field_season(contacts, counts, hub_sizes, hub_densities, rate_of_infection_per_contact, recovery_rate, transition_rate, 
+                      max_time_periods):
+    """
+    MeanFieldModel.run_season as plain loops over the hubs, which is much faster for a handful of hubs than a few
+    NumPy calls per time period. counts is a (number_of_hubs x number of states) float array, and is stepped in place.
+    Returns the counts at the start of the last time period, and the number of time periods run.
+    """
+    number_of_hubs = len(hub_sizes)
+    starting_counts = counts.copy()
+    infectious_share = np.empty(number_of_hubs)
+    exposure_probability = np.empty(number_of_hubs)
+    time_periods = 0
+    while counts[:, INFECTIOUS].sum() >= 0.5 and time_periods < max_time_periods:
+        time_periods += 1
+        starting_counts[:, :] = counts
+        for hub in range(number_of_hubs):
+            infectious_share[hub] = counts[hub, INFECTIOUS] / max(hub_sizes[hub], 1.0)
+        for hub in range(number_of_hubs):
+            exposure_probability[hub] = 0.0
+            if hub_densities[hub] > 0:
+                infectious_neighbors = 0.0
+                for other_hub in range(number_of_hubs):
+                    infectious_neighbors += contacts[hub, other_hub] * infectious_share[other_hub]
+                contact_probability = min(max(infectious_neighbors / hub_densities[hub], 0.0), 1.0)
+                exposure_probability[hub] = 1 - (1 - rate_of_infection_per_contact * contact_probability) ** hub_densities[hub]
+        for hub in range(number_of_hubs):
+            new_exposures = counts[hub, SUSCEPTIBLE] * exposure_probability[hub]
+            recoveries = counts[hub, INFECTIOUS] * recovery_rate
+            incubations = counts[hub, EXPOSED] * transition_rate
+            counts[hub, SUSCEPTIBLE] -= new_exposures
+            counts[hub, EXPOSED] += new_exposures - incubations
+            counts[hub, INFECTIOUS] += incubations - recoveries
+            counts[hub, RECOVERED] += recoveries
+    return starting_counts, time_periods
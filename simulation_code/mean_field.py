@@ -0,0 +1,237 @@
+import logging
+import numpy as np
+import scipy.stats
+import network_tools
+import seir_engine
+import kernels
+
+#a season is cut off after this many time periods, so a config whose infection never dies out cannot hang a sweep
+MAX_TIME_PERIODS = 10000
+
+
+def cost_classes(infection_cost_key, infection_costs, number_of_classes):
+    """
+    Stands in for the distribution of infection costs in each hub with number_of_classes equally likely costs, at the
+    midpoints of its quantiles. See VaxModel.assign_infection_cost for the infection cost keys.
+    Returns a (number_of_hubs x number_of_classes) array.
+    """
+    quantiles = (np.arange(number_of_classes) + 0.5) / number_of_classes
+
+    if infection_cost_key == "constant":
+        return np.repeat(np.asarray(infection_costs, dtype=np.float64)[:, None], number_of_classes, axis=1)
+
+    elif infection_cost_key == "uniform":
+        bounds = np.asarray(infection_costs, dtype=np.float64)
+        return bounds[:, :1] + (bounds[:, 1:] - bounds[:, :1]) * quantiles
+
+    elif infection_cost_key == "normal":
+        means = np.array([costs["mean"] for costs in infection_costs], dtype=np.float64)
+        sds = np.array([costs["sd"] for costs in infection_costs], dtype=np.float64)
+        costs = means[:, None] + sds[:, None] * scipy.stats.norm.ppf(quantiles)
+        costs[costs < 0] = 0.001 # bound the infection_cost below at 0.001
+        return costs
+
+    else:
+        logging.debug(f"ERROR: Unexpected value for infection_cost_key = {infection_cost_key}")
+        return np.ones((len(infection_costs), number_of_classes))
+
+
+class MeanFieldModel:
+    """
+    A deterministic companion to VaxModel, built from the same config dict, for mapping out parameter space in
+    milliseconds per config and sanity-checking agent-based results.
+
+    Every hub is a vector of expected S/E/I/R/V counts. Each time period applies HubModel's transitions with their
+    expected values instead of binomial draws: a fraction seir_engine.hub_exposure_probability of the susceptible agents are
+    exposed, recovery_rate of the infectious agents recover and 1/incubation_period of the exposed agents become
+    infectious, with mixing between hubs from network_tools.hub_contact_matrix. A season starts with the model's
+    10 seeds spread over the hubs by size, and ends once fewer than half an agent is still infectious, or after
+    'max_time_periods' time periods (MAX_TIME_PERIODS by default). Recovered and unvaccinated agents are counted at
+    the start of the last time period, like VaxModel.end_season.
+
+    Vax choices follow VaxAgent.vax_choice in expectation. Each hub's infection costs are split into number_of_classes
+    equally likely classes (see cost_classes), and each class keeps the fraction of its agents who are vaccinated.
+    Every vax_choice_key but neighbors (which needs a network) is supported.
+
+    If 'use_kernels' is set in the config and Numba is installed, each season runs as a compiled kernel 
+    (see kernels.mean_field_season), which is about a hundred times faster.
+    """
+    def __init__(self, config, number_of_classes=100):
+        self.config = config
+        self.hub_sizes = np.asarray(config["hub_sizes"], dtype=np.float64)
+        self.hub_densities = np.asarray(config["hub_densities"], dtype=np.float64)
+        self.number_of_hubs = len(self.hub_sizes)
+        self.rate_of_infection_per_contact = config["rate_of_infection_per_contact"]
+        self.recovery_rate = config["recovery_rate"]
+        self.transition_rate = 1 / config["incubation_period"]
+        self.vax_choice_key = config["vax_choice_key"]
+        self.vax_choice_params = config["vax_choice_params"]
+        self.contacts = network_tools.hub_contact_matrix(config["hub_sizes"], config["hub_densities"], config["degree_of_homophily"])
+        self.costs = cost_classes(config["infection_cost_key"], config["infection_costs"], number_of_classes)
+        self.betas = None # classes of beta, only used if vax_choice_key is logit_normal
+        if self.vax_choice_key == "logit_normal":
+            quantiles = (np.arange(number_of_classes) + 0.5) / number_of_classes
+            betas = self.vax_choice_params["beta_mean"] + self.vax_choice_params["beta_sigma"] * scipy.stats.norm.ppf(quantiles)
+            self.betas = np.maximum(betas, 0) #bound beta below at 0
+        self.seeds = 10 * self.hub_sizes / self.hub_sizes.sum() # the expected number of seeds in each hub
+        self.avg_probs_of_infection = None # only used if vax_choice_key is seasonal_learning
+        self.belief_denominator = None # the sum of the discount weights so far, only used if vax_choice_key is seasonal_learning
+        self.use_kernels = config.get("use_kernels", False) and kernels.NUMBA_AVAILABLE
+        self.max_time_periods = config.get("max_time_periods", MAX_TIME_PERIODS)
+
+    def run(self, number_of_seasons=None, tolerance=1e-6):
+        """
+        Runs up to number_of_seasons seasons (by default, the config's), stopping early once the vaccination and
+        infection rates of every hub change by less than tolerance from one season to the next.
+
+        Returns a dict of (seasons x number_of_hubs) arrays: 'recovered' and 'unvaccinated' (expected numbers of
+        agents), 'vaccination_rate' and 'infection_rate' (recovered / hub_size), plus 'steady_vaccination_rate' and
+        'steady_infection_rate', the rates of the last season, and 'converged', whether the rates settled down.
+        Returns None if recovery_rate is not positive, since the infection would then never die out.
+        """
+        if self.recovery_rate <= 0:
+            logging.debug(f"ERROR: the mean-field model needs a positive recovery_rate, not {self.recovery_rate}")
+            return None
+
+        if number_of_seasons is None:
+            number_of_seasons = self.config["number_of_seasons"]
+
+        #the fraction of each cost class that starts the season vaccinated
+        vaccinated = np.full(self.costs.shape, float(self.config["starting_vaccination_rate"]))
+        recovered = []
+        unvaccinated = []
+        converged = False
+        for season in range(number_of_seasons):
+            vaccination_rate = vaccinated.mean(axis=1)
+            if season == 0: #the first season's seeds are never vaccinated
+                number_vaccinated = (self.hub_sizes - self.seeds) * vaccination_rate
+                seeds = self.seeds
+            else:
+                number_vaccinated = self.hub_sizes * vaccination_rate
+                seeds = self.seeds * (1 - vaccination_rate)
+
+            starting_counts = self.run_season(number_vaccinated, seeds)
+            recovered.append(starting_counts[:, seir_engine.RECOVERED])
+            unvaccinated.append(self.hub_sizes - starting_counts[:, seir_engine.VACCINATED])
+
+            probabilities_of_infection = np.divide(recovered[-1], unvaccinated[-1], out=np.zeros(self.number_of_hubs),
+                                                   where=unvaccinated[-1] > 0)
+            old_vaccinated = vaccinated
+            old_avg = self.avg_probs_of_infection
+            vaccinated = self.vax_choices(vaccinated, probabilities_of_infection, season)
+
+            #the model has settled once a season repeats itself and nothing that decides the next one has moved
+            if season > 0 and np.abs(recovered[-1] - recovered[-2]).max() < tolerance * self.hub_sizes.max() and \
+               np.abs(vaccinated - old_vaccinated).max() < tolerance and \
+               (old_avg is None or np.abs(self.avg_probs_of_infection - old_avg).max() < tolerance):
+                converged = True
+                break
+
+        recovered = np.array(recovered)
+        unvaccinated = np.array(unvaccinated)
+        vaccination_rate = 1 - unvaccinated / self.hub_sizes
+        infection_rate = recovered / self.hub_sizes
+        return {"recovered": recovered,
+                "unvaccinated": unvaccinated,
+                "vaccination_rate": vaccination_rate,
+                "infection_rate": infection_rate,
+                "steady_vaccination_rate": vaccination_rate[-1],
+                "steady_infection_rate": infection_rate[-1],
+                "converged": converged}
+
+    def run_season(self, number_vaccinated, seeds):
+        """
+        Runs one season from the expected number of vaccinated agents and infectious seeds in each hub,
+        and returns the expected counts at the start of its last time period.
+        """
+        counts = np.zeros((self.number_of_hubs, len(seir_engine.STATES)))
+        counts[:, seir_engine.VACCINATED] = number_vaccinated
+        counts[:, seir_engine.INFECTIOUS] = seeds
+        counts[:, seir_engine.SUSCEPTIBLE] = self.hub_sizes - number_vaccinated - seeds
+        if self.use_kernels:
+            starting_counts, time_periods = kernels.mean_field_season(self.contacts, counts, self.hub_sizes, self.hub_densities, 
+                                                                      self.rate_of_infection_per_contact, self.recovery_rate, 
+                                                                      self.transition_rate, self.max_time_periods)
+            self.check_time_periods(time_periods, counts)
+            return starting_counts
+
+        starting_counts = counts.copy()
+        hub_sizes = np.maximum(self.hub_sizes, 1)
+
+        #repeat until less than half an agent is still infectious
+        time_periods = 0
+        while counts[:, seir_engine.INFECTIOUS].sum() >= 0.5 and time_periods < self.max_time_periods:
+            time_periods += 1
+            starting_counts = counts.copy()
+            exposure_probability = seir_engine.hub_exposure_probability(self.contacts, counts[:, seir_engine.INFECTIOUS] / hub_sizes,
+                                                            self.hub_densities, self.rate_of_infection_per_contact)
+            new_exposures = counts[:, seir_engine.SUSCEPTIBLE] * exposure_probability
+            recoveries = counts[:, seir_engine.INFECTIOUS] * self.recovery_rate
+            incubations = counts[:, seir_engine.EXPOSED] * self.transition_rate
+
+            counts[:, seir_engine.SUSCEPTIBLE] -= new_exposures
+            counts[:, seir_engine.EXPOSED] += new_exposures - incubations
+            counts[:, seir_engine.INFECTIOUS] += incubations - recoveries
+            counts[:, seir_engine.RECOVERED] += recoveries
+
+        self.check_time_periods(time_periods, counts)
+        return starting_counts
+
+    def check_time_periods(self, time_periods, counts):
+        if time_periods >= self.max_time_periods and counts[:, seir_engine.INFECTIOUS].sum() >= 0.5:
+            logging.debug(f"ERROR: a mean-field season was cut off after {time_periods} time periods, with "
+                          f"{counts[:, seir_engine.INFECTIOUS].sum()} agents still infectious")
+
+    def vax_choices(self, vaccinated, probabilities_of_infection, season):
+        """
+        The fraction of each cost class that is vaccinated next season, following VaxAgent.vax_choice in expectation.
+        """
+        vax_choice_key = self.vax_choice_key
+        vax_choice_params = self.vax_choice_params
+        class_probs = probabilities_of_infection[:, None]
+        wants_vaccine = (class_probs >= (1 / self.costs)).astype(np.float64)
+
+        if vax_choice_key == "simple_probability":
+            probability_choice = vax_choice_params["probability_choice"]
+            return (1 - probability_choice) * vaccinated + probability_choice * wants_vaccine
+
+        elif vax_choice_key == "fixed_percent":
+            percent_choice = vax_choice_params["percent_choice"]
+            return (1 - percent_choice) * vaccinated + percent_choice * wants_vaccine
+
+        elif vax_choice_key == "logit_constant":
+            diff = class_probs * self.costs - 1 # we normalize the cost of vaccination as 1
+            with np.errstate(over='ignore'):
+                return 1 / (1 + np.exp(-1 * vax_choice_params["beta"] * diff))
+
+        elif vax_choice_key == "logit_normal":
+            diff = class_probs * self.costs - 1
+            with np.errstate(over='ignore'): #average over the classes of beta
+                return (1 / (1 + np.exp(-1 * self.betas[None, None, :] * diff[:, :, None]))).mean(axis=2)
+
+        elif vax_choice_key == "seasonal_learning":
+            discount_factor = vax_choice_params["discount_factor"]
+            if season == 0:
+                self.avg_probs_of_infection = probabilities_of_infection
+                self.belief_denominator = 0 + discount_factor**0
+            else: #the same arithmetic as VaxModel.update_seasonal_belief
+                old_numerator = self.avg_probs_of_infection * self.belief_denominator
+                numerator = old_numerator * discount_factor + probabilities_of_infection
+                self.belief_denominator = self.belief_denominator + discount_factor**season
+                self.avg_probs_of_infection = numerator / self.belief_denominator
+            return (self.avg_probs_of_infection[:, None] >= (1 / self.costs)).astype(np.float64)
+
+        elif vax_choice_key == "neighbors":
+            logging.debug("ERROR: the neighbors vax_choice_key needs a network, so the mean-field model keeps every vaccination rate")
+            return vaccinated
+
+        else:
+            logging.debug(f"ERROR: Unexpected value for vax_choice_key = {vax_choice_key}")
+            return vaccinated
+
+
+def solve(config, number_of_seasons=None, tolerance=1e-6):
+    """
+    Runs the MeanFieldModel of a config, see MeanFieldModel.run. Returns None if the config cannot be run.
+    """
+    return MeanFieldModel(config).run(number_of_seasons, tolerance)
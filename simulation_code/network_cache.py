@@ -0,0 +1,88 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+
+class NetworkCache:
+    """
+    An on-disk cache of generated networks. Each network is stored as an uncompressed .npz file holding its
+    CSR arrays (indptr and indices), named after a hash of the parameters that determine the network:
+    the generator, hub_sizes, hub_densities, degree_of_homophily and the seed.
+
+    If max_megabytes is set, the least recently used networks are deleted whenever the cache directory grows past
+    that size. Several worker processes can share one cache directory, since files are written atomically.
+    """
+    def __init__(self, cache_dir, max_megabytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = None if max_megabytes is None else int(max_megabytes * 1024 * 1024)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, network_generator, hub_sizes, hub_densities, degree_of_homophily, seed):
+        """
+        Builds the cache key for a network from the parameters that determine it.
+        """
+        parameters = {"network_generator": network_generator,
+                      "hub_sizes": [int(size) for size in hub_sizes],
+                      "hub_densities": [int(density) for density in hub_densities],
+                      "degree_of_homophily": float(degree_of_homophily),
+                      "seed": int(seed)}
+        return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"network_{key}.npz")
+
+    def load(self, key):
+        """
+        Returns the cached (indptr, indices) for this key, or None if the network is not in the cache.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as network:
+                indptr = network["indptr"]
+                indices = network["indices"]
+            os.utime(path) #mark this network as recently used
+        except (FileNotFoundError, OSError, KeyError, ValueError): #a missing, evicted or half-written file is just a miss
+            return None
+        return indptr, indices
+
+    def store(self, key, indptr, indices):
+        """
+        Writes a network to the cache, then evicts old networks if the cache has grown too large.
+        """
+        path = self.path(key)
+        tmp_path = path + f".{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, indptr=indptr, indices=indices)
+        os.replace(tmp_path, path) #an atomic rename, so other workers never see a partial file
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used networks until the cache fits inside max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(".npz"):
+                continue
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError: #another worker evicted it first
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            logging.debug(f"Network cache: evicted {path}")
@@ -0,0 +1,343 @@
+import csv
+import itertools
+import logging
+import os
+import xml.etree.ElementTree as ET
+import numpy as np
+from network_tools import build_csr, hub_types
+
+#number of agents written per block, so exports never hold more than one block of edges or text in memory
+EXPORT_BLOCK_SIZE = 100000
+
+
+def edge_blocks(indptr, indices, block_size=EXPORT_BLOCK_SIZE):
+    """
+    Walks the CSR arrays in blocks of agents and yields (sources, targets) arrays holding each undirected edge once
+    (source < target). Only one block of edges exists in memory at a time.
+    """
+    number_of_agents = len(indptr) - 1
+    for start in range(0, number_of_agents, block_size):
+        stop = min(start + block_size, number_of_agents)
+        degrees = np.diff(indptr[start:stop + 1])
+        sources = np.repeat(np.arange(start, stop, dtype=np.int32), degrees)
+        targets = np.asarray(indices[indptr[start]:indptr[stop]])
+        upper = sources < targets
+        yield sources[upper], targets[upper]
+
+
+def export_edge_list_binary(path, indptr, indices):
+    """
+    Writes the edges as an (number_of_edges x 2) int32 .npy file, one row per undirected edge.
+    The file is filled block by block through a memory map, and can be loaded back with np.load(path, mmap_mode='r').
+    """
+    number_of_edges = int(indptr[-1]) // 2
+    edges = np.lib.format.open_memmap(path, mode='w+', dtype=np.int32, shape=(number_of_edges, 2))
+    position = 0
+    for sources, targets in edge_blocks(indptr, indices):
+        edges[position:position + len(sources), 0] = sources
+        edges[position:position + len(sources), 1] = targets
+        position += len(sources)
+    edges.flush()
+    del edges
+
+
+def export_edge_list_csv(edge_path, node_path, indptr, indices, agent_hubs, hub_densities):
+    """
+    Writes the edges to edge_path (columns source,target) and the agents to node_path (columns agent,hub,type),
+    using the same layout as the edgelist.csv and nodelist.csv files we loaded into Gephi.
+    """
+    types = np.array(hub_types(hub_densities))
+    with open(edge_path, 'w') as f:
+        f.write("source,target\n")
+        for sources, targets in edge_blocks(indptr, indices):
+            f.write("".join(f"{source},{target}\n" for source, target in zip(sources.tolist(), targets.tolist())))
+
+    with open(node_path, 'w') as f:
+        f.write("agent,hub,type\n")
+        for start in range(0, len(agent_hubs), EXPORT_BLOCK_SIZE):
+            hubs = agent_hubs[start:start + EXPORT_BLOCK_SIZE]
+            f.write("".join(f"{agent},{hub},{hub_type}\n" for agent, hub, hub_type
+                            in zip(range(start, start + len(hubs)), hubs.tolist(), types[hubs].tolist())))
+
+
+def export_gexf(path, indptr, indices, agent_hubs, hub_densities):
+    """
+    Writes the network as an undirected GEXF 1.2 file for Gephi, with each agent's hub and urban/rural type as node attributes.
+    The XML is written directly, block by block, instead of building a graph object in memory.
+    """
+    types = np.array(hub_types(hub_densities))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("<?xml version='1.0' encoding='utf-8'?>\n"
+                '<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">\n'
+                '  <graph defaultedgetype="undirected" mode="static">\n'
+                '    <attributes mode="static" class="node">\n'
+                '      <attribute id="0" title="hub" type="integer" />\n'
+                '      <attribute id="1" title="type" type="string" />\n'
+                '    </attributes>\n'
+                '    <nodes>\n')
+        for start in range(0, len(agent_hubs), EXPORT_BLOCK_SIZE):
+            hubs = agent_hubs[start:start + EXPORT_BLOCK_SIZE]
+            f.write("".join(f'      <node id="{agent}" label="{agent}"><attvalues><attvalue for="0" value="{hub}" />'
+                            f'<attvalue for="1" value="{hub_type}" /></attvalues></node>\n'
+                            for agent, hub, hub_type in zip(range(start, start + len(hubs)), hubs.tolist(), types[hubs].tolist())))
+        f.write('    </nodes>\n'
+                '    <edges>\n')
+        edge_id = 0
+        for sources, targets in edge_blocks(indptr, indices):
+            f.write("".join(f'      <edge id="{edge_id + k}" source="{source}" target="{target}" />\n'
+                            for k, (source, target) in enumerate(zip(sources.tolist(), targets.tolist()))))
+            edge_id += len(sources)
+        f.write('    </edges>\n'
+                '  </graph>\n'
+                '</gexf>\n')
+
+
+def export_network(directory, name, indptr, indices, agent_hubs, hub_densities, formats):
+    """
+    Exports a network in each of the requested formats ('npy', 'csv' and/or 'gexf') to files in directory
+    whose names start with name.
+    """
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, name)
+    for export_format in formats:
+        if export_format == "npy":
+            export_edge_list_binary(base + "_edges.npy", indptr, indices)
+        elif export_format == "csv":
+            export_edge_list_csv(base + "_edgelist.csv", base + "_nodelist.csv", indptr, indices, agent_hubs, hub_densities)
+        elif export_format == "gexf":
+            export_gexf(base + ".gexf", indptr, indices, agent_hubs, hub_densities)
+        else:
+            logging.debug(f"ERROR: Unexpected network export format = {export_format}")
+
+
+class NodeLabels:
+    """
+    Maps the node labels found in a network file to consecutive integer ids, in the order they are first seen.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.hubs = {} # node id -> hub, for nodes whose hub is given in the file
+        self.types = {} # node id -> 'urban' or 'rural', for nodes whose type is given in the file
+
+    def id(self, label):
+        if label not in self.ids:
+            self.ids[label] = len(self.ids)
+        return self.ids[label]
+
+    def node_hubs(self):
+        """
+        Every node's hub as an array in node id order, or None unless the file gave the hub of every node.
+        """
+        if not self.hubs or len(self.hubs) != len(self.ids):
+            return None
+        return np.array([self.hubs[node_id] for node_id in range(len(self.ids))], dtype=np.int32)
+
+    def node_types(self):
+        """
+        Every node's type as a list in node id order, or None unless the file gave the type of every node.
+        """
+        if not self.types or len(self.types) != len(self.ids):
+            return None
+        return [self.types[node_id] for node_id in range(len(self.ids))]
+
+
+def read_edge_list_binary(path):
+    """
+    Reads an (number_of_edges x 2) .npy edge list (see export_edge_list_binary) through a memory map.
+    Returns (sources, targets, node_hubs, node_types), where the last two are None because the file holds no node attributes.
+    """
+    edges = np.load(path, mmap_mode='r')
+    return np.array(edges[:, 0], dtype=np.int32), np.array(edges[:, 1], dtype=np.int32), None, None
+
+
+def read_edge_list_csv(edge_path, node_path=None, block_size=EXPORT_BLOCK_SIZE):
+    """
+    Reads a source,target edge list one block of rows at a time. If node_path is given (columns agent and, optionally,
+    hub and type), nodes are numbered in the order of that file. Otherwise integer labels are used as ids directly, and
+    any other labels are numbered in the order they first appear. Returns (sources, targets, node_hubs, node_types).
+    """
+    labels = NodeLabels()
+    if node_path is not None:
+        with open(node_path, newline='') as f:
+            for row in csv.DictReader(f):
+                node_id = labels.id(row["agent"])
+                if "hub" in row:
+                    labels.hubs[node_id] = int(row["hub"])
+                if "type" in row:
+                    labels.types[node_id] = row["type"]
+
+    sources = []
+    targets = []
+    integer_labels = None
+    with open(edge_path, newline='') as f:
+        reader = csv.reader(f)
+        next(reader) #skip the source,target header
+        while True:
+            block = [row for row in itertools.islice(reader, block_size) if row]
+            if not block:
+                break
+            if integer_labels is None: #decide from the first row whether the labels can be used as ids directly
+                integer_labels = node_path is None and block[0][0].isdigit() and block[0][1].isdigit()
+            if integer_labels:
+                sources.append(np.array([int(row[0]) for row in block], dtype=np.int32))
+                targets.append(np.array([int(row[1]) for row in block], dtype=np.int32))
+            else:
+                sources.append(np.array([labels.id(row[0]) for row in block], dtype=np.int32))
+                targets.append(np.array([labels.id(row[1]) for row in block], dtype=np.int32))
+    sources = np.concatenate(sources) if sources else np.zeros(0, dtype=np.int32)
+    targets = np.concatenate(targets) if targets else np.zeros(0, dtype=np.int32)
+
+    return sources, targets, labels.node_hubs(), labels.node_types()
+
+
+def read_csr(path):
+    """
+    Reads a network stored as CSR arrays in a .npz file (indptr, indices and optionally agent_hubs), such as the files
+    in a NetworkCache. Returns (sources, targets, node_hubs, node_types), where node_types is always None.
+    """
+    with np.load(path) as network:
+        indptr = network["indptr"]
+        indices = network["indices"]
+        node_hubs = network["agent_hubs"] if "agent_hubs" in network else None
+    sources = np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+    upper = sources < indices #each edge appears twice in the CSR arrays, so keep one copy
+    return sources[upper], indices[upper].astype(np.int32), node_hubs, None
+
+
+def read_gexf(path):
+    """
+    Reads a GEXF file with a streaming XML parser, clearing each element once it has been read.
+    Nodes are numbered in the order they appear. Node attributes titled 'hub' and 'type' (if there are any) give each
+    node's hub and urban/rural type. Returns (sources, targets, node_hubs, node_types).
+    """
+    labels = NodeLabels()
+    hub_attribute = None
+    type_attribute = None
+    sources = []
+    targets = []
+    for _, element in ET.iterparse(path, events=('end',)):
+        tag = element.tag.rsplit('}', 1)[-1] #strip the gexf namespace
+        if tag == 'attribute' and element.get('title') == 'hub':
+            hub_attribute = element.get('id')
+        elif tag == 'attribute' and element.get('title') == 'type':
+            type_attribute = element.get('id')
+        elif tag == 'node':
+            node_id = labels.id(element.get('id'))
+            for attvalue in element.iter():
+                if attvalue.tag.rsplit('}', 1)[-1] != 'attvalue':
+                    continue
+                if attvalue.get('for') == hub_attribute:
+                    labels.hubs[node_id] = int(attvalue.get('value'))
+                elif attvalue.get('for') == type_attribute:
+                    labels.types[node_id] = attvalue.get('value')
+            element.clear()
+        elif tag == 'edge':
+            sources.append(labels.id(element.get('source')))
+            targets.append(labels.id(element.get('target')))
+            element.clear()
+
+    return np.array(sources, dtype=np.int32), np.array(targets, dtype=np.int32), labels.node_hubs(), labels.node_types()
+
+
+def hubs_from_types(node_types, hub_sizes, hub_densities):
+    """
+    Assigns each node to a hub from its urban/rural type, for files (like the networks in
+    deprecated/mtree_analysis/network_data) that give each node's type but not its hub. The nodes of each type fill
+    the hubs of that type (see network_tools.hub_types) in file order. The file does not say which hub of its type a
+    node was in, so inside edges may land between hubs of the same type. Returns None if the number of nodes of some
+    type does not match the total size of that type's hubs.
+    """
+    node_types = np.array(node_types)
+    types = np.array(hub_types(hub_densities))
+    node_hubs = np.full(len(node_types), -1, dtype=np.int32)
+    for hub_type in np.union1d(np.unique(node_types), np.unique(types)):
+        hubs = np.flatnonzero(types == hub_type)
+        nodes = np.flatnonzero(node_types == hub_type)
+        if len(nodes) != int(np.sum(np.asarray(hub_sizes)[hubs])):
+            logging.debug(f"ERROR: a network file has {len(nodes)} {hub_type} nodes, but the config has "
+                          f"{int(np.sum(np.asarray(hub_sizes)[hubs]))} {hub_type} agents")
+            return None
+        node_hubs[nodes] = np.repeat(hubs, np.asarray(hub_sizes)[hubs])
+    return node_hubs
+
+
+def load_network(path, hub_sizes, hub_densities, node_path=None, degree_tolerance=0.01):
+    """
+    Loads a network from a .npy edge list, a .csv edge list (with an optional node list), a .npz of CSR arrays
+    or a .gexf file, and returns it as CSR arrays (indptr, indices) laid out for VaxModel.
+
+    If the file gives each node's hub, nodes are renumbered so that each hub's agents are contiguous, in the same
+    order VaxModel assigns agents to hubs. If it only gives each node's urban/rural type, the nodes of each type fill
+    that type's hubs in file order (see hubs_from_types). Otherwise nodes are assigned to hubs in the order they appear
+    in the file. Self-loops and repeated edges are dropped.
+
+    The network is checked against the config, and None is returned (so no seasons are run on it) if the number of
+    nodes or the hub sizes do not match, if any agent has more neighbors than their hub density, or if more than
+    degree_tolerance of the agents have fewer. The matching generator leaves a few agents short, so the networks it
+    made still load.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        sources, targets, node_hubs, node_types = read_edge_list_binary(path)
+    elif extension == ".csv":
+        sources, targets, node_hubs, node_types = read_edge_list_csv(path, node_path)
+    elif extension == ".npz":
+        sources, targets, node_hubs, node_types = read_csr(path)
+    elif extension == ".gexf":
+        sources, targets, node_hubs, node_types = read_gexf(path)
+    else:
+        logging.debug(f"ERROR: Unexpected network file type = {path}")
+        return None
+
+    number_of_agents = int(np.sum(hub_sizes))
+    if node_hubs is not None:
+        number_of_nodes = len(node_hubs)
+    elif node_types is not None:
+        number_of_nodes = len(node_types)
+    else:
+        number_of_nodes = int(max(sources.max(initial=-1), targets.max(initial=-1))) + 1
+    if number_of_nodes != number_of_agents:
+        logging.debug(f"ERROR: network file {path} has {number_of_nodes} nodes, but the config has {number_of_agents} agents")
+        return None
+
+    if node_hubs is None and node_types is not None:
+        node_hubs = hubs_from_types(node_types, hub_sizes, hub_densities)
+        if node_hubs is None:
+            return None
+
+    #renumber the nodes so each hub's agents are contiguous, and check the hub sizes against the config
+    if node_hubs is not None:
+        computed_hub_sizes = np.bincount(node_hubs, minlength=len(hub_sizes))
+        if len(computed_hub_sizes) != len(hub_sizes) or np.any(computed_hub_sizes != np.asarray(hub_sizes)):
+            logging.debug(f"ERROR: network file {path} has hub sizes {computed_hub_sizes.tolist()}, expected {list(hub_sizes)}")
+            return None
+        new_ids = np.empty(number_of_agents, dtype=np.int32)
+        new_ids[np.argsort(node_hubs, kind='stable')] = np.arange(number_of_agents, dtype=np.int32)
+        sources, targets = new_ids[sources], new_ids[targets]
+    else:
+        logging.debug(f"Institution: network file {path} has no hub or type attribute, so agents are assigned to hubs in file order")
+
+    #drop self-loops and repeated edges (including edges listed once in each direction)
+    low = np.minimum(sources, targets).astype(np.int64)
+    high = np.maximum(sources, targets).astype(np.int64)
+    keys = np.unique(low[low != high] * number_of_agents + high[low != high])
+    if len(keys) != len(sources):
+        logging.debug(f"Institution: dropped {len(sources) - len(keys)} self-loops and repeated edges from network file {path}")
+    indptr, indices = build_csr((keys // number_of_agents).astype(np.int32), (keys % number_of_agents).astype(np.int32), number_of_agents)
+
+    #check every agent's degree against its hub density
+    agent_hubs = np.repeat(np.arange(len(hub_sizes)), hub_sizes)
+    missing = np.asarray(hub_densities)[agent_hubs] - np.diff(indptr)
+    if np.any(missing < 0):
+        by_hub = np.bincount(agent_hubs[missing < 0], minlength=len(hub_sizes)).tolist()
+        logging.debug(f"ERROR: {int(np.sum(missing < 0))} agents in network file {path} have more neighbors than their hub density, by hub = {by_hub}")
+        return None
+    if np.any(missing > 0):
+        by_hub = np.bincount(agent_hubs[missing > 0], minlength=len(hub_sizes)).tolist()
+        message = f"{int(np.sum(missing > 0))} agents in network file {path} have fewer neighbors than their hub density, by hub = {by_hub}"
+        if np.sum(missing > 0) > degree_tolerance * number_of_agents:
+            logging.debug(f"ERROR: {message}")
+            return None
+        logging.debug(f"Institution: {message}")
+
+    return indptr, indices
@@ -0,0 +1,225 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+try:
+    import fcntl
+except ImportError: #not available on Windows, where concurrent generators only rely on the atomic rename
+    fcntl = None
+from network_tools import hub_edge_counts, hub_offsets, repair_block
+
+#rough working memory needed per stub while a block of stubs is shuffled, paired, repaired and written out
+BYTES_PER_STUB = 48
+
+
+def scatter_edges(indptr, indices, fill, sources, targets):
+    """
+    Writes each edge (sources[k], targets[k]) into the next free slot of both endpoints' neighbor lists.
+    fill counts the slots already used by each agent. Writes are sorted by agent, so they sweep through the
+    memory-mapped indices file in order.
+    """
+    rows = np.concatenate((sources, targets))
+    columns = np.concatenate((targets, sources))
+    order = np.argsort(rows, kind='stable')
+    rows, columns = rows[order], columns[order]
+
+    #rank each entry within its agent's group, so agents with several new neighbors fill consecutive slots
+    group_starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    group_sizes = np.diff(np.append(group_starts, len(rows)))
+    ranks = np.arange(len(rows)) - np.repeat(group_starts, group_sizes)
+
+    indices[indptr[rows] + fill[rows] + ranks] = columns
+    fill[rows[group_starts]] += group_sizes.astype(fill.dtype)
+
+
+def compact(directory, fill, block_size):
+    """
+    If some edges were dropped during repair, a few agents have unused slots at the end of their neighbor lists.
+    This rewrites indptr and indices without the unused slots, one block of agents at a time.
+    """
+    number_of_agents = len(fill)
+    indptr, indices = load_network_on_disk(directory)
+    new_indptr = np.lib.format.open_memmap(os.path.join(directory, "indptr.tmp.npy"), mode='w+', dtype=np.int64, shape=(number_of_agents + 1,))
+    new_indptr[0] = 0
+    for start in range(0, number_of_agents, block_size):
+        stop = min(start + block_size, number_of_agents)
+        new_indptr[start + 1:stop + 1] = new_indptr[start] + np.cumsum(fill[start:stop])
+
+    new_indices = np.lib.format.open_memmap(os.path.join(directory, "indices.tmp.npy"), mode='w+', dtype=np.int32, shape=(int(new_indptr[-1]),))
+    for start in range(0, number_of_agents, block_size):
+        stop = min(start + block_size, number_of_agents)
+        degrees = np.diff(indptr[start:stop + 1])
+        slots = np.arange(indptr[start], indptr[stop]) - np.repeat(indptr[start:stop], degrees)
+        used = slots < np.repeat(fill[start:stop], degrees)
+        new_indices[new_indptr[start]:new_indptr[stop]] = indices[indptr[start]:indptr[stop]][used]
+
+    new_indptr.flush()
+    new_indices.flush()
+    del new_indptr, new_indices, indptr, indices
+    os.replace(os.path.join(directory, "indptr.tmp.npy"), os.path.join(directory, "indptr.npy"))
+    os.replace(os.path.join(directory, "indices.tmp.npy"), os.path.join(directory, "indices.npy"))
+
+
+def generate_block_network_on_disk(directory, hub_sizes, hub_densities, degree_of_homophily, seed=None, memory_budget_mb=1024):
+    """
+    Generates a stochastic-block network from the same distribution as network_tools.generate_block_network (the 
+    same edge counts between hubs and the same degrees), but streams it into memory-mapped indptr.npy and 
+    indices.npy files in directory instead of building it in memory. The random numbers are drawn in a different 
+    order, so the same seed does not give the same network as generate_block_network.
+
+    Since every agent's degree is known up front, indptr is written first. Then hubs are processed one at a time:
+    each hub's stubs are shuffled, its inside edges are paired, repaired and written straight into indices, and its
+    stubs for every other hub are spilled to a scratch file. A final merge pass pairs the spilled stubs of each pair
+    of hubs and writes the cross-hub edges. Apart from one int32 fill counter per agent, memory use is bounded by the
+    largest single block of stubs, and agent-level passes run in blocks sized by memory_budget_mb. A hub whose stubs
+    alone do not fit inside the budget is still generated in one piece, and logged.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    hub_sizes = np.asarray(hub_sizes, dtype=np.int64)
+    hub_densities = np.asarray(hub_densities, dtype=np.int64)
+    number_of_hubs = len(hub_sizes)
+    number_of_agents = int(hub_sizes.sum())
+    offsets = hub_offsets(hub_sizes)
+    budget_stubs = max(int(memory_budget_mb * 1024 * 1024 / BYTES_PER_STUB), 1)
+    agent_block_size = max(budget_stubs // int(hub_densities.max(initial=1) or 1), 1)
+    edge_counts = hub_edge_counts(hub_sizes, hub_densities, degree_of_homophily, rng)
+
+    #every agent's degree is its hub density, so indptr can be written before any edges exist
+    indptr = np.lib.format.open_memmap(os.path.join(directory, "indptr.npy"), mode='w+', dtype=np.int64, shape=(number_of_agents + 1,))
+    indptr[0] = 0
+    for h in range(number_of_hubs):
+        for start in range(offsets[h], offsets[h + 1], agent_block_size):
+            stop = min(start + agent_block_size, offsets[h + 1])
+            indptr[start + 1:stop + 1] = indptr[start] + hub_densities[h] * np.arange(1, stop - start + 1)
+    indices = np.lib.format.open_memmap(os.path.join(directory, "indices.npy"), mode='w+', dtype=np.int32, shape=(int(indptr[-1]),))
+    fill = np.zeros(number_of_agents, dtype=np.int32)
+
+    #lay out the scratch file: one region for the stubs each hub deals to each other hub
+    spill_offsets = {}
+    position = 0
+    for h in range(number_of_hubs):
+        for g in range(number_of_hubs):
+            if g != h:
+                spill_offsets[(h, g)] = position
+                position += int(edge_counts[h, g])
+    spill_path = os.path.join(directory, "cross_hub_stubs.tmp.npy")
+    spill = np.lib.format.open_memmap(spill_path, mode='w+', dtype=np.int32, shape=(max(position, 1),))
+
+    #first pass: one hub at a time, write the inside edges and spill the stubs meant for other hubs
+    for h in range(number_of_hubs):
+        hub_stubs = int(hub_sizes[h] * hub_densities[h])
+        if hub_stubs > budget_stubs:
+            logging.debug(f"Institution: hub {h} has {hub_stubs} stubs, more than the memory budget of {budget_stubs} stubs allows")
+        stubs = rng.permutation(np.repeat(np.arange(offsets[h], offsets[h + 1], dtype=np.int32), hub_densities[h]))
+
+        inside = stubs[:2 * edge_counts[h, h]]
+        sources, targets = repair_block(inside[0::2].copy(), inside[1::2].copy(), number_of_agents, rng)
+        scatter_edges(indptr, indices, fill, sources, targets)
+
+        position = 2 * int(edge_counts[h, h])
+        for g in range(number_of_hubs):
+            if g != h:
+                block_size = int(edge_counts[h, g])
+                spill[spill_offsets[(h, g)]:spill_offsets[(h, g)] + block_size] = stubs[position:position + block_size]
+                position += block_size
+        del stubs, inside, sources, targets
+
+    #merge pass: pair the spilled stubs of each pair of hubs and write the cross-hub edges
+    for h in range(number_of_hubs):
+        for g in range(h + 1, number_of_hubs):
+            block_size = int(edge_counts[h, g])
+            if block_size == 0:
+                continue
+            sources = np.array(spill[spill_offsets[(h, g)]:spill_offsets[(h, g)] + block_size])
+            targets = np.array(spill[spill_offsets[(g, h)]:spill_offsets[(g, h)] + block_size])
+            sources, targets = repair_block(sources, targets, number_of_agents, rng)
+            scatter_edges(indptr, indices, fill, sources, targets)
+    del spill
+    os.remove(spill_path)
+
+    indptr.flush()
+    indices.flush()
+    short = sum(int(np.count_nonzero(fill[offsets[h]:offsets[h + 1]] != hub_densities[h])) for h in range(number_of_hubs))
+    del indptr, indices
+    if short > 0:
+        logging.debug(f"Institution: {short} agents are short of their hub density, compacting the network files")
+        compact(directory, fill, agent_block_size)
+
+    with open(os.path.join(directory, "network.json"), 'w') as f:
+        json.dump(network_parameters(hub_sizes, hub_densities, degree_of_homophily, seed), f)
+
+    return load_network_on_disk(directory)
+
+
+def network_parameters(hub_sizes, hub_densities, degree_of_homophily, seed):
+    return {"hub_sizes": [int(size) for size in hub_sizes],
+            "hub_densities": [int(density) for density in hub_densities],
+            "degree_of_homophily": float(degree_of_homophily),
+            "seed": None if seed is None else int(seed)}
+
+
+def load_network_on_disk(directory):
+    """
+    Opens a network written by generate_block_network_on_disk as read-only memory-mapped (indptr, indices) arrays.
+    """
+    indptr = np.load(os.path.join(directory, "indptr.npy"), mmap_mode='r')
+    indices = np.load(os.path.join(directory, "indices.npy"), mmap_mode='r')
+    return indptr, indices
+
+
+def network_subdirectory(directory, hub_sizes, hub_densities, degree_of_homophily, seed):
+    """
+    The subdirectory of directory that holds the network with these parameters and seed, named after their hash.
+    """
+    parameters = network_parameters(hub_sizes, hub_densities, degree_of_homophily, seed)
+    key = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+    return os.path.join(directory, f"network_{key}")
+
+
+@contextlib.contextmanager
+def generation_lock(path):
+    """
+    Holds an exclusive lock on the file at path, so only one process generates a given network at a time.
+    The lock is released when the block ends, or when the process dies.
+    """
+    with open(path, 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def generate_or_load_on_disk(directory, hub_sizes, hub_densities, degree_of_homophily, seed=None, memory_budget_mb=1024):
+    """
+    Opens the network with these parameters and seed from its subdirectory of directory (see network_subdirectory),
+    generating it there first if it does not exist yet.
+
+    Other processes may be reading a network through memory maps while it is needed again, so a network's files 
+    are never rewritten. A new network is generated in a temporary subdirectory, which is renamed to its final 
+    name once it is complete, while a lock file keeps other processes from generating the same network at the 
+    same time. 
+
+    A seed is required: an unseeded network could never be reused, and its files could not be deleted while the 
+    model still has them mapped, so every unseeded run would leave a whole network behind. Without one, an ERROR 
+    is logged and None is returned.
+    """
+    if seed is None:
+        logging.debug("ERROR: out_of_core networks need a network_seed or a replication number, so no network was generated")
+        return None
+
+    os.makedirs(directory, exist_ok=True)
+
+    network_directory = network_subdirectory(directory, hub_sizes, hub_densities, degree_of_homophily, seed)
+    with generation_lock(network_directory + ".lock"):
+        if not os.path.exists(os.path.join(network_directory, "network.json")):
+            tmp_directory = tempfile.mkdtemp(prefix=os.path.basename(network_directory) + ".", suffix=".tmp", dir=directory)
+            generate_block_network_on_disk(tmp_directory, hub_sizes, hub_densities, degree_of_homophily, seed, memory_budget_mb)
+            try:
+                os.rename(tmp_directory, network_directory) #an atomic rename, so readers never see a partial network
+            except OSError: #another process finished the same network first
+                shutil.rmtree(tmp_directory, ignore_errors=True)
+    return load_network_on_disk(network_directory)
@@ -0,0 +1,120 @@
+import logging
+from multiprocessing import shared_memory
+import numpy as np
+from VaxModel import VaxModel
+
+#shared memory blocks this worker has already attached to, so each block is only mapped once per process
+_attached_blocks = {}
+
+
+#every config key that changes the CSR arrays VaxModel.generate_network builds, with its default
+NETWORK_PARAMETERS = {"network_generator": "matching",
+                      "hub_sizes": None,
+                      "hub_densities": None,
+                      "degree_of_homophily": None,
+                      "homophily_base": None,
+                      "network_seed": None,
+                      "use_kernels": False, #compiled matching draws different networks
+                      "network_file": None,
+                      "network_node_file": None,
+                      "network_degree_tolerance": 0.01,
+                      "network_dir": None,
+                      "network_memory_budget_mb": 1024,
+                      "agent_order": "shuffled"}
+
+
+def network_key(config):
+    """
+    The config parameters that determine a network. Configs with the same key can share the same pool of networks.
+    """
+    key = []
+    for parameter, default in NETWORK_PARAMETERS.items():
+        value = config.get(parameter, default)
+        key.append(tuple(value) if isinstance(value, list) else value)
+    return tuple(key)
+
+
+class SharedNetworkPool:
+    """
+    A pool of generated networks that lives in shared memory, so worker processes can use them without
+    generating or copying them. The parent process builds pool_size networks for each distinct network config,
+    then hands each replication a small descriptor naming the shared memory blocks of its network. Workers call
+    attach_network on that descriptor to get read-only CSR arrays backed by the shared memory.
+    """
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self.blocks = [] # every SharedMemory block this pool owns, so they can be unlinked on close
+        self.descriptors = {} # network_key -> list of descriptors, one for each network in the pool
+
+    def descriptor(self, config, replication):
+        """
+        Returns the descriptor of the network that a replication of this config should use,
+        building the config's networks first if this is the first time the pool has seen it.
+        Returns None if no network could be built for this config, so its replications build their own.
+        """
+        key = network_key(config)
+        if key not in self.descriptors:
+            descriptors = []
+            for i in range(self.pool_size):
+                descriptor = self.build(config, i)
+                if descriptor is None:
+                    descriptors = None
+                    break
+                descriptors.append(descriptor)
+            self.descriptors[key] = descriptors
+        if self.descriptors[key] is None:
+            return None
+        return self.descriptors[key][replication % self.pool_size]
+
+    def build(self, config, replication):
+        """
+        Generates one network for this config and copies its CSR arrays into shared memory.
+        Returns None if the model could not build a network (for example, a network_file that does not fit the config).
+        """
+        model = VaxModel(config, -1, None, replication)
+        model.init_simulation()
+        model.generate_network()
+        if model.indptr is None:
+            logging.debug("ERROR: no network could be built for the shared pool, so this config's replications build their own")
+            return None
+        return {"indptr": self.share(model.indptr),
+                "indices": self.share(model.indices)}
+
+    def share(self, array):
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared_array[:] = array
+        self.blocks.append(block)
+        return (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        """
+        Releases every shared memory block. Only call this once all the workers are done.
+        """
+        for block in self.blocks:
+            block.close()
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                logging.debug(f"ERROR: shared memory block {block.name} was already unlinked")
+        self.blocks = []
+        self.descriptors = {}
+
+
+def attach_array(name, shape, dtype):
+    if name not in _attached_blocks:
+        try: #Python 3.13+ can skip the resource tracker, which would otherwise unlink the block when a spawned worker exits
+            block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            block = shared_memory.SharedMemory(name=name)
+        _attached_blocks[name] = block
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_attached_blocks[name].buf)
+    array.flags.writeable = False
+    return array
+
+
+def attach_network(descriptor):
+    """
+    Returns read-only (indptr, indices) arrays for a network in a SharedNetworkPool, without copying it.
+    """
+    return attach_array(*descriptor["indptr"]), attach_array(*descriptor["indices"])
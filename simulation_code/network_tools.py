@@ -0,0 +1,540 @@
+import logging
+import random
+import numpy as np
+
+
+def hub_offsets(hub_sizes):
+    """
+    Agents are assigned to hubs in order of unique_id, so the agents of hub h are the ids
+    offsets[h] through offsets[h+1] - 1. This helper returns that offsets array.
+    """
+    offsets = np.zeros(len(hub_sizes) + 1, dtype=np.int64)
+    np.cumsum(hub_sizes, out=offsets[1:])
+    return offsets
+
+
+def hub_types(hub_densities):
+    """
+    Labels each hub 'rural' or 'urban' by its density. Hubs below the midpoint between the lowest and highest
+    densities are rural, the rest are urban (so with a single density, every hub counts as urban).
+    """
+    midpoint = (min(hub_densities) + max(hub_densities)) / 2
+    return ['rural' if density < midpoint else 'urban' for density in hub_densities]
+
+
+def build_csr(sources, targets, number_of_agents):
+    """
+    Builds the symmetric CSR adjacency (indptr, indices) of an undirected edge list.
+    Each edge (sources[k], targets[k]) is entered in the neighbor list of both of its endpoints.
+    """
+    rows = np.concatenate((sources, targets))
+    columns = np.concatenate((targets, sources))
+
+    degrees = np.bincount(rows, minlength=number_of_agents)
+    indptr = np.zeros(number_of_agents + 1, dtype=np.int64)
+    np.cumsum(degrees, out=indptr[1:])
+
+    order = np.argsort(rows, kind='stable') #group each agent's neighbors together, keeping the random edge order
+    indices = columns[order].astype(np.int32)
+    return indptr, indices
+
+
+def csr_edges(indptr, indices):
+    """
+    Returns the edges of a CSR network as (sources, targets) arrays, with each undirected edge listed once (source < target).
+    """
+    sources = np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+    upper = sources < indices
+    return sources[upper], np.array(indices[upper], dtype=np.int32)
+
+
+def hub_inside_edges(hub_sizes, hub_densities, degree_of_homophily):
+    """
+    The number of edges inside each hub: a fraction degree_of_homophily of the hub's stubs, capped at the number of 
+    distinct pairs the hub can hold.
+    """
+    hub_sizes = np.asarray(hub_sizes, dtype=np.int64)
+    stubs = hub_sizes * np.asarray(hub_densities, dtype=np.int64)
+    inside_edges = np.round(degree_of_homophily * stubs / 2).astype(np.int64)
+    return np.minimum(inside_edges, hub_sizes * (hub_sizes - 1) // 2)
+
+
+def hub_contact_matrix(hub_sizes, hub_densities, degree_of_homophily):
+    """
+    The expected number of neighbors an agent in hub h has in hub g, in a network laid out by hub_edge_counts. 
+    Inside edges are fixed, and the outside stubs are paired at random, so a hub's outside stubs land in each other 
+    hub in proportion to its share of the outside stubs of the other hubs. 
+    Returns a (number_of_hubs x number_of_hubs) float array, whose rows sum to about hub_densities.
+    """
+    hub_sizes = np.asarray(hub_sizes, dtype=np.int64)
+    stubs = hub_sizes * np.asarray(hub_densities, dtype=np.int64)
+    inside_edges = hub_inside_edges(hub_sizes, hub_densities, degree_of_homophily)
+    outside_stubs = (stubs - 2 * inside_edges).astype(np.float64)
+
+    contacts = np.zeros((len(hub_sizes), len(hub_sizes)))
+    for h in range(len(hub_sizes)):
+        other_stubs = outside_stubs.copy()
+        other_stubs[h] = 0
+        if other_stubs.sum() > 0:
+            contacts[h] = outside_stubs[h] * other_stubs / other_stubs.sum()
+    contacts[np.diag_indices(len(hub_sizes))] = 2 * inside_edges
+    return contacts / np.maximum(hub_sizes, 1)[:, None]
+
+
+def hub_edge_counts(hub_sizes, hub_densities, degree_of_homophily, rng):
+    """
+    Decides how many edges the network will have inside each hub and between each pair of hubs.
+    Returns a symmetric (number_of_hubs x number_of_hubs) matrix of edge counts. The diagonal holds
+    the number of edges inside each hub, and the row sums of 2 * diagonal + off-diagonal equal
+    hub_size * hub_density, so every agent can reach exactly its target number of connections.
+
+    A fraction degree_of_homophily of each hub's stubs is matched inside the hub. The remaining stubs
+    are labelled by hub and randomly paired with stubs from other hubs.
+    """
+    hub_sizes = np.asarray(hub_sizes, dtype=np.int64)
+    hub_densities = np.asarray(hub_densities, dtype=np.int64)
+    number_of_hubs = len(hub_sizes)
+    stubs = hub_sizes * hub_densities
+
+    if stubs.sum() % 2 != 0:
+        logging.debug("ERROR: the total number of connections is odd, so one agent will be left one neighbor short")
+
+    inside_edges = hub_inside_edges(hub_sizes, hub_densities, degree_of_homophily)
+    outside_stubs = stubs - 2 * inside_edges
+
+    #randomly pair the outside stubs, then repair any pair that landed inside a single hub
+    stub_hubs = rng.permutation(np.repeat(np.arange(number_of_hubs, dtype=np.int32), outside_stubs))
+    if len(stub_hubs) % 2 != 0:
+        stub_hubs = stub_hubs[:-1]
+    pairs = stub_hubs.reshape(-1, 2)
+
+    bad_pairs = np.flatnonzero(pairs[:, 0] == pairs[:, 1])
+    for i in bad_pairs:
+        hub = pairs[i, 0]
+        if pairs[i, 1] != hub: #an earlier swap already fixed this pair
+            continue
+        for _ in range(100):
+            j = rng.integers(len(pairs))
+            if pairs[j, 0] != hub and pairs[j, 1] != hub:
+                pairs[i, 1], pairs[j, 0] = pairs[j, 0], pairs[i, 1] #now (hub, a) and (hub, b)
+                break
+        else:
+            logging.debug(f"ERROR: could not find a hub to pair with an outside stub from hub {hub}")
+
+    edge_counts = np.zeros((number_of_hubs, number_of_hubs), dtype=np.int64)
+    np.add.at(edge_counts, (pairs[:, 0], pairs[:, 1]), 1)
+    edge_counts = edge_counts + edge_counts.T
+    edge_counts[np.diag_indices(number_of_hubs)] = inside_edges
+    #any outside pairs that could not be repaired are dropped, and those agents end up short a neighbor
+    return edge_counts
+
+
+class EdgeKeys:
+    """
+    Keeps count of the undirected edges in a set of edges that is being rewired, so swaps can be checked for
+    self-loops and duplicate edges. Each edge (a, b) is stored as the key min(a,b) * number_of_agents + max(a,b).
+    The original keys are held in one sorted array, and only the changes made since then go in a dict.
+    """
+    def __init__(self, keys, number_of_agents):
+        self.sorted_keys = np.sort(keys)
+        self.number_of_agents = number_of_agents
+        self.changes = {}
+
+    def key(self, a, b):
+        return min(a, b) * self.number_of_agents + max(a, b)
+
+    def count(self, a, b):
+        key = self.key(a, b)
+        original = np.searchsorted(self.sorted_keys, key, side='right') - np.searchsorted(self.sorted_keys, key, side='left')
+        return int(original) + self.changes.get(key, 0)
+
+    def change(self, a, b, change):
+        key = self.key(a, b)
+        self.changes[key] = self.changes.get(key, 0) + change
+
+    def can_swap(self, a, b, c, d):
+        """
+        Whether edges (a, b) and (c, d) can be rewired into (a, d) and (c, b) without creating a self-loop or a duplicate edge.
+        """
+        if a == d or c == b or self.key(a, d) == self.key(c, b):
+            return False
+        return self.count(a, d) == 0 and self.count(c, b) == 0
+
+    def swap(self, a, b, c, d):
+        """
+        Records that edges (a, b) and (c, d) have been rewired into (a, d) and (c, b).
+        """
+        self.change(a, b, -1)
+        self.change(c, d, -1)
+        self.change(a, d, 1)
+        self.change(c, b, 1)
+
+
+def repair_block(sources, targets, number_of_agents, rng, max_attempts=100):
+    """
+    Removes self-loops and duplicate edges from one block of randomly paired edges
+    (all edges inside one hub, or all edges between two hubs). Each bad edge swaps its target
+    with a random edge from the same block, which keeps every agent's degree and the block's
+    edge count unchanged. Edges that cannot be repaired are dropped and logged.
+    Returns the repaired (sources, targets).
+    """
+    number_of_edges = len(sources)
+    if number_of_edges == 0:
+        return sources, targets
+
+    low = np.minimum(sources, targets).astype(np.int64)
+    high = np.maximum(sources, targets).astype(np.int64)
+    keys = low * number_of_agents + high
+
+    #an edge is bad if it is a self-loop or repeats an edge that came before it
+    _, first_positions = np.unique(keys, return_index=True)
+    duplicate = np.ones(number_of_edges, dtype=bool)
+    duplicate[first_positions] = False
+    bad_edges = np.flatnonzero((sources == targets) | duplicate)
+    if len(bad_edges) == 0:
+        return sources, targets
+
+    edge_keys = EdgeKeys(keys, number_of_agents)
+
+    dropped = []
+    for i in bad_edges.tolist():
+        for _ in range(max_attempts):
+            a, b = int(sources[i]), int(targets[i])
+            if a != b and edge_keys.count(a, b) == 1: #an earlier swap already fixed this edge
+                break
+            j = int(rng.integers(number_of_edges))
+            c, d = int(sources[j]), int(targets[j])
+            if j == i or not edge_keys.can_swap(a, b, c, d):
+                continue
+            #swap targets: (a, b), (c, d) becomes (a, d), (c, b)
+            edge_keys.swap(a, b, c, d)
+            targets[i], targets[j] = d, b
+            break
+        else:
+            a, b = int(sources[i]), int(targets[i])
+            logging.debug(f"Institution: agents {a} and {b} could not find a valid match when assigning neighbors")
+            edge_keys.change(a, b, -1)
+            dropped.append(i)
+
+    if dropped:
+        keep = np.ones(number_of_edges, dtype=bool)
+        keep[dropped] = False
+        sources, targets = sources[keep], targets[keep]
+    return sources, targets
+
+
+def generate_block_edges(hub_sizes, hub_densities, degree_of_homophily, rng):
+    """
+    Generates the edge list of a stochastic-block network with the same targets as the matching
+    algorithm in VaxModel.generate_network: every agent in hub h gets exactly hub_densities[h]
+    neighbors, and a fraction degree_of_homophily of them come from inside the agent's own hub.
+    The hub-to-hub edge counts are fixed up front, then each agent's stubs are shuffled and dealt
+    out to the blocks, so the whole thing runs in time linear in the number of edges.
+    Returns (sources, targets) as int32 arrays.
+    """
+    number_of_agents = int(np.sum(hub_sizes))
+    number_of_hubs = len(hub_sizes)
+    offsets = hub_offsets(hub_sizes)
+    edge_counts = hub_edge_counts(hub_sizes, hub_densities, degree_of_homophily, rng)
+
+    #shuffle the stubs of each hub and deal them out: first to the inside edges, then to each other hub in order
+    dealt_stubs = {}
+    for h in range(number_of_hubs):
+        hub_ids = np.arange(offsets[h], offsets[h + 1], dtype=np.int32)
+        hub_stubs = rng.permutation(np.repeat(hub_ids, hub_densities[h]))
+        position = 0
+        for g in range(number_of_hubs):
+            if g == h:
+                block_size = 2 * edge_counts[h, h]
+            else:
+                block_size = edge_counts[h, g]
+            dealt_stubs[(h, g)] = hub_stubs[position:position + block_size]
+            position += block_size
+
+    sources = []
+    targets = []
+    for h in range(number_of_hubs):
+        for g in range(h, number_of_hubs):
+            if g == h: #pair consecutive stubs inside the hub
+                block_sources = dealt_stubs[(h, h)][0::2].copy()
+                block_targets = dealt_stubs[(h, h)][1::2].copy()
+            else: #pair the stubs hub h dealt to hub g with the stubs hub g dealt to hub h
+                block_sources = dealt_stubs[(h, g)].copy()
+                block_targets = dealt_stubs[(g, h)].copy()
+                if len(block_sources) != len(block_targets):
+                    logging.debug(f"ERROR: hubs {h} and {g} disagree on the number of edges between them")
+                    block_size = min(len(block_sources), len(block_targets))
+                    block_sources, block_targets = block_sources[:block_size], block_targets[:block_size]
+            block_sources, block_targets = repair_block(block_sources, block_targets, number_of_agents, rng)
+            sources.append(block_sources)
+            targets.append(block_targets)
+
+    return np.concatenate(sources), np.concatenate(targets)
+
+
+def generate_block_network(hub_sizes, hub_densities, degree_of_homophily, seed=None):
+    """
+    Generates a stochastic-block network (see generate_block_edges) and returns it as CSR arrays (indptr, indices).
+    """
+    rng = np.random.default_rng(seed)
+    sources, targets = generate_block_edges(hub_sizes, hub_densities, degree_of_homophily, rng)
+    return build_csr(sources, targets, int(np.sum(hub_sizes)))
+
+
+def network_diagnostics(indptr, indices, agent_hubs, hub_densities, block_size=1000000):
+    """
+    Computes summary statistics of a network with array operations, and returns them as a dict of plain Python
+    values (ready to be written as JSON):
+
+    - hub_sizes, hub_densities: the realized number of agents and average number of neighbors in each hub
+    - mixing_matrix: entry [g][h] counts the neighbors from hub h of agents in hub g
+    - hub_homophilies, homophily: the proportion of neighbors inside one's own hub, by hub and overall
+    - avg_rural_homophily, avg_urban_homophily: hub homophily averaged over rural and urban hubs (see hub_types)
+    - agents_short, missing_connections: by hub and in total, how many agents have fewer neighbors than their
+        hub density, and how many neighbors they are missing altogether
+    """
+    number_of_hubs = len(hub_densities)
+    number_of_agents = len(indptr) - 1
+    hub_densities = np.asarray(hub_densities)
+    hub_sizes = np.bincount(agent_hubs, minlength=number_of_hubs)
+    total_hub_matches = np.zeros(number_of_hubs)
+    mixing_matrix = np.zeros(number_of_hubs**2, dtype=np.int64)
+    hub_agents_short = np.zeros(number_of_hubs)
+    hub_missing_connections = np.zeros(number_of_hubs)
+
+    #work through the agents in blocks, so memory-mapped networks never have to be loaded all at once
+    for start in range(0, number_of_agents, block_size):
+        stop = min(start + block_size, number_of_agents)
+        degrees = np.diff(indptr[start:stop + 1])
+        hubs = agent_hubs[start:stop]
+        total_hub_matches += np.bincount(hubs, weights=degrees, minlength=number_of_hubs)
+
+        #label every neighbor slot with the hub of the agent and the hub of the neighbor, then count each pair of hubs
+        row_hubs = np.repeat(hubs, degrees).astype(np.int64)
+        column_hubs = agent_hubs[indices[indptr[start]:indptr[stop]]].astype(np.int64)
+        mixing_matrix += np.bincount(row_hubs * number_of_hubs + column_hubs, minlength=number_of_hubs**2)
+
+        deficits = np.maximum(hub_densities[hubs] - degrees, 0)
+        hub_agents_short += np.bincount(hubs, weights=deficits > 0, minlength=number_of_hubs)
+        hub_missing_connections += np.bincount(hubs, weights=deficits, minlength=number_of_hubs)
+
+    mixing_matrix = mixing_matrix.reshape(number_of_hubs, number_of_hubs)
+    inside_hub_matches = np.diag(mixing_matrix)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        computed_hub_densities = total_hub_matches / hub_sizes
+        computed_hub_homophilies = inside_hub_matches / total_hub_matches
+
+    types = np.array(hub_types(hub_densities))
+    def type_average(hub_type):
+        values = computed_hub_homophilies[types == hub_type]
+        return float(np.mean(values)) if len(values) > 0 else None
+
+    def clean(values): #JSON has no NaN, so hubs without any agents or neighbors are reported as None
+        return [None if np.isnan(value) else float(value) for value in values]
+
+    total_neighbors = int(total_hub_matches.sum())
+    return {"hub_sizes": hub_sizes.tolist(),
+            "hub_densities": clean(computed_hub_densities),
+            "hub_homophilies": clean(computed_hub_homophilies),
+            "homophily": float(inside_hub_matches.sum() / total_neighbors) if total_neighbors > 0 else None,
+            "mixing_matrix": mixing_matrix.tolist(),
+            "avg_rural_homophily": type_average('rural'),
+            "avg_urban_homophily": type_average('urban'),
+            "hub_agents_short": hub_agents_short.astype(int).tolist(),
+            "hub_missing_connections": hub_missing_connections.astype(int).tolist(),
+            "agents_short": int(hub_agents_short.sum()),
+            "missing_connections": int(hub_missing_connections.sum())}
+
+
+class HubEdgeSets:
+    """
+    The edges of a network that is being rewired, grouped into a set of inside edges and a set of cross-hub edges 
+    for every hub (a cross-hub edge is in the sets of both of its hubs). The sets are built once and kept up to date 
+    as edges are swapped. Each set is a list of edge ids plus a dict of where each id is in the list, so edges are 
+    added, removed and drawn at random in constant time. sources, targets and agent_hubs are plain lists, which are 
+    much faster than arrays to read one element at a time.
+    """
+    def __init__(self, sources, targets, agent_hubs, number_of_hubs, draws):
+        self.sources = sources
+        self.targets = targets
+        self.agent_hubs = agent_hubs
+        self.draws = draws # a random.Random
+        self.inside = [([], {}) for _ in range(number_of_hubs)]
+        self.cross = [([], {}) for _ in range(number_of_hubs)]
+        for edge in range(len(sources)):
+            self.add(edge)
+
+    def sets_of(self, edge):
+        source_hub = self.agent_hubs[self.sources[edge]]
+        target_hub = self.agent_hubs[self.targets[edge]]
+        if source_hub == target_hub:
+            return [self.inside[source_hub]]
+        return [self.cross[source_hub], self.cross[target_hub]]
+
+    def remove(self, edge):
+        """Takes an edge out of its sets, before its endpoints change."""
+        for members, positions in self.sets_of(edge):
+            position = positions.pop(edge)
+            last = members.pop()
+            if last != edge: #move the last edge into the hole
+                members[position] = last
+                positions[last] = position
+
+    def add(self, edge):
+        """Puts an edge into its sets, after its endpoints have changed."""
+        for members, positions in self.sets_of(edge):
+            positions[edge] = len(members)
+            members.append(edge)
+
+    def draw(self, sets, hub):
+        members = sets[hub][0]
+        if not members:
+            return None
+        return members[self.draws.randrange(len(members))]
+
+
+def homophily_targets(indptr, agent_hubs, degree_of_homophily):
+    """
+    Each hub's target number of inside edges for degree_of_homophily, set the same way generate_block_edges sets it. 
+    Returns the targets, or None if no network with these degrees and hubs can have them: every hub's cross-hub 
+    neighbor slots have to be filled by the other hubs, so no hub can have more of them than all the others together.
+    """
+    number_of_hubs = int(agent_hubs.max()) + 1
+    hub_sizes = np.bincount(agent_hubs, minlength=number_of_hubs)
+    stubs = np.bincount(agent_hubs, weights=np.diff(indptr), minlength=number_of_hubs).astype(np.int64)
+    targets = np.minimum(np.round(degree_of_homophily * stubs / 2), hub_sizes * (hub_sizes - 1) // 2).astype(np.int64)
+    cross_stubs = stubs - 2 * targets
+    if np.any(cross_stubs < 0) or np.any(cross_stubs > cross_stubs.sum() - cross_stubs):
+        logging.debug(f"ERROR: no network with these degrees has homophily {degree_of_homophily}: the hubs would need "
+                      f"{cross_stubs.tolist()} cross-hub neighbors, and no hub can need more than all the others together")
+        return None
+    return targets
+
+
+def rewire_homophily(indptr, indices, agent_hubs, degree_of_homophily, rng, max_failures=10000):
+    """
+    Rewires a network to a new degree_of_homophily with degree-preserving swaps, changing only as many edges as needed.
+    Each hub's target number of inside edges is set by homophily_targets.
+
+    - To lower a hub's homophily, an inside edge (a, b) of the hub swaps endpoints with an edge (c, d) outside the hub
+        (an inside edge of another hub that also needs fewer, if there is one), giving cross-hub edges (a, d) and (c, b).
+    - To raise it, two cross-hub edges (a, c) and (b, d) with a, b in the hub become (a, b) and (c, d).
+
+    Every agent keeps its degree and its hub. Returns the rewired network as CSR arrays (indptr, indices), or None if 
+    the targets cannot be reached: either no network has them (see homophily_targets), or max_failures swaps in a row 
+    were rejected before every hub reached its target.
+    """
+    number_of_agents = len(indptr) - 1
+    number_of_hubs = int(agent_hubs.max()) + 1
+    target_inside_edges = homophily_targets(indptr, agent_hubs, degree_of_homophily)
+    if target_inside_edges is None:
+        return None
+
+    sources, targets = csr_edges(indptr, indices)
+    edge_keys = EdgeKeys(np.minimum(sources, targets).astype(np.int64) * number_of_agents + np.maximum(sources, targets), number_of_agents)
+    #every swap draws a few single random numbers, which are much faster from a random.Random seeded by rng
+    draws = random.Random(int(rng.integers(2**63)))
+    sources, targets, hub_of = sources.tolist(), targets.tolist(), agent_hubs.tolist()
+    edge_sets = HubEdgeSets(sources, targets, hub_of, number_of_hubs, draws)
+
+    #how many more inside edges each hub needs (negative if it needs fewer)
+    need = [int(target) - len(members) for target, (members, _) in zip(target_inside_edges, edge_sets.inside)]
+
+    def oriented(edge, hub): #returns the edge's endpoints with the endpoint in hub first
+        if hub_of[sources[edge]] == hub:
+            return sources[edge], targets[edge]
+        return targets[edge], sources[edge]
+
+    def rewire(first, second, new_first, new_second):
+        edge_sets.remove(first)
+        edge_sets.remove(second)
+        sources[first], targets[first] = new_first
+        sources[second], targets[second] = new_second
+        edge_sets.add(first)
+        edge_sets.add(second)
+
+    failures = 0 #swaps rejected in a row
+    while failures < max_failures:
+        lowering = [hub for hub in range(number_of_hubs) if need[hub] < 0]
+        raising = [hub for hub in range(number_of_hubs) if need[hub] > 0]
+
+        if lowering:
+            hub = draws.choice(lowering)
+            first = edge_sets.draw(edge_sets.inside, hub)
+            partners = [other for other in lowering if other != hub]
+            if partners: #pair with an inside edge of another hub that also needs fewer
+                second = edge_sets.draw(edge_sets.inside, draws.choice(partners))
+            else: #otherwise use any cross-hub edge that does not touch this hub
+                other = draws.choice([other for other in range(number_of_hubs) if other != hub])
+                second = edge_sets.draw(edge_sets.cross, other)
+                if second is not None and hub in (hub_of[sources[second]], hub_of[targets[second]]):
+                    second = None
+            if first is None or second is None:
+                failures += 1
+                continue
+            a, b = sources[first], targets[first]
+            c, d = sources[second], targets[second]
+            if draws.random() < 0.5:
+                c, d = d, c
+            if not edge_keys.can_swap(a, b, c, d):
+                failures += 1
+                continue
+            second_was_inside = hub_of[c] == hub_of[d]
+            edge_keys.swap(a, b, c, d)
+            rewire(first, second, (a, d), (c, b))
+            need[hub] += 1
+            if second_was_inside:
+                need[hub_of[c]] += 1
+
+        elif raising:
+            hub = draws.choice(raising)
+            first = edge_sets.draw(edge_sets.cross, hub)
+            second = edge_sets.draw(edge_sets.cross, hub)
+            if first is None or second is None or first == second:
+                failures += 1
+                continue
+            a, c = oriented(first, hub)
+            b, d = oriented(second, hub)
+            #(c, d) becomes an inside edge if c and d share a hub, so only allow that if their hub needs more too
+            if hub_of[c] == hub_of[d] and need[hub_of[c]] <= 0:
+                failures += 1
+                continue
+            if not edge_keys.can_swap(a, c, d, b):
+                failures += 1
+                continue
+            edge_keys.swap(a, c, d, b)
+            rewire(first, second, (a, b), (d, c))
+            need[hub] -= 1
+            if hub_of[c] == hub_of[d]:
+                need[hub_of[c]] -= 1
+
+        else:
+            break
+
+        failures = 0
+    else:
+        logging.debug(f"ERROR: could not rewire the network to homophily {degree_of_homophily}, remaining need by hub = {need}")
+        return None
+
+    return build_csr(np.array(sources, dtype=np.int32), np.array(targets, dtype=np.int32), number_of_agents)
+
+
+def permute_csr(indptr, indices, order):
+    """
+    Renumbers the agents of a CSR network so that agent order[i] becomes agent i. 
+    Each agent's neighbor list is also sorted, so reading it walks through memory in one direction.
+    """
+    number_of_agents = len(indptr) - 1
+    new_ids = np.empty(number_of_agents, dtype=np.int64)
+    new_ids[order] = np.arange(number_of_agents)
+
+    degrees = np.diff(indptr)[order]
+    new_indptr = np.zeros(number_of_agents + 1, dtype=np.int64)
+    np.cumsum(degrees, out=new_indptr[1:])
+    slots = np.arange(new_indptr[-1]) - np.repeat(new_indptr[:-1], degrees)
+    new_indices = new_ids[np.asarray(indices)[np.repeat(np.asarray(indptr)[order], degrees) + slots]]
+
+    rows = np.repeat(np.arange(number_of_agents), degrees)
+    new_indices = new_indices[np.lexsort((new_indices, rows))].astype(np.int32)
+    return new_indptr, new_indices
@@ -1,9 +1,13 @@
 import concurrent.futures
+import logging
 import time
 import jsonlines
 import os
 import shutil
 from VaxModel import VaxModel
+from hub_model import HubModel
+from batch_engine import BatchedSimulation
+from network_pool import SharedNetworkPool, attach_network
 
 def set_priority(pid=None,priority=1):
     """ Set The Priority of a Windows Process.  Priority is a value between 0-5 where
@@ -26,13 +30,79 @@ def set_priority(pid=None,priority=1):
 
 #define the function for running an entire simulation from start to finish
 def single_run(run_dict):
-    model = VaxModel(run_dict["config"],run_dict["run_number"],run_dict["tmpdirname"])
+    model_class = HubModel if run_dict["config"].get("engine") == "hub" else VaxModel
+    model = model_class(run_dict["config"],run_dict["run_number"],run_dict["tmpdirname"],run_dict["replication"])
     model.init_simulation()
-    model.generate_network()
+    if "shared_network" in run_dict: #use a network from the shared memory pool instead of generating one
+        indptr, indices = attach_network(run_dict["shared_network"])
+        model.set_adjacency(indptr, indices)
+        model.order_agents()
+        model.record_network()
+    else:
+        model.generate_network()
     run_number = model.run_full_simulation()
     return run_number
 
-def run(configs_list,number_of_runs):
+#define the function for running a batch of replications of the same config together
+def batch_unsupported(config):
+    """
+    The options in a config that batch_engine.BatchedSimulation would ignore, so batching would run a different model.
+    """
+    unsupported = []
+    if config.get("engine", "agents") not in ("agents", "numpy"):
+        unsupported.append(f"engine = {config.get('engine')}")
+    for key in ("scheduled_transitions", "keep_state_history", "use_kernels"):
+        if config.get(key, False):
+            unsupported.append(key)
+    return unsupported
+
+def batch_run(run_dicts):
+    config = run_dicts[0]["config"]
+    #hub models are already fast, and annealed networks have no adjacency to batch, so these simply run one after the other
+    if config.get("engine") == "hub" or config.get("network_generator") == "annealed":
+        return [single_run(run_dict) for run_dict in run_dicts]
+
+    unsupported = batch_unsupported(config)
+    if unsupported:
+        logging.debug(f"ERROR: the batched engine does not support {', '.join(unsupported)}, so these replications run one at a time")
+        return [single_run(run_dict) for run_dict in run_dicts]
+
+    models = []
+    shared_networks = {} #attach each shared network once, so replications that share it use the very same arrays
+    for run_dict in run_dicts:
+        model = VaxModel(run_dict["config"],run_dict["run_number"],run_dict["tmpdirname"],run_dict["replication"])
+        model.init_simulation()
+        if "shared_network" in run_dict:
+            network_name = run_dict["shared_network"]["indices"][0]
+            if network_name not in shared_networks:
+                shared_networks[network_name] = attach_network(run_dict["shared_network"])
+            model.set_adjacency(*shared_networks[network_name])
+            model.order_agents()
+            model.record_network()
+        else:
+            model.generate_network()
+        models.append(model)
+    if any(model.indptr is None for model in models): #a network file that could not be used, see VaxModel.generate_network
+        return [model.run_full_simulation() for model in models]
+    run_numbers = BatchedSimulation(models).run_full_simulation()
+    return run_numbers
+
+def run(configs_list,number_of_runs,network_pool_size=None,batch_size=None):
+    """
+    Runs number_of_runs replications of every config in configs_list, in parallel. 
+
+    If network_pool_size is set, the parent process generates that many networks for each distinct network config 
+    (every key that changes the network, see network_pool.NETWORK_PARAMETERS) and places them in shared memory. 
+    Replication r of a config then runs on network r % network_pool_size of its pool, instead of generating its own. 
+    If no network can be built for a config, its replications are left out of the pool and build their own. 
+
+    If batch_size is set, the replications of each config are split into batches of up to batch_size, and each 
+    worker simulates a whole batch at once (see batch_engine.BatchedSimulation). With network_pool_size = 1, every 
+    replication in a batch shares one network, which is the fastest way to run a batch. A batch steps every 
+    replication like the numpy engine, so batching only applies to configs whose engine is agents (the default) or 
+    numpy, without scheduled_transitions, keep_state_history or use_kernels. Any other config is logged as an ERROR 
+    and its replications run one at a time instead, as do configs for the hub engine or the annealed network.
+    """
     
     start_time = time.time()
 
@@ -46,41 +116,87 @@ def run(configs_list,number_of_runs):
     run_dicts = []
     overall_count = 0
     for config in configs_list:
-        for _ in range(number_of_runs):
+        for replication in range(number_of_runs):
             run_dict = {
                 "run_number": overall_count,
+                "replication": replication,
                 "tmpdirname": tmpdirname,
                 "config": config
             }
             run_dicts.append(run_dict)
             overall_count += 1
 
+    #if requested, build the shared pool of networks before any workers start
+    network_pool = None
+    if network_pool_size is not None:
+        network_pool = SharedNetworkPool(network_pool_size)
+        for run_dict in run_dicts:
+            if run_dict["config"].get("engine") == "hub" or run_dict["config"].get("network_generator") == "annealed":
+                continue #these have no network to share
+            descriptor = network_pool.descriptor(run_dict["config"], run_dict["replication"])
+            if descriptor is not None:
+                run_dict["shared_network"] = descriptor
+        print(f"Built a shared pool of {len(network_pool.blocks) // 2} networks.")
+
+    #if requested, group the replications of each config into batches
+    if batch_size is None:
+        tasks = [(single_run, run_dict) for run_dict in run_dicts]
+    else:
+        tasks = []
+        for start in range(0, len(run_dicts), number_of_runs):
+            config_run_dicts = run_dicts[start:start + number_of_runs]
+            for batch_start in range(0, number_of_runs, batch_size):
+                tasks.append((batch_run, config_run_dicts[batch_start:batch_start + batch_size]))
+
+    try:
+        run_replications(tasks, len(run_dicts), tmpdirname, start_time)
+    finally:
+        if network_pool is not None:
+            network_pool.close()
+
+def run_replications(tasks, total_processes, tmpdirname, start_time):
     #this ProcessPoolExecutor manages our multi-processing
     with concurrent.futures.ProcessPoolExecutor() as executor:
     
         num_completed = 0
-        futures = {executor.submit(single_run, run_dict) for run_dict in run_dicts} # save the results of each process
-        total_processes = len(run_dicts)
+        futures = {executor.submit(function, argument) for function, argument in tasks} # save the results of each process
 
         for fut in concurrent.futures.as_completed(futures):
-            
-            #when a replication finishes running, copy data from the temporary data file to the main data file
-            run_number = fut.result()
-            with jsonlines.open(tmpdirname + f'/experiment_data_{run_number}.log') as reader:
-                with jsonlines.open('experiment_data.log', mode='a') as writer:
-                    for obj in reader:
-                        writer.write(obj)
-
-            #keep track of the number of replications completed
-            num_completed += 1
-            print(f"{num_completed} replications completed.")
-
-            if num_completed == total_processes: #once we finish processing all replications, tidy up
-                
-                shutil.rmtree(tmpdirname) #delete the directory of temporary data files
-
-                #print how long it took to run this whole simuatlion
-                duration_seconds = time.time() - start_time 
-                duration_minutes = duration_seconds / 60
-                print(f"Simulation finished running after {duration_minutes} minutes.")
+            #a single run returns its run number, a batch returns a list of them
+            run_numbers = fut.result()
+            if not isinstance(run_numbers, list):
+                run_numbers = [run_numbers]
+            for run_number in run_numbers:
+                num_completed = merge_run_data(run_number, num_completed, total_processes, tmpdirname, start_time)
+
+def merge_run_data(run_number, num_completed, total_processes, tmpdirname, start_time):
+    #when a replication finishes running, copy data from the temporary data file to the main data file
+    data_file = tmpdirname + f'/experiment_data_{run_number}.log'
+    if os.path.exists(data_file): #a replication without a usable network runs no seasons, so it has no data
+        with jsonlines.open(data_file) as reader:
+            with jsonlines.open('experiment_data.log', mode='a') as writer:
+                for obj in reader:
+                    writer.write(obj)
+
+    #the network records go to their own file, so the seasonal data log keeps the same format
+    network_file = tmpdirname + f'/network_data_{run_number}.log'
+    if os.path.exists(network_file):
+        with jsonlines.open(network_file) as reader:
+            with jsonlines.open('network_data.log', mode='a') as writer:
+                for obj in reader:
+                    writer.write(obj)
+
+    #keep track of the number of replications completed
+    num_completed += 1
+    print(f"{num_completed} replications completed.")
+
+    if num_completed == total_processes: #once we finish processing all replications, tidy up
+        
+        shutil.rmtree(tmpdirname) #delete the directory of temporary data files
+
+        #print how long it took to run this whole simuatlion
+        duration_seconds = time.time() - start_time 
+        duration_minutes = duration_seconds / 60
+        print(f"Simulation finished running after {duration_minutes} minutes.")
 
+    return num_completed
@@ -0,0 +1,301 @@
+import numpy as np
+import scipy.sparse
+import kernels
+from states import STATES, STATE_CODES, SUSCEPTIBLE, EXPOSED, INFECTIOUS, RECOVERED, VACCINATED
+
+
+def adjacency_matrix(indptr, indices):
+    """
+    Wraps a CSR network in a scipy sparse matrix, so every agent's number of infectious neighbors is one
+    matrix-vector product. The data is int32 so the product never overflows or needs a converted copy.
+    """
+    number_of_agents = len(indptr) - 1
+    data = np.ones(len(indices), dtype=np.int32)
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=(number_of_agents, number_of_agents))
+
+
+def exposure_table(rate_of_infection_per_contact, max_degree):
+    """
+    The probability that a susceptible agent with k infectious neighbors is exposed, for k = 0 ... max_degree.
+    See Chang and Tassier (2019), A.2.
+    """
+    return 1 - (1 - rate_of_infection_per_contact) ** np.arange(max_degree + 1)
+
+
+def hub_exposure_probability(contacts, infectious_share, hub_densities, rate_of_infection_per_contact):
+    """
+    The probability that a susceptible agent in each hub is exposed in one time period, if the agents of every hub 
+    mix at random along the contact matrix and a fraction infectious_share of each hub is infectious. 
+    Each of the agent's hub_densities neighbors is infectious with the probability that a random neighbor is.
+    """
+    infectious_neighbors = contacts @ infectious_share
+    contact_probability = np.divide(infectious_neighbors, hub_densities, out=np.zeros(len(hub_densities)), where=hub_densities > 0)
+    return 1 - (1 - rate_of_infection_per_contact * np.clip(contact_probability, 0, 1)) ** hub_densities
+
+
+def active_sets(states):
+    """
+    The ids of the infectious and exposed agents.
+    """
+    return np.flatnonzero(states == INFECTIOUS), np.flatnonzero(states == EXPOSED)
+
+
+def neighbors_of(indptr, indices, ids):
+    """
+    The neighbor lists of the agents in ids, concatenated, read straight from the CSR arrays.
+    """
+    starts = np.asarray(indptr[ids], dtype=np.int64)
+    degrees = np.asarray(indptr[ids + 1], dtype=np.int64) - starts
+    slots = np.arange(degrees.sum()) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+    return np.asarray(indices[np.repeat(starts, degrees) + slots], dtype=np.int64)
+
+
+class TransitionCalendar:
+    """
+    Schedules the Ex -> In and In -> R transitions of the array engines. Rather than rolling a lottery every time 
+    period, each agent draws a geometric waiting time once, when they enter Ex or In, and the calendar files the 
+    time period they will leave in. A lottery with success probability p, rolled every period, first succeeds 
+    after a geometric number of periods, so every agent leaves in the same period with the same probability.
+
+    The calendar is one int32 array of due periods indexed by unique_id, so filing a block of agents is a single 
+    vectorized write, and finding who is due is one comparison over the infectious and exposed agents, with no 
+    random numbers drawn. (Buckets of ids per period were tried first, but sorting every block of new entries into 
+    its buckets cost more than the lotteries it saved.)
+    """
+    def __init__(self, number_of_agents, recovery_rate, transition_rate, rng):
+        self.rates = {INFECTIOUS: recovery_rate, EXPOSED: transition_rate}
+        self.rng = rng
+        self.due_periods = np.zeros(number_of_agents, dtype=np.int32)
+
+    def schedule(self, ids, code, first_period):
+        """
+        Files agents who just entered state code. first_period is the first time period they could leave it in.
+        """
+        if len(ids) > 0:
+            self.due_periods[ids] = first_period - 1 + self.rng.geometric(self.rates[code], size=len(ids))
+
+    def due(self, ids, time_period):
+        """
+        The agents among ids who are filed to leave their state in this time period.
+        """
+        return ids[self.due_periods[ids] == time_period]
+
+
+class ArrayEngine:
+    """
+    Runs the seasons of the numpy and frontier engines on the arrays of a StateStore.
+
+    Each time period follows run_one_time_period and VaxAgent.update_state: susceptible agents are exposed with 
+    probability table[number of infectious neighbors], infectious agents recover with probability recovery_rate, 
+    exposed agents become infectious with probability transition_rate, and newly exposed agents only move to Ex at 
+    the end of the period. By default the last two are lotteries rolled every period. If scheduled is set, a 
+    TransitionCalendar decides them up front instead, so random numbers are only drawn when an agent changes state.
+
+    The engine keeps the ids of the infectious and exposed agents up to date. Subclasses decide how exposures 
+    (exposures) and lotteries (draw) are computed. If compiled is set, they use the Numba kernels in kernels.py, 
+    which consume the same random draws and return the same ids, so a season is identical either way.
+    """
+    def __init__(self, indptr, indices, table, recovery_rate, transition_rate, rng, scheduled=False, compiled=False):
+        self.indptr = indptr
+        self.indices = indices
+        self.table = table
+        self.recovery_rate = recovery_rate
+        self.transition_rate = transition_rate
+        self.rng = rng
+        self.scheduled = scheduled
+        self.compiled = compiled
+        self.calendar = None
+        self.infectious = None
+        self.exposed = None
+
+    def start_season(self, store, time_period):
+        self.infectious, self.exposed = active_sets(store.states)
+        if self.scheduled:
+            self.calendar = TransitionCalendar(len(store.states), self.recovery_rate, self.transition_rate, self.rng)
+            self.calendar.schedule(self.infectious, INFECTIOUS, time_period)
+            self.calendar.schedule(self.exposed, EXPOSED, time_period)
+
+    def step(self, store, time_period):
+        """
+        Runs one time period.
+        """
+        states = store.states
+        if self.calendar is None:
+            newly_exposed, recovering, incubated = self.draw(states)
+        else:
+            newly_exposed = self.exposures(states)
+            recovering = self.calendar.due(self.infectious, time_period)
+            incubated = self.calendar.due(self.exposed, time_period)
+
+        store.expose(newly_exposed)
+        store.move(recovering, INFECTIOUS, RECOVERED)
+        store.move(incubated, EXPOSED, INFECTIOUS)
+        store.move(newly_exposed, SUSCEPTIBLE, EXPOSED)
+
+        if self.calendar is not None:
+            self.calendar.schedule(incubated, INFECTIOUS, time_period + 1)
+            self.calendar.schedule(newly_exposed, EXPOSED, time_period + 1)
+
+        self.infectious = np.concatenate((self.infectious[states[self.infectious] == INFECTIOUS], incubated))
+        self.exposed = np.concatenate((self.exposed[states[self.exposed] == EXPOSED], newly_exposed))
+
+
+class DenseEngine(ArrayEngine):
+    """
+    The numpy engine. Every agent's number of infectious neighbors is one sparse matrix-vector product.
+    """
+    def __init__(self, indptr, indices, table, recovery_rate, transition_rate, rng, scheduled=False, compiled=False):
+        super().__init__(indptr, indices, table, recovery_rate, transition_rate, rng, scheduled, compiled)
+        self.adjacency = None if compiled else adjacency_matrix(indptr, indices)
+
+    def exposures(self, states):
+        if self.compiled:
+            candidates, infectious_neighbors = kernels.exposure_candidates(self.indptr, self.indices, states)
+            return candidates[self.rng.random(len(candidates)) <= self.table[infectious_neighbors]]
+
+        #only susceptible agents with an infectious neighbor can be exposed, so only they need a draw
+        infectious_neighbors = self.adjacency @ (states == INFECTIOUS).astype(np.int32)
+        candidates = np.flatnonzero((infectious_neighbors > 0) & (states == SUSCEPTIBLE))
+        return candidates[self.rng.random(len(candidates)) <= self.table[infectious_neighbors[candidates]]]
+
+    def draw(self, states):
+        #each agent is in exactly one state, so one uniform draw per agent covers every transition
+        if self.compiled:
+            lottery = self.rng.random(len(states))
+            return kernels.dense_draw(self.indptr, self.indices, states, lottery, self.table, self.recovery_rate, self.transition_rate)
+
+        infectious_neighbors = self.adjacency @ (states == INFECTIOUS).astype(np.int32)
+        lottery = self.rng.random(len(states))
+        newly_exposed = np.flatnonzero((states == SUSCEPTIBLE) & (lottery <= self.table[infectious_neighbors]))
+        recovering = np.flatnonzero((states == INFECTIOUS) & (lottery <= self.recovery_rate))
+        incubated = np.flatnonzero((states == EXPOSED) & (lottery <= self.transition_rate))
+        return newly_exposed, recovering, incubated
+
+
+class FrontierEngine(ArrayEngine):
+    """
+    The frontier engine. Only the infectious and exposed agents and the susceptible neighbors of the infectious 
+    ones are touched. Every other agent would keep their state anyway, so the cost of a time period is 
+    proportional to the frontier of the epidemic rather than to the number of agents.
+    """
+    def __init__(self, indptr, indices, table, recovery_rate, transition_rate, rng, scheduled=False, compiled=False):
+        super().__init__(indptr, indices, table, recovery_rate, transition_rate, rng, scheduled, compiled)
+        self.scratch = np.zeros(len(indptr) - 1, dtype=np.int64) if compiled else None # see kernels.frontier_targets
+
+    def exposures(self, states):
+        if self.compiled:
+            targets, infectious_neighbors = kernels.frontier_targets(self.indptr, self.indices, states, self.infectious, self.scratch)
+            return targets[self.rng.random(len(targets)) <= self.table[infectious_neighbors]]
+
+        #push exposure from every infectious agent to their susceptible neighbors
+        contacts = neighbors_of(self.indptr, self.indices, self.infectious)
+        contacts = contacts[states[contacts] == SUSCEPTIBLE]
+        targets, infectious_neighbors = np.unique(contacts, return_counts=True)
+        return targets[self.rng.random(len(targets)) <= self.table[infectious_neighbors]]
+
+    def draw(self, states):
+        newly_exposed = self.exposures(states)
+        recovering = self.infectious[self.rng.random(len(self.infectious)) <= self.recovery_rate]
+        incubated = self.exposed[self.rng.random(len(self.exposed)) <= self.transition_rate]
+        return newly_exposed, recovering, incubated
+
+
+class AdaptiveEngine(ArrayEngine):
+    """
+    The adaptive engine. A season starts with a handful of seeds, can grow into an outbreak across most of the 
+    network and ends with a long tail of a few infections, and neither the dense nor the frontier step is the 
+    fastest over all of it. Every time period, this engine estimates the work of a frontier step, the neighbors 
+    of the infectious agents plus the infectious and exposed agents, and runs the frontier step if that is under 
+    crossover times the work of a dense step, the edges plus the agents, and the dense step otherwise.
+
+    The default crossovers were measured with testing_files/adaptive_benchmark, which prints where the two steps 
+    cost the same: numpy's dense step is one fast sparse product, so the frontier only pays off up to about 7% of 
+    its work, and the compiled dense step is faster still compared to the compiled frontier step, at about 3%. path_counts counts the time 
+    periods each step ran. The two steps draw their random numbers differently, so seasons match the numpy and 
+    frontier engines in distribution only.
+    """
+    DEFAULT_CROSSOVERS = {False: 0.07, True: 0.03} # by whether the Numba kernels are used
+
+    def __init__(self, indptr, indices, table, recovery_rate, transition_rate, rng, scheduled=False, compiled=False, 
+                 crossover=None):
+        super().__init__(indptr, indices, table, recovery_rate, transition_rate, rng, scheduled, compiled)
+        self.dense = DenseEngine(indptr, indices, table, recovery_rate, transition_rate, rng, scheduled, compiled)
+        self.frontier = FrontierEngine(indptr, indices, table, recovery_rate, transition_rate, rng, scheduled, compiled)
+        self.degrees = np.diff(indptr)
+        self.crossover = self.DEFAULT_CROSSOVERS[bool(compiled)] if crossover is None else crossover
+        self.dense_work = len(indices) + len(indptr) - 1
+        self.path_counts = {"dense": 0, "frontier": 0}
+
+    def choose(self):
+        """
+        The engine to step this time period with, counted in path_counts.
+        """
+        frontier_work = int(self.degrees[self.infectious].sum()) + len(self.infectious) + len(self.exposed)
+        path = "frontier" if frontier_work < self.crossover * self.dense_work else "dense"
+        self.path_counts[path] += 1
+        engine = self.frontier if path == "frontier" else self.dense
+        engine.infectious = self.infectious
+        engine.exposed = self.exposed
+        return engine
+
+    def exposures(self, states):
+        return self.choose().exposures(states)
+
+    def draw(self, states):
+        return self.choose().draw(states)
+
+
+class AnnealedEngine(ArrayEngine):
+    """
+    The engine of the annealed network (network_generator = 'annealed'), where no edges are stored at all. Every time 
+    period, each agent in hub h meets hub_densities[h] new random agents, drawn from each hub g in proportion to 
+    contacts[h, g] (see network_tools.hub_contact_matrix). Only the number of infectious contacts matters, and with 
+    contacts drawn at random that number is Binomial(hub_density, q), where q is the chance that a random contact of 
+    the hub is infectious. So a susceptible agent is exposed with probability hub_exposure_probability, and one 
+    uniform draw per agent decides it, with no contacts or edges ever materialized. Memory is O(number_of_agents).
+    """
+    def __init__(self, agent_hubs, contacts, hub_densities, rate_of_infection_per_contact, recovery_rate, transition_rate, 
+                 rng, scheduled=False):
+        super().__init__(None, None, None, recovery_rate, transition_rate, rng, scheduled)
+        self.agent_hubs = agent_hubs
+        self.contacts = contacts
+        self.hub_densities = np.asarray(hub_densities, dtype=np.float64)
+        self.hub_sizes = np.maximum(np.bincount(agent_hubs, minlength=len(contacts)), 1)
+        self.rate_of_infection_per_contact = rate_of_infection_per_contact
+
+    def exposure_probabilities(self):
+        """
+        The probability that a susceptible agent is exposed in this time period, for each agent.
+        """
+        infectious_share = np.bincount(self.agent_hubs[self.infectious], minlength=len(self.hub_sizes)) / self.hub_sizes
+        hub_probabilities = hub_exposure_probability(self.contacts, infectious_share, self.hub_densities, self.rate_of_infection_per_contact)
+        return hub_probabilities[self.agent_hubs]
+
+    def exposures(self, states):
+        exposure_probabilities = self.exposure_probabilities()
+        candidates = np.flatnonzero((states == SUSCEPTIBLE) & (exposure_probabilities > 0))
+        return candidates[self.rng.random(len(candidates)) <= exposure_probabilities[candidates]]
+
+    def draw(self, states):
+        #each agent is in exactly one state, so one uniform draw per agent covers every transition
+        lottery = self.rng.random(len(states))
+        newly_exposed = np.flatnonzero((states == SUSCEPTIBLE) & (lottery <= self.exposure_probabilities()))
+        recovering = np.flatnonzero((states == INFECTIOUS) & (lottery <= self.recovery_rate))
+        incubated = np.flatnonzero((states == EXPOSED) & (lottery <= self.transition_rate))
+        return newly_exposed, recovering, incubated
+
+
+def period_counts(starting_counts, new_exposures, time_period):
+    """
+    The counts run_one_time_period logs for one time period, from the number of agents that started the period
+    in each state and the number of new exposures. Like the original engine, recovered agents are only counted 
+    after time period 0.
+    """
+    current_recovered = int(starting_counts[RECOVERED]) if time_period > 0 else 0
+    current_exposed = int(starting_counts[EXPOSED]) + int(new_exposures)
+    return {"current_recovered": current_recovered,
+            "new_exposures": int(new_exposures),
+            "current_infections": int(starting_counts[INFECTIOUS]),
+            "current_exposed": current_exposed,
+            "current_vaccinated": int(starting_counts[VACCINATED]),
+            "current_susceptible": int(starting_counts.sum()) - int(starting_counts[VACCINATED]) - current_recovered - int(starting_counts[INFECTIOUS]) - current_exposed}
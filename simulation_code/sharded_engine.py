@@ -0,0 +1,200 @@
+import logging
+import multiprocessing
+import random
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+import scipy.sparse
+import seir_engine
+
+#commands the parent process sends to the shard workers
+STEP, STOP = range(2)
+
+
+def shard_ranges(agent_hubs, number_of_hubs, number_of_shards):
+    """
+    Splits the hubs into at most number_of_shards groups of consecutive hubs with about the same number of agents.
+    Agents are numbered hub by hub, so each group is one range of unique_ids. Returns a list of (start, stop) ranges.
+    """
+    hub_starts = np.searchsorted(agent_hubs, np.arange(number_of_hubs + 1))
+    number_of_agents = len(agent_hubs)
+    #cut at the hub boundary closest to each multiple of number_of_agents / number_of_shards
+    targets = np.arange(1, number_of_shards) * number_of_agents / number_of_shards
+    cuts = hub_starts[np.abs(hub_starts[None, :] - targets[:, None]).argmin(axis=1)]
+    boundaries = np.unique(np.concatenate(([0], cuts, [number_of_agents])))
+    return [(int(start), int(stop)) for start, stop in zip(boundaries[:-1], boundaries[1:])]
+
+
+def local_network(indptr, indices, start, stop):
+    """
+    The rows of the agents start ... stop-1, with their neighbors renumbered for one shard: the shard's own agents
+    are 0 ... stop-start-1, and its boundary agents (neighbors in other shards) follow, in order of unique_id.
+    Returns (local_indptr, local_indices, boundary_ids).
+    """
+    local_indptr = np.asarray(indptr[start:stop + 1], dtype=np.int64) - indptr[start]
+    columns = np.asarray(indices[indptr[start]:indptr[stop]], dtype=np.int64)
+    outside = (columns < start) | (columns >= stop)
+    boundary_ids = np.unique(columns[outside])
+    local_indices = columns - start
+    local_indices[outside] = (stop - start) + np.searchsorted(boundary_ids, columns[outside])
+    return local_indptr, local_indices.astype(np.int32), boundary_ids
+
+
+def create_shared(shape, dtype, blocks):
+    block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf), (block.name, shape, np.dtype(dtype).str)
+
+
+def attach_shared(name, shape, dtype, blocks):
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def shard_worker(shard, start, stop, local_indptr, local_indices, boundary_ids, local_hubs, shared, parameters, seed, barrier):
+    """
+    The loop of one shard's worker process. Every time period, the parent releases the barrier, the worker steps its
+    own agents from the states in the read buffer into the write buffer, reading only its boundary agents from the
+    other shards, writes its hub counts, and waits on the barrier again.
+    """
+    blocks = [] #the blocks stay attached until the worker exits
+    try:
+        states = attach_shared(*shared["states"], blocks)
+        counts = attach_shared(*shared["counts"], blocks)
+        exposures = attach_shared(*shared["exposures"], blocks)
+        control = attach_shared(*shared["control"], blocks)
+        table, recovery_rate, transition_rate, number_of_hubs = parameters
+        number_of_states = len(seir_engine.STATES)
+        number_own = stop - start
+        adjacency = scipy.sparse.csr_matrix((np.ones(len(local_indices), dtype=np.int32), local_indices, local_indptr),
+                                            shape=(number_own, number_own + len(boundary_ids)))
+        hub_codes = local_hubs.astype(np.int64) * number_of_states
+        rng = np.random.default_rng(seed)
+
+        while True:
+            barrier.wait()
+            command, read = control
+            if command == STOP:
+                break
+
+            own_states = states[read, start:stop]
+            infectious = np.concatenate((own_states == seir_engine.INFECTIOUS, states[read, boundary_ids] == seir_engine.INFECTIOUS))
+            infectious_neighbors = adjacency @ infectious.astype(np.int32)
+
+            #each agent is in exactly one state, so one uniform draw per agent covers every transition
+            lottery = rng.random(number_own)
+            exposed = (own_states == seir_engine.SUSCEPTIBLE) & (lottery <= table[infectious_neighbors])
+            recovering = (own_states == seir_engine.INFECTIOUS) & (lottery <= recovery_rate)
+            incubated = (own_states == seir_engine.EXPOSED) & (lottery <= transition_rate)
+            new_states = own_states.copy()
+            new_states[recovering] = seir_engine.RECOVERED
+            new_states[incubated] = seir_engine.INFECTIOUS
+            new_states[exposed] = seir_engine.EXPOSED
+            states[1 - read, start:stop] = new_states
+
+            counts[shard, 0] = np.bincount(hub_codes + own_states, minlength=number_of_hubs * number_of_states).reshape(number_of_hubs, number_of_states)
+            counts[shard, 1] = np.bincount(hub_codes + new_states, minlength=number_of_hubs * number_of_states).reshape(number_of_hubs, number_of_states)
+            exposures[shard] = np.bincount(local_hubs[exposed], minlength=number_of_hubs)
+            barrier.wait()
+
+    except Exception as error: #break the barrier, so the parent process stops waiting instead of hanging
+        logging.debug(f"ERROR: shard {shard} failed with {error!r}")
+        barrier.abort()
+
+
+class ShardedEngine:
+    """
+    Runs the seasons of one model across several worker processes (engine = 'sharded'), for replications too large
+    for one core. The hubs are split into number_of_shards groups of consecutive hubs (see shard_ranges), and each
+    worker owns one group's agents. Every agent's state lives in shared memory, in two buffers: in each time period,
+    every worker reads the starting states from one buffer and writes its own agents' new states into the other, then
+    all of them meet at a barrier and the buffers swap. A worker only ever reads the states of its own agents and of
+    its boundary agents, the neighbors it has in other hubs, which homophily keeps to a small share of the network.
+
+    The workers also write their (hub x state) counts at the start and end of each time period, which the parent adds
+    up for log_period_data and to decide when the season is over. At the end of a season the parent loads the final
+    states into the model's StateStore, and end_season runs as usual.
+
+    The time periods follow the numpy engine, with per-period lotteries. The workers draw from their own random
+    streams, so seasons match the other engines in distribution only. The agents' time_infected/time_exposed debug
+    counters are not kept. There is no state history and no scheduled_transitions, so VaxModel runs configs that 
+    set either on the numpy engine instead.
+    """
+    def __init__(self, model, number_of_shards):
+        self.blocks = []
+        self.processes = []
+        number_of_agents = model.number_of_agents
+        number_of_hubs = model.number_of_hubs
+        if np.any(np.diff(model.agent_hubs) < 0):
+            logging.debug("ERROR: the sharded engine needs agents numbered hub by hub")
+        self.ranges = shard_ranges(model.agent_hubs, number_of_hubs, number_of_shards)
+
+        self.states, states_descriptor = create_shared((2, number_of_agents), np.int8, self.blocks)
+        self.counts, counts_descriptor = create_shared((len(self.ranges), 2, number_of_hubs, len(seir_engine.STATES)), np.int64, self.blocks)
+        self.exposures, exposures_descriptor = create_shared((len(self.ranges), number_of_hubs), np.int64, self.blocks)
+        self.control, control_descriptor = create_shared((2,), np.int64, self.blocks)
+        shared = {"states": states_descriptor, "counts": counts_descriptor, "exposures": exposures_descriptor, "control": control_descriptor}
+
+        table = seir_engine.exposure_table(model.rate_of_infection_per_contact, int(np.diff(model.indptr).max(initial=0)))
+        parameters = (table, model.recovery_rate, 1 / model.incubation_period, number_of_hubs)
+        seeds = np.random.SeedSequence(random.getrandbits(64)).spawn(len(self.ranges)) #seeding the random module still makes runs repeatable
+
+        self.barrier = multiprocessing.Barrier(len(self.ranges) + 1)
+        for shard, (start, stop) in enumerate(self.ranges):
+            local_indptr, local_indices, boundary_ids = local_network(model.indptr, model.indices, start, stop)
+            process = multiprocessing.Process(target=shard_worker, daemon=True,
+                                              args=(shard, start, stop, local_indptr, local_indices, boundary_ids,
+                                                    model.agent_hubs[start:stop].copy(), shared, parameters, seeds[shard], self.barrier))
+            process.start()
+            self.processes.append(process)
+
+    def run_season(self, model):
+        """
+        Runs one season of the model, then loads its final states into the model's StateStore.
+        """
+        store = model.store
+        self.states[0] = store.states
+        read = 0
+
+        model.number_infected = store.count(seir_engine.INFECTIOUS)
+        if model.number_infected == 0:
+            logging.debug(f"Institution: All seed agents were vaccinated in season {model.season} so no epidemic took place.")
+            store.begin_period()
+            store.record_period()
+            return
+
+        #repeat the simulation until the number of infected equals zero
+        while model.number_infected > 0:
+            self.control[:] = (STEP, read)
+            self.barrier.wait() #start the time period
+            self.barrier.wait() #wait for every shard to finish it
+
+            counts = self.counts.sum(axis=0)
+            model.log_period_data(counts[0], hub_exposures=self.exposures.sum(axis=0))
+
+            read = 1 - read
+            model.time_period += 1 #move to the next time period
+            model.number_infected = int(counts[1][:, seir_engine.INFECTIOUS].sum())
+
+        #the newest states are in the read buffer, and the last time period's starting states are in the other one
+        store.load(self.states[read], self.states[1 - read])
+
+    def close(self):
+        """
+        Stops the workers and releases the shared memory.
+        """
+        if self.processes:
+            self.control[:] = (STOP, 0)
+            try:
+                self.barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+            for process in self.processes:
+                process.join()
+        self.processes = []
+        self.states = self.counts = self.exposures = self.control = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
@@ -0,0 +1,191 @@
+import numpy as np
+import kernels
+from states import STATES, STATE_CODES
+
+
+class StateStore:
+    """
+    Holds every agent's S/E/I/R/V state as int8 codes (see states.STATES), indexed by unique_id.
+
+    - states: each agent's current state. VaxAgent.current_state reads and writes this array.
+    - starting_states: each agent's state at the start of the latest time period.
+    - exposed: which agents were exposed during the latest time period.
+    - counts: the number of agents in each state in each hub, a (number_of_hubs x number of states) array, and 
+      starting_counts, the same counts at the start of the latest time period.
+
+    Every state change goes through set_state or move, which keep counts up to date and remember which agents 
+    changed. begin_period then only refreshes starting_states and exposed for those agents, so the bookkeeping of 
+    a time period costs O(changes) rather than O(number_of_agents).
+
+    Only the latest time period is kept, which is all end_season and vax_choice need. If keep_history is set, every
+    time period's starting states and exposures are also saved, packed two states per byte and eight exposures per
+    byte, and each season's history is stacked into one array when the season ends (see history).
+
+    If compiled is set, hub_counts uses the Numba kernel in kernels.py.
+    """
+    def __init__(self, number_of_agents, agent_hubs, number_of_hubs, keep_history=False, compiled=False):
+        self.number_of_agents = number_of_agents
+        self.agent_hubs = agent_hubs # the model's array of each agent's hub, filled in as agents are initialized
+        self.states = np.zeros(number_of_agents, dtype=np.int8)
+        self.starting_states = np.zeros(number_of_agents, dtype=np.int8)
+        self.exposed = np.zeros(number_of_agents, dtype=bool)
+        self.counts = np.zeros((number_of_hubs, len(STATES)), dtype=np.int64)
+        self.starting_counts = self.counts.copy()
+        self.new_exposures = 0 # the number of agents exposed during the latest time period
+        self.changed_ids = [] # agents whose state changed one at a time since the last begin_period
+        self.changed_blocks = [] # arrays of agents whose state changed in bulk since the last begin_period
+        self.exposed_blocks = []
+        self.keep_history = keep_history
+        self.compiled = compiled
+        self.season_history = [] # packed (starting_states, exposed) of each time period in the current season
+        self.seasons = [] # one (packed_states, packed_exposed) pair of 2D arrays for every finished season
+
+    def recount(self):
+        """
+        Counts every state from scratch. Called once every agent has a state and a hub, and after agents are renumbered.
+        """
+        self.counts[:] = self.hub_counts(self.states)
+        self.starting_counts[:] = self.counts
+        self.starting_states[:] = self.states
+        self.exposed[:] = False
+        self.changed_ids = []
+        self.changed_blocks = []
+        self.exposed_blocks = []
+
+    def hub_counts(self, states):
+        """
+        Counts the agents in each state in each hub, for any array of states indexed by unique_id.
+        """
+        if self.compiled:
+            return kernels.hub_counts(self.agent_hubs, states, len(self.counts), len(STATES))
+        return np.bincount(self.agent_hubs.astype(np.int64) * len(STATES) + states, 
+                           minlength=self.counts.size).reshape(self.counts.shape)
+
+    def load(self, states, starting_states):
+        """
+        Replaces the current and starting states of every agent, for engines that step their own copies of the 
+        state arrays (see batch_engine). The counts are rebuilt and the bookkeeping starts over.
+        """
+        self.states[:] = states
+        self.recount()
+        self.starting_states[:] = starting_states
+        self.starting_counts[:] = self.hub_counts(self.starting_states)
+
+    def replace(self, states):
+        """
+        Replaces the state of every agent at once, like set_state for each of them (see VaxModel.batch_new_season).
+        The counts are rebuilt and the bookkeeping starts over.
+        """
+        self.states[:] = states
+        self.recount()
+
+    def begin_period(self):
+        """
+        Starts a new time period: the current states become its starting states, and nobody has been exposed yet.
+        """
+        changed = np.array(self.changed_ids, dtype=np.int64)
+        if self.changed_blocks:
+            changed = np.concatenate(self.changed_blocks + [changed])
+        self.starting_states[changed] = self.states[changed]
+        if self.exposed_blocks:
+            self.exposed[np.concatenate(self.exposed_blocks)] = False
+        self.starting_counts[:] = self.counts
+        self.new_exposures = 0
+        self.changed_ids = []
+        self.changed_blocks = []
+        self.exposed_blocks = []
+
+    def expose(self, ids):
+        """
+        Marks one agent (or an array of agents) as exposed during this time period.
+        """
+        self.exposed[ids] = True
+        self.exposed_blocks.append(np.atleast_1d(ids))
+        self.new_exposures += np.size(ids)
+
+    def record_period(self):
+        """
+        Saves the latest time period to the history, if the history is kept.
+        """
+        if self.keep_history:
+            self.season_history.append((pack_states(self.starting_states), np.packbits(self.exposed)))
+
+    def end_season(self):
+        """
+        Stacks the history of the season that just ended into one pair of arrays.
+        """
+        if self.keep_history:
+            packed_states = np.array([states for states, _ in self.season_history], dtype=np.uint8).reshape(len(self.season_history), -1)
+            packed_exposed = np.array([exposed for _, exposed in self.season_history], dtype=np.uint8).reshape(len(self.season_history), -1)
+            self.seasons.append((packed_states, packed_exposed))
+            self.season_history = []
+
+    def history(self, season):
+        """
+        Unpacks the history of a finished season into (starting_states, exposed) arrays,
+        each with one row per time period and one column per agent.
+        """
+        packed_states, packed_exposed = self.seasons[season]
+        starting_states = unpack_states(packed_states, self.number_of_agents)
+        exposed = np.unpackbits(packed_exposed, axis=-1, count=self.number_of_agents).astype(bool)
+        return starting_states, exposed
+
+    def state(self, unique_id):
+        return STATES[self.states[unique_id]]
+
+    def set_state(self, unique_id, state):
+        old_code = self.states[unique_id]
+        new_code = STATE_CODES[state]
+        if old_code == new_code:
+            return
+        hub = self.agent_hubs[unique_id]
+        self.counts[hub, old_code] -= 1
+        self.counts[hub, new_code] += 1
+        self.states[unique_id] = new_code
+        self.changed_ids.append(unique_id)
+
+    def move(self, ids, old_code, new_code):
+        """
+        Moves an array of agents, who are all in state old_code, to state new_code.
+        """
+        if len(ids) == 0:
+            return
+        hub_counts = np.bincount(self.agent_hubs[ids], minlength=len(self.counts))
+        self.counts[:, old_code] -= hub_counts
+        self.counts[:, new_code] += hub_counts
+        self.states[ids] = new_code
+        self.changed_blocks.append(ids)
+
+    def count(self, code):
+        """
+        The number of agents currently in a state, over all hubs.
+        """
+        return int(self.counts[:, code].sum())
+
+    def permute(self, order):
+        """
+        Renumbers the agents so that agent order[i] becomes agent i (see VaxModel.order_agents).
+        Agents never change hubs when they are renumbered, so the model's agent_hubs array stays valid.
+        """
+        self.states = self.states[order]
+        self.recount()
+
+
+def pack_states(states):
+    """
+    Packs an array of state codes (which all fit in 4 bits) two to a byte.
+    """
+    if len(states) % 2 == 1:
+        states = np.append(states, 0)
+    states = states.astype(np.uint8)
+    return states[0::2] | (states[1::2] << 4)
+
+
+def unpack_states(packed, number_of_agents):
+    """
+    Reverses pack_states, along the last axis of packed.
+    """
+    states = np.empty(packed.shape[:-1] + (2 * packed.shape[-1],), dtype=np.int8)
+    states[..., 0::2] = packed & 0x0F
+    states[..., 1::2] = packed >> 4
+    return states[..., :number_of_agents]
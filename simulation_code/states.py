@@ -0,0 +1,5 @@
+#agent states are stored as int8 codes, indexed by unique_id. STATES maps each code back to the state string agents use.
+#this module imports nothing, so every engine, kernel and store can share the codes without importing each other
+STATES = ['S', 'Ex', 'In', 'R', 'V']
+SUSCEPTIBLE, EXPOSED, INFECTIOUS, RECOVERED, VACCINATED = range(len(STATES))
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
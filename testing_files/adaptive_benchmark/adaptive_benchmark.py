@@ -0,0 +1,86 @@
+# Calibrates the adaptive engine's crossover (the 'adaptive_crossover' config key): times one dense and one frontier
+# time period at a range of prevalences, next to the frontier's share of the dense step's work, so the crossover is the
+# work share where the two times meet. Then times a whole season with the numpy, frontier and adaptive engines.
+# Like the other testing files, copy this into simulation_code before running it.
+import random
+import tempfile
+import time
+import numpy as np
+import seir_engine
+from VaxModel import VaxModel
+
+number_of_time_periods = 10 #time periods to average over for each measurement
+number_of_agents = 100000
+prevalences = [0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2]
+engines = ["numpy", "frontier", "adaptive"]
+
+def make_config(engine, use_kernels):
+    scale = number_of_agents // 1000
+    return {"number_of_agents" : number_of_agents, 
+            "rate_of_infection_per_contact" : 0.03,
+            "recovery_rate" : 0.08,
+            "incubation_period" : 3,
+            "number_of_hubs" : 10,
+            "degree_of_homophily" : 0.89,
+            "hub_densities" : [8,8,8,8,8,12,12,12,12,12],
+            "hub_sizes" : [80 * scale] * 5 + [120 * scale] * 5,
+            "infection_costs" : [[2,4]] * 10,
+            "infection_cost_key" : "uniform",
+            "starting_vaccination_rate" : 0.15,
+            "number_of_seasons" :  1,
+            "vax_choice_key" : "seasonal_learning",
+            "vax_choice_params" : {"discount_factor": 0.9},
+            "log_time_period_data" : False,
+            "network_generator" : "stochastic_block", #the matching generator is far too slow at this size
+            "network_seed" : 0,
+            "engine" : engine,
+            "use_kernels" : use_kernels}
+
+def time_step(engine, states):
+    engine.infectious, engine.exposed = seir_engine.active_sets(states)
+    engine.draw(states) #the first call compiles the kernels
+    start = time.time()
+    for i in range(number_of_time_periods):
+        engine.draw(states)
+    return (time.time() - start) / number_of_time_periods
+
+def calibrate(model, use_kernels):
+    table = seir_engine.exposure_table(model.rate_of_infection_per_contact, int(np.diff(model.indptr).max()))
+    rng = np.random.default_rng(0)
+    adaptive = seir_engine.AdaptiveEngine(model.indptr, model.indices, table, model.recovery_rate, 1 / model.incubation_period,
+                                          rng, compiled=use_kernels)
+    print(f"{'prevalence':>10} {'dense (ms)':>11} {'frontier (ms)':>14} {'work share':>11}")
+    for prevalence in prevalences:
+        states = np.zeros(number_of_agents, dtype=np.int8)
+        states[rng.random(number_of_agents) < prevalence] = seir_engine.INFECTIOUS
+        states[(states == seir_engine.SUSCEPTIBLE) & (rng.random(number_of_agents) < prevalence)] = seir_engine.EXPOSED
+        dense_seconds = time_step(adaptive.dense, states)
+        frontier_seconds = time_step(adaptive.frontier, states)
+        infectious, exposed = seir_engine.active_sets(states)
+        work_share = (adaptive.degrees[infectious].sum() + len(infectious) + len(exposed)) / adaptive.dense_work
+        print(f"{prevalence:>10} {dense_seconds * 1000:>11.2f} {frontier_seconds * 1000:>14.2f} {work_share:>11.4f}")
+
+def time_season(engine, use_kernels):
+    random.seed(0)
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as tmpdirname: #end_season writes the seasonal data here
+        model = VaxModel(make_config(engine, use_kernels), 0, tmpdirname)
+        model.init_simulation()
+        model.generate_network()
+        start = time.time()
+        model.run_full_simulation()
+        seconds = time.time() - start
+    path_counts = model.array_engine.path_counts if engine == "adaptive" else {}
+    return seconds, path_counts
+
+if __name__ == '__main__':
+    for use_kernels in [False, True]:
+        print(f"use_kernels = {use_kernels}")
+        random.seed(0)
+        model = VaxModel(make_config("numpy", use_kernels), 0, None)
+        model.init_simulation()
+        model.generate_network()
+        calibrate(model, use_kernels)
+        for engine in engines:
+            seconds, path_counts = time_season(engine, use_kernels)
+            print(f"{engine:>10} season: {seconds:.2f}s {path_counts}")
@@ -0,0 +1,59 @@
+# Checks that use_kernels leaves the seasons of every engine exactly as they are without it.
+# Like the other testing files, copy this into simulation_code before running it.
+import json
+import random
+import tempfile
+import numpy as np
+import kernels
+from VaxModel import VaxModel
+
+def make_config(**changes):
+    config = {"number_of_agents" : 1000, 
+              "rate_of_infection_per_contact" : 0.03,
+              "recovery_rate" : 0.08,
+              "incubation_period" : 3,
+              "number_of_hubs" : 10,
+              "degree_of_homophily" : 0.89,
+              "hub_densities" : [8,8,8,8,8,12,12,12,12,12],
+              "hub_sizes" : [80,80,80,80,80,120,120,120,120,120],
+              "infection_costs" : [[2,4]] * 10,
+              "infection_cost_key" : "uniform",
+              "starting_vaccination_rate" : 0.15,
+              "number_of_seasons" :  8,
+              "vax_choice_key" : "seasonal_learning",
+              "vax_choice_params" : {"discount_factor": 0.9},
+              "log_time_period_data" : False}
+    config.update(changes)
+    return config
+
+def seasonal_data(config, seed=0):
+    """
+    Runs one replication and returns its (season, hub, recovered, unvaccinated) records.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        model = VaxModel(config, 0, tmpdirname)
+        model.init_simulation()
+        model.generate_network()
+        model.run_full_simulation()
+        with open(tmpdirname + "/experiment_data_0.log") as f:
+            records = [json.loads(line) for line in f]
+    return [(record["season"], record["hub"], record["recovered"], record["unvaccinated"]) for record in records]
+
+def check_kernels():
+    """
+    The compiled kernels draw the same random numbers as the code they replace, so every engine gives the same
+    seasons with and without use_kernels. The network comes from stochastic_block, since compiled matching draws
+    different networks.
+    """
+    for engine in ["agents", "numpy", "frontier"]:
+        config = make_config(engine=engine, network_generator="stochastic_block", network_seed=0)
+        assert seasonal_data(config) == seasonal_data(dict(config, use_kernels=True)), f"use_kernels changed the {engine} engine"
+
+if __name__ == '__main__':
+    if kernels.NUMBA_AVAILABLE:
+        check_kernels()
+        print("kernel checks passed")
+    else:
+        print("Numba is not installed, so the kernels were not checked")
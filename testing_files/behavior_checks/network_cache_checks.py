@@ -0,0 +1,96 @@
+# Checks the on-disk NetworkCache: keys, misses, hits, unreadable files and eviction, and that a VaxModel with
+# 'network_cache_dir' set runs on exactly the network it would have generated.
+# Like the other testing files, copy this into simulation_code before running it.
+import os
+import tempfile
+import numpy as np
+import network_tools
+from network_cache import NetworkCache
+from VaxModel import VaxModel
+
+hub_sizes = [80, 80, 80, 80, 80, 120, 120, 120, 120, 120]
+hub_densities = [8, 8, 8, 8, 8, 12, 12, 12, 12, 12]
+
+def make_config(network_cache_dir):
+    return {"number_of_agents" : 1000, 
+            "rate_of_infection_per_contact" : 0.03,
+            "recovery_rate" : 0.08,
+            "incubation_period" : 3,
+            "number_of_hubs" : 10,
+            "degree_of_homophily" : 0.89,
+            "hub_densities" : hub_densities,
+            "hub_sizes" : hub_sizes,
+            "infection_costs" : [[2,4]] * 10,
+            "infection_cost_key" : "uniform",
+            "starting_vaccination_rate" : 0.15,
+            "number_of_seasons" :  1,
+            "vax_choice_key" : "seasonal_learning",
+            "vax_choice_params" : {"discount_factor": 0.9},
+            "log_time_period_data" : False,
+            "network_generator" : "stochastic_block",
+            "network_cache_dir" : network_cache_dir}
+
+def cached_files(cache_dir):
+    return sorted(file_name for file_name in os.listdir(cache_dir) if file_name.endswith(".npz"))
+
+def check_keys():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = NetworkCache(cache_dir)
+        key = cache.key("stochastic_block", hub_sizes, hub_densities, 0.89, 0)
+        assert key == cache.key("stochastic_block", list(hub_sizes), list(hub_densities), 0.89, 0)
+        different = [cache.key("matching", hub_sizes, hub_densities, 0.89, 0),
+                     cache.key("stochastic_block", hub_sizes[::-1], hub_densities, 0.89, 0),
+                     cache.key("stochastic_block", hub_sizes, hub_densities[::-1], 0.89, 0),
+                     cache.key("stochastic_block", hub_sizes, hub_densities, 0.5, 0),
+                     cache.key("stochastic_block", hub_sizes, hub_densities, 0.89, 1)]
+        assert key not in different and len(set(different)) == len(different), "different networks share a key"
+
+def check_miss_hit_and_eviction():
+    indptr, indices = network_tools.generate_block_network(hub_sizes, hub_densities, 0.89, seed=0)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = NetworkCache(cache_dir)
+        key = cache.key("stochastic_block", hub_sizes, hub_densities, 0.89, 0)
+        assert cache.load(key) is None, "an empty cache hit"
+        cache.store(key, indptr, indices)
+        network = cache.load(key)
+        assert network is not None and np.array_equal(network[0], indptr) and np.array_equal(network[1], indices)
+
+        #an unreadable file is a miss, not an error
+        with open(cache.path(key), 'wb') as f:
+            f.write(b"not a network")
+        assert cache.load(key) is None
+
+    #with room for only one network, storing a second evicts the first
+    with tempfile.TemporaryDirectory() as cache_dir:
+        megabytes = (indptr.nbytes + indices.nbytes) * 1.5 / (1024 * 1024)
+        cache = NetworkCache(cache_dir, max_megabytes=megabytes)
+        first = cache.key("stochastic_block", hub_sizes, hub_densities, 0.89, 0)
+        second = cache.key("stochastic_block", hub_sizes, hub_densities, 0.89, 1)
+        cache.store(first, indptr, indices)
+        os.utime(cache.path(first), (0, 0)) #make the first network clearly the least recently used
+        cache.store(second, indptr, indices)
+        assert cached_files(cache_dir) == [os.path.basename(cache.path(second))], "eviction kept the wrong networks"
+
+def check_model_hits():
+    """
+    Without a network_seed, the replication number keys the cache, so replication 0 generates and stores its
+    network the first time, loads that very network the second time, and replication 1 gets a different one.
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+        networks = []
+        for replication in [0, 0, 1]:
+            model = VaxModel(make_config(cache_dir), replication, cache_dir, replication)
+            model.init_simulation()
+            model.generate_network()
+            networks.append((np.array(model.indptr), np.array(model.indices)))
+        assert len(cached_files(cache_dir)) == 2, "each replication's network should be stored once"
+        assert all(np.array_equal(a, b) for a, b in zip(networks[0], networks[1])), "a cache hit returned a different network"
+        assert not np.array_equal(networks[0][1], networks[2][1]), "two replications got the same network"
+        expected = network_tools.generate_block_network(hub_sizes, hub_densities, 0.89, seed=0)
+        assert all(np.array_equal(a, b) for a, b in zip(networks[0], expected)), "the cached network is not the generated one"
+
+if __name__ == '__main__':
+    check_keys()
+    check_miss_hit_and_eviction()
+    check_model_hits()
+    print("network cache checks passed")
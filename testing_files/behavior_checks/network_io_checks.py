@@ -0,0 +1,160 @@
+# Checks that a network exported in every format (see network_io.export_network) loads back as the same CSR arrays
+# with network_io.load_network, and that networks whose nodes are not numbered hub by hub are renumbered correctly.
+# Like the other testing files, copy this into simulation_code before running it.
+import csv
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+import numpy as np
+import network_io
+import network_tools
+
+hub_sizes = [80, 80, 80, 120, 120]
+hub_densities = [8, 8, 8, 12, 12]
+degree_of_homophily = 0.89
+
+#networks made by the original code, which give each node's urban/rural type but not its hub
+NETWORK_DATA = os.path.join("..", "deprecated", "mtree_analysis", "network_data")
+original_hub_sizes = [80, 80, 80, 80, 80, 120, 120, 120, 120, 120]
+original_hub_densities = [8, 8, 8, 8, 8, 12, 12, 12, 12, 12]
+
+def csr_edges(indptr, indices):
+    """
+    Each undirected edge once, as (sources, targets) arrays with source < target.
+    """
+    sources = np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+    upper = sources < indices
+    return sources[upper], np.asarray(indices)[upper]
+
+def canonical_edges(indptr, indices):
+    """
+    Every undirected edge once, as a sorted (number_of_edges x 2) array of (low, high) ids.
+    """
+    sources, targets = csr_edges(indptr, indices)
+    edges = np.column_stack((np.minimum(sources, targets), np.maximum(sources, targets))).astype(np.int64)
+    return edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+
+def hub_edge_matrix(indptr, indices, agent_hubs):
+    sources, targets = csr_edges(indptr, indices)
+    matrix = np.zeros((len(hub_sizes), len(hub_sizes)), dtype=np.int64)
+    np.add.at(matrix, (agent_hubs[sources], agent_hubs[targets]), 1)
+    return matrix + matrix.T
+
+def check_round_trips():
+    indptr, indices = network_tools.generate_block_network(hub_sizes, hub_densities, degree_of_homophily, seed=0)
+    agent_hubs = np.repeat(np.arange(len(hub_sizes), dtype=np.int32), hub_sizes)
+    expected = canonical_edges(indptr, indices)
+
+    with tempfile.TemporaryDirectory() as directory:
+        network_io.export_network(directory, "network", indptr, indices, agent_hubs, hub_densities, ["npy", "csv", "gexf"])
+        np.savez(os.path.join(directory, "network.npz"), indptr=indptr, indices=indices, agent_hubs=agent_hubs)
+        files = {"npy": ("network_edges.npy", None),
+                 "csv": ("network_edgelist.csv", "network_nodelist.csv"),
+                 "gexf": ("network.gexf", None),
+                 "npz": ("network.npz", None)}
+        for export_format, (file_name, node_file_name) in files.items():
+            node_path = None if node_file_name is None else os.path.join(directory, node_file_name)
+            network = network_io.load_network(os.path.join(directory, file_name), hub_sizes, hub_densities, node_path)
+            assert network is not None, f"the {export_format} export could not be loaded"
+            assert np.array_equal(network[0], indptr), f"the {export_format} round trip changed the degrees"
+            assert np.array_equal(canonical_edges(*network), expected), f"the {export_format} round trip changed the edges"
+
+def check_renumbering():
+    """
+    A file whose nodes are listed in random order, with their hubs, must come back hub by hub, with every agent
+    keeping their degree and every pair of hubs keeping their number of edges.
+    """
+    indptr, indices = network_tools.generate_block_network(hub_sizes, hub_densities, degree_of_homophily, seed=1)
+    agent_hubs = np.repeat(np.arange(len(hub_sizes), dtype=np.int32), hub_sizes)
+    order = np.random.default_rng(1).permutation(len(agent_hubs)) #agent order[i] is listed as node i
+    new_ids = np.argsort(order)
+    sources, targets = canonical_edges(indptr, indices).T
+    shuffled_indptr, shuffled_indices = network_tools.build_csr(new_ids[sources], new_ids[targets], len(agent_hubs))
+
+    with tempfile.TemporaryDirectory() as directory:
+        network_io.export_network(directory, "shuffled", shuffled_indptr, shuffled_indices, agent_hubs[order], hub_densities, ["csv"])
+        network = network_io.load_network(os.path.join(directory, "shuffled_edgelist.csv"), hub_sizes, hub_densities,
+                                          os.path.join(directory, "shuffled_nodelist.csv"))
+    assert network is not None
+    assert np.array_equal(np.diff(network[0]), np.diff(indptr)), "degrees do not match the hub densities"
+    assert np.array_equal(hub_edge_matrix(*network, agent_hubs), hub_edge_matrix(indptr, indices, agent_hubs))
+
+def read_original_gexf(path):
+    """
+    Parses the file independently of network_io: returns each node's type and the edges, by node label.
+    """
+    types = {}
+    edges = []
+    for _, element in ET.iterparse(path):
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag == 'node':
+            types[element.get('id')] = [attvalue.get('value') for attvalue in element.iter() if attvalue.tag.endswith('attvalue')][0]
+        elif tag == 'edge':
+            edges.append((element.get('source'), element.get('target')))
+    return types, edges
+
+def check_original_network(network, types, edges):
+    """
+    The nodes of each type must fill that type's hubs in file order, and every edge of the file must join the same
+    two agents in the loaded network, so every agent keeps their degree.
+    """
+    assert network is not None, "the original network could not be loaded"
+    indptr, indices = network
+    hub_type = network_tools.hub_types(original_hub_densities)
+    agent_hubs = np.repeat(np.arange(len(original_hub_sizes)), original_hub_sizes)
+    new_ids = {}
+    for node_type in ["rural", "urban"]:
+        agents = np.flatnonzero(np.array(hub_type)[agent_hubs] == node_type)
+        new_ids.update(zip([label for label in types if types[label] == node_type], agents.tolist()))
+    for label, agent in new_ids.items():
+        assert hub_type[agent_hubs[agent]] == types[label], f"node {label} was put in a hub of the wrong type"
+
+    expected = np.array(sorted({(min(new_ids[a], new_ids[b]), max(new_ids[a], new_ids[b])) for a, b in edges}), dtype=np.int64)
+    assert np.array_equal(canonical_edges(indptr, indices), expected), "the loaded edges are not the file's edges"
+    file_degrees = np.bincount(expected.ravel(), minlength=len(agent_hubs))
+    assert np.array_equal(np.diff(indptr), file_degrees), "an agent's degree changed"
+
+def check_original_files():
+    types, edges = read_original_gexf(os.path.join(NETWORK_DATA, "79homophily.gexf"))
+    network = network_io.load_network(os.path.join(NETWORK_DATA, "79homophily.gexf"), original_hub_sizes, original_hub_densities)
+    check_original_network(network, types, edges)
+
+    #the csv files hold the same network, with every edge listed in both directions
+    with open(os.path.join(NETWORK_DATA, "nodelist.csv"), newline='') as f:
+        assert [row["agent"] for row in csv.DictReader(f)] == list(types)
+    network = network_io.load_network(os.path.join(NETWORK_DATA, "edgelist.csv"), original_hub_sizes, original_hub_densities,
+                                      os.path.join(NETWORK_DATA, "nodelist.csv"))
+    check_original_network(network, types, edges)
+
+    #a config whose hubs do not match the file's types, or whose densities do not match its degrees, runs nothing
+    assert network_io.load_network(os.path.join(NETWORK_DATA, "79homophily.gexf"), [500, 500], [8, 12]) is None
+    assert network_io.load_network(os.path.join(NETWORK_DATA, "79homophily.gexf"), original_hub_sizes, [8] * 10) is None
+    #89homophily.gexf has 401 rural nodes, one more than these hubs hold
+    assert network_io.load_network(os.path.join(NETWORK_DATA, "89homophily.gexf"), original_hub_sizes, original_hub_densities) is None
+
+def check_degree_validation():
+    """
+    Without hubs or types, nodes are put in hubs in file order, and a file whose degrees do not fit the hubs it was
+    put in is rejected. A few agents short of neighbors are allowed, up to degree_tolerance.
+    """
+    indptr, indices = network_tools.generate_block_network(hub_sizes, hub_densities, degree_of_homophily, seed=2)
+    order = np.random.default_rng(2).permutation(len(indptr) - 1)
+    with tempfile.TemporaryDirectory() as directory:
+        network_io.export_network(directory, "network", *network_tools.permute_csr(indptr, indices, order),
+                                  np.zeros(len(order), dtype=np.int32), hub_densities, ["npy"])
+        assert network_io.load_network(os.path.join(directory, "network_edges.npy"), hub_sizes, hub_densities) is None
+
+        #drop one edge, leaving two agents one neighbor short
+        sources, targets = canonical_edges(indptr, indices)[1:].T
+        short_indptr, short_indices = network_tools.build_csr(sources.astype(np.int32), targets.astype(np.int32), len(indptr) - 1)
+        network_io.export_network(directory, "short", short_indptr, short_indices, np.zeros(len(order), dtype=np.int32), hub_densities, ["npy"])
+        path = os.path.join(directory, "short_edges.npy")
+        assert network_io.load_network(path, hub_sizes, hub_densities) is not None
+        assert network_io.load_network(path, hub_sizes, hub_densities, degree_tolerance=0) is None
+
+if __name__ == '__main__':
+    check_round_trips()
+    check_renumbering()
+    check_original_files()
+    check_degree_validation()
+    print("network I/O checks passed")
@@ -0,0 +1,82 @@
+# Checks that network_tools.rewire_homophily (used when 'homophily_base' is set) keeps every agent's degree and
+# hub, keeps the network simple, and moves each hub's number of inside edges to its target for the new homophily,
+# including with only two hubs, and that targets no network can have are refused, with VaxModel generating the
+# network from scratch instead.
+# Like the other testing files, copy this into simulation_code before running it.
+import numpy as np
+import network_tools
+from VaxModel import VaxModel
+
+hub_sizes = [80, 80, 80, 80, 80, 120, 120, 120, 120, 120]
+hub_densities = [8, 8, 8, 8, 8, 12, 12, 12, 12, 12]
+
+def inside_edges(indptr, indices, agent_hubs):
+    sources, targets = network_tools.csr_edges(indptr, indices)
+    inside = agent_hubs[sources] == agent_hubs[targets]
+    return np.bincount(agent_hubs[sources[inside]], minlength=int(agent_hubs.max()) + 1)
+
+def check_rewire(base_homophily, degree_of_homophily, hub_sizes=hub_sizes, hub_densities=hub_densities):
+    agent_hubs = np.repeat(np.arange(len(hub_sizes), dtype=np.int32), hub_sizes)
+    indptr, indices = network_tools.generate_block_network(hub_sizes, hub_densities, base_homophily, seed=0)
+    rng = np.random.default_rng(0)
+    network = network_tools.rewire_homophily(indptr, indices, agent_hubs, degree_of_homophily, rng)
+    assert network is not None, f"could not rewire from {base_homophily} to {degree_of_homophily}"
+    new_indptr, new_indices = network
+
+    assert np.array_equal(np.diff(new_indptr), np.diff(indptr)), "rewiring changed a degree"
+    sources, targets = network_tools.csr_edges(new_indptr, new_indices)
+    assert np.all(sources != targets), "rewiring made a self-loop"
+    keys = np.minimum(sources, targets).astype(np.int64) * len(agent_hubs) + np.maximum(sources, targets)
+    assert len(np.unique(keys)) == len(keys), "rewiring made a repeated edge"
+
+    #the same targets generate_block_edges aims for, from the neighbors the agents actually have
+    hub_sizes_array = np.asarray(hub_sizes)
+    stubs = np.bincount(agent_hubs, weights=np.diff(indptr))
+    targets = np.minimum(np.round(degree_of_homophily * stubs / 2), hub_sizes_array * (hub_sizes_array - 1) // 2)
+    assert np.array_equal(inside_edges(new_indptr, new_indices, agent_hubs), targets), \
+        f"inside edges {inside_edges(new_indptr, new_indices, agent_hubs).tolist()} missed the targets {targets.tolist()}"
+
+def check_infeasible():
+    """
+    With two hubs every cross-hub edge joins both of them, so they must need the same number of cross-hub neighbors.
+    Hubs of 800 and 1200 neighbor slots cannot both be half inside, so that target is refused without any swaps.
+    """
+    two_hub_sizes, two_hub_densities = [100, 100], [8, 12]
+    agent_hubs = np.repeat(np.arange(2, dtype=np.int32), two_hub_sizes)
+    indptr, indices = network_tools.generate_block_network(two_hub_sizes, two_hub_densities, 0.9, seed=0)
+    assert network_tools.homophily_targets(indptr, agent_hubs, 0.5) is None
+    assert network_tools.rewire_homophily(indptr, indices, agent_hubs, 0.5, np.random.default_rng(0)) is None
+
+    #the model generates a network at the new homophily instead, the same one stochastic_block gives without a base
+    config = {"number_of_agents" : 200,
+              "rate_of_infection_per_contact" : 0.03,
+              "recovery_rate" : 0.08,
+              "incubation_period" : 3,
+              "number_of_hubs" : 2,
+              "degree_of_homophily" : 0.5,
+              "homophily_base" : 0.9,
+              "network_generator" : "stochastic_block",
+              "network_seed" : 0,
+              "hub_densities" : two_hub_densities,
+              "hub_sizes" : two_hub_sizes,
+              "infection_costs" : [[2,4]] * 2,
+              "infection_cost_key" : "uniform",
+              "starting_vaccination_rate" : 0.15,
+              "number_of_seasons" :  1,
+              "vax_choice_key" : "seasonal_learning",
+              "vax_choice_params" : {"discount_factor": 0.9},
+              "log_time_period_data" : False}
+    model = VaxModel(config, 0, None)
+    model.init_simulation()
+    model.generate_network()
+    expected = network_tools.generate_block_network(two_hub_sizes, two_hub_densities, 0.5, seed=0)
+    assert np.array_equal(model.indptr, expected[0]) and np.array_equal(model.indices, expected[1])
+
+if __name__ == '__main__':
+    check_rewire(0.5, 0.89) #raising homophily
+    check_rewire(0.89, 0.5) #lowering it
+    check_rewire(0.7, 0.7) #nothing to do
+    check_rewire(0.5, 0.9, [100, 100], [10, 10]) #two hubs, raising
+    check_rewire(0.5, 0.2, [100, 100], [10, 10]) #two hubs, lowering
+    check_infeasible()
+    print("rewiring checks passed")
@@ -0,0 +1,140 @@
+# Checks that the StateStore leaves the agents engine's seasons exactly as the original code gave them, that its
+# per-hub counts always match its state arrays through every kind of update the engines make (with and without the
+# compiled hub_counts kernel), and that packed histories unpack to what was stored.
+# Like the other testing files, copy this into simulation_code before running it.
+import json
+import random
+import tempfile
+import numpy as np
+import kernels
+from state_store import StateStore, pack_states, unpack_states
+from states import STATES, SUSCEPTIBLE, EXPOSED, INFECTIOUS, RECOVERED, VACCINATED
+from VaxModel import VaxModel
+
+#recovered and unvaccinated agents over all hubs and seasons, as the original code gave them for random.seed(0)
+ORIGINAL_TOTALS = (2017, 3565)
+
+number_of_agents = 1001 #odd, so the last byte of a packed history is half full
+number_of_hubs = 7
+number_of_time_periods = 50
+
+def make_config():
+    return {"number_of_agents" : 1000,
+            "rate_of_infection_per_contact" : 0.03,
+            "recovery_rate" : 0.08,
+            "incubation_period" : 3,
+            "number_of_hubs" : 10,
+            "degree_of_homophily" : 0.89,
+            "hub_densities" : [8,8,8,8,8,12,12,12,12,12],
+            "hub_sizes" : [80,80,80,80,80,120,120,120,120,120],
+            "infection_costs" : [[2,4]] * 10,
+            "infection_cost_key" : "uniform",
+            "starting_vaccination_rate" : 0.15,
+            "number_of_seasons" :  8,
+            "vax_choice_key" : "seasonal_learning",
+            "vax_choice_params" : {"discount_factor": 0.9},
+            "log_time_period_data" : False}
+
+def check_original_results():
+    random.seed(0)
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        model = VaxModel(make_config(), 0, tmpdirname)
+        model.init_simulation()
+        model.generate_network()
+        model.run_full_simulation()
+        with open(tmpdirname + "/experiment_data_0.log") as f:
+            records = [json.loads(line) for line in f]
+    totals = (sum(record["recovered"] for record in records), sum(record["unvaccinated"] for record in records))
+    assert totals == ORIGINAL_TOTALS, f"the agents engine gave {totals}, the original code gave {ORIGINAL_TOTALS}"
+
+def make_store(rng, keep_history=False, compiled=False):
+    agent_hubs = np.sort(rng.integers(0, number_of_hubs, number_of_agents)).astype(np.int32)
+    store = StateStore(number_of_agents, agent_hubs, number_of_hubs, keep_history, compiled)
+    store.states[:] = rng.choice([SUSCEPTIBLE, VACCINATED, INFECTIOUS], number_of_agents, p=[0.8, 0.15, 0.05])
+    store.recount()
+    return store
+
+def expected_counts(store, states):
+    counts = np.zeros((number_of_hubs, len(STATES)), dtype=np.int64)
+    np.add.at(counts, (store.agent_hubs, states), 1)
+    return counts
+
+def check_counts(store):
+    assert np.array_equal(store.counts, expected_counts(store, store.states)), "counts drifted from the states"
+    for code in range(len(STATES)):
+        assert store.count(code) == int(np.count_nonzero(store.states == code))
+
+def run_periods(store, rng):
+    """
+    Steps the store the way the engines do: bulk moves between states, exposures, and single set_state calls.
+    """
+    for time_period in range(number_of_time_periods):
+        store.begin_period()
+        assert np.array_equal(store.starting_counts, expected_counts(store, store.starting_states)), "starting counts are wrong"
+        assert np.array_equal(store.starting_states, store.states), "starting states are not the states at the start of the period"
+
+        states = store.states
+        newly_exposed = np.flatnonzero((states == SUSCEPTIBLE) & (rng.random(number_of_agents) < 0.05))
+        recovering = np.flatnonzero((states == INFECTIOUS) & (rng.random(number_of_agents) < 0.1))
+        incubated = np.flatnonzero((states == EXPOSED) & (rng.random(number_of_agents) < 0.3))
+        store.expose(newly_exposed)
+        store.move(recovering, INFECTIOUS, RECOVERED)
+        store.move(incubated, EXPOSED, INFECTIOUS)
+        store.move(newly_exposed, SUSCEPTIBLE, EXPOSED)
+        assert store.new_exposures == len(newly_exposed)
+        assert np.array_equal(np.flatnonzero(store.exposed), np.sort(newly_exposed))
+
+        #the agents engine changes states one agent at a time
+        for unique_id in rng.choice(number_of_agents, 5, replace=False):
+            store.set_state(unique_id, STATES[rng.integers(len(STATES))])
+        store.record_period()
+        check_counts(store)
+
+def check_counts_match_states(compiled=False):
+    rng = np.random.default_rng(0)
+    store = make_store(rng, compiled=compiled)
+    check_counts(store)
+    run_periods(store, rng)
+
+def check_replace_and_permute():
+    rng = np.random.default_rng(1)
+    store = make_store(rng)
+    run_periods(store, rng)
+    store.replace(rng.choice([SUSCEPTIBLE, VACCINATED], number_of_agents).astype(np.int8))
+    check_counts(store)
+
+    #renumbering agents within their hubs keeps every hub's counts
+    counts = store.counts.copy()
+    order = np.concatenate([rng.permutation(np.flatnonzero(store.agent_hubs == hub)) for hub in range(number_of_hubs)])
+    store.permute(order)
+    check_counts(store)
+    assert np.array_equal(store.counts, counts)
+
+def check_history():
+    rng = np.random.default_rng(2)
+    store = make_store(rng, keep_history=True)
+    saved = []
+    for time_period in range(10):
+        store.begin_period()
+        newly_exposed = np.flatnonzero((store.states == SUSCEPTIBLE) & (rng.random(number_of_agents) < 0.05))
+        store.expose(newly_exposed)
+        store.move(newly_exposed, SUSCEPTIBLE, EXPOSED)
+        saved.append((store.starting_states.copy(), store.exposed.copy()))
+        store.record_period()
+    store.end_season()
+    starting_states, exposed = store.history(0)
+    assert np.array_equal(starting_states, np.array([states for states, _ in saved]))
+    assert np.array_equal(exposed, np.array([exposed for _, exposed in saved]))
+
+    states = rng.integers(0, len(STATES), number_of_agents).astype(np.int8)
+    assert np.array_equal(unpack_states(pack_states(states), number_of_agents), states)
+
+if __name__ == '__main__':
+    check_original_results()
+    check_counts_match_states()
+    if kernels.NUMBA_AVAILABLE:
+        check_counts_match_states(compiled=True)
+    check_replace_and_permute()
+    check_history()
+    print("StateStore checks passed")
@@ -0,0 +1,85 @@
+# Times one SEIR time period with and without agent reordering (the 'agent_order' config key).
+# Like the other testing files, copy this into simulation_code before running it.
+import random
+import time
+import numpy as np
+import network_tools
+import seir_engine
+from VaxModel import VaxModel
+
+number_of_time_periods = 10 #time periods to average over for each measurement
+agent_orders = ["shuffled", "hub"]
+populations = [10000, 100000]
+
+def make_config(number_of_agents, agent_order):
+    scale = number_of_agents // 1000
+    return {"number_of_agents" : number_of_agents, 
+            "rate_of_infection_per_contact" : 0.03,
+            "recovery_rate" : 0.08,
+            "incubation_period" : 3,
+            "number_of_hubs" : 10,
+            "degree_of_homophily" : 0.89,
+            "hub_densities" : [8,8,8,8,8,12,12,12,12,12],
+            "hub_sizes" : [80 * scale] * 5 + [120 * scale] * 5,
+            "infection_costs" : [[2,4]] * 10,
+            "infection_cost_key" : "uniform",
+            "starting_vaccination_rate" : 0.15,
+            "number_of_seasons" :  1,
+            "vax_choice_key" : "seasonal_learning",
+            "vax_choice_params" : {"discount_factor": 0.9},
+            "log_time_period_data" : False,
+            "network_generator" : "stochastic_block", #the matching generator is far too slow at 100k agents
+            "network_seed" : 0,
+            "agent_order" : agent_order}
+
+def shuffle_agents(model, rng):
+    """
+    Stands in for the matching generator's random numbering: stochastic_block numbers agents hub by hub, so the
+    agents are renumbered in a random order, across hubs, before any ordering is applied.
+    """
+    order = rng.permutation(model.number_of_agents)
+    indptr, indices = network_tools.permute_csr(model.indptr, model.indices, order)
+    model.agent_hubs[:] = model.agent_hubs[order] #in place, so the StateStore keeps sharing the array
+    model.agents_by_id = [model.agents_by_id[old_id] for old_id in order]
+    for new_id, agent in enumerate(model.agents_by_id):
+        agent.unique_id = new_id
+        agent.hub = int(model.agent_hubs[new_id])
+    model.store.permute(order)
+    model.set_adjacency(indptr, indices)
+    model.agents = model.agents_by_id.copy()
+
+def benchmark(number_of_agents, agent_order):
+    random.seed(0)
+    np.random.seed(0)
+    model = VaxModel(make_config(number_of_agents, agent_order), 0, None)
+    model.init_simulation()
+    model.generate_network()
+    if agent_order == "shuffled":
+        shuffle_agents(model, np.random.default_rng(0))
+
+    #time the model's own time period, including the agent state updates that follow it in run_full_simulation
+    start = time.time()
+    for i in range(number_of_time_periods):
+        model.run_one_time_period()
+        for agent in model.agents:
+            exposed = bool(model.store.exposed[agent.unique_id])
+            agent.update_state(exposed, model.time_period)
+        model.time_period += 1
+    model_seconds = (time.time() - start) / number_of_time_periods
+
+    #time the sparse product that counts every agent's infectious neighbors, in the order the agents are stored
+    adjacency = seir_engine.adjacency_matrix(model.indptr, model.indices)
+    infectious = (np.random.random(number_of_agents) < 0.05).astype(np.int32)
+    start = time.time()
+    for i in range(number_of_time_periods):
+        counts = adjacency @ infectious
+    array_seconds = (time.time() - start) / number_of_time_periods
+
+    return model_seconds, array_seconds
+
+if __name__ == '__main__':
+    print(f"{'agents':>8} {'agent_order':>12} {'time period (s)':>16} {'neighbor pass (ms)':>19}")
+    for number_of_agents in populations:
+        for agent_order in agent_orders:
+            model_seconds, array_seconds = benchmark(number_of_agents, agent_order)
+            print(f"{number_of_agents:>8} {agent_order:>12} {model_seconds:>16.3f} {array_seconds * 1000:>19.2f}")
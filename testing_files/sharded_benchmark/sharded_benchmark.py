@@ -0,0 +1,67 @@
+# Times one season of a single large replication with the numpy engine and with the sharded engine
+# (the 'engine' and 'number_of_shards' config keys), for a few shard counts, and gives each one's speedup over numpy.
+# The best a shard count can do is the number of agents over the agents of its largest shard (the 'ideal' column),
+# and only with a core for every shard, so run this on a machine with at least as many cores as the largest count.
+# Like the other testing files, copy this into simulation_code before running it.
+import os
+import random
+import tempfile
+import time
+import numpy as np
+import sharded_engine
+from VaxModel import VaxModel
+
+shard_counts = [1, 2, 4, 8]
+populations = [100000, 1000000]
+
+def make_config(number_of_agents, engine, number_of_shards):
+    scale = number_of_agents // 1000
+    return {"number_of_agents" : number_of_agents, 
+            "rate_of_infection_per_contact" : 0.03,
+            "recovery_rate" : 0.08,
+            "incubation_period" : 3,
+            "number_of_hubs" : 10,
+            "degree_of_homophily" : 0.89,
+            "hub_densities" : [8,8,8,8,8,12,12,12,12,12],
+            "hub_sizes" : [80 * scale] * 5 + [120 * scale] * 5,
+            "infection_costs" : [[2,4]] * 10,
+            "infection_cost_key" : "uniform",
+            "starting_vaccination_rate" : 0.15,
+            "number_of_seasons" :  1,
+            "vax_choice_key" : "seasonal_learning",
+            "vax_choice_params" : {"discount_factor": 0.9},
+            "log_time_period_data" : False,
+            "network_generator" : "stochastic_block", #the matching generator is far too slow at these sizes
+            "network_seed" : 0,
+            "engine" : engine,
+            "number_of_shards" : number_of_shards}
+
+def benchmark(number_of_agents, engine, number_of_shards=1):
+    random.seed(0)
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as tmpdirname: #end_season writes the seasonal data here
+        model = VaxModel(make_config(number_of_agents, engine, number_of_shards), 0, tmpdirname)
+        model.init_simulation()
+        model.generate_network()
+
+        #time the whole season, including starting and stopping the shard workers
+        start = time.time()
+        model.run_full_simulation()
+        return time.time() - start
+
+def ideal_speedup(number_of_agents, number_of_shards):
+    config = make_config(number_of_agents, "sharded", number_of_shards)
+    agent_hubs = np.repeat(np.arange(config["number_of_hubs"]), config["hub_sizes"])
+    ranges = sharded_engine.shard_ranges(agent_hubs, config["number_of_hubs"], number_of_shards)
+    return number_of_agents / max(stop - start for start, stop in ranges)
+
+if __name__ == '__main__':
+    print(f"{os.cpu_count()} cores")
+    print(f"{'agents':>8} {'engine':>8} {'shards':>7} {'season (s)':>11} {'speedup':>8} {'ideal':>6}")
+    for number_of_agents in populations:
+        numpy_seconds = benchmark(number_of_agents, "numpy")
+        print(f"{number_of_agents:>8} {'numpy':>8} {'-':>7} {numpy_seconds:>11.2f} {1:>8.2f} {'-':>6}")
+        for number_of_shards in shard_counts:
+            seconds = benchmark(number_of_agents, "sharded", number_of_shards)
+            print(f"{number_of_agents:>8} {'sharded':>8} {number_of_shards:>7} {seconds:>11.2f} "
+                  f"{numpy_seconds / seconds:>8.2f} {ideal_speedup(number_of_agents, number_of_shards):>6.2f}")